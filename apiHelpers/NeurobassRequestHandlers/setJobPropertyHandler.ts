@@ -62,6 +62,9 @@ const setJobPropertyHandler = async (request: SetJobPropertyRequest, o: {verifie
     else if (request.property === 'consoleOutput') {
         update.consoleOutput = request.value
     }
+    else if (request.property === 'metrics') {
+        update.metrics = request.value
+    }
     else {
         throw new Error(`Invalid property: ${request.property}`)
     }
@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+import numpy as np
+import yaml
+from neurobass.crypto_keys import generate_keypair
+from fake_neurobass_api import FakeNeurobassApi
+from s3_stub import S3Stub
+
+
+# End-to-end benchmark of the orchestration overhead around a processing tool.
+#
+# A no-op tool (noop_plugin.py) is run through the real
+# handle_job -> run-job path against a fake /api/neurobass server (which
+# verifies signatures) and a local S3-compatible stub, for N concurrent jobs.
+# Per-phase latencies are derived from the timestamps of the API requests.
+#
+# python bench_job_pipeline.py --num-jobs 8 --output results.json
+
+this_directory = Path(__file__).parent
+
+_phases = [
+    # (name, start event, end event)
+    ('startup', 'spawn', 'first_request'), # python startup and config loading in handle_job
+    ('claim', 'first_request', 'running'), # getJob + set status to running
+    ('inputs', 'running', 'inputs_resolved'), # getFile for each input and writing job.json
+    ('run_job', 'inputs_resolved', 'output_registered'), # run-job subprocess: plugin imports, tool, S3 upload, console streaming
+    ('upload', 'upload_start', 'upload_end'), # S3 upload (part of run_job)
+    ('finalize', 'output_registered', 'completed'), # setFile + set status to completed
+    ('exit', 'completed', 'exit'),
+    ('total', 'spawn', 'exit')
+]
+
+def run_pipeline_benchmark(*, work_dir: str, num_jobs: int, output_size_bytes: int, stream_output: bool=False) -> dict:
+    compute_resource_id, compute_resource_private_key = generate_keypair()
+    with FakeNeurobassApi(compute_resource_id=compute_resource_id) as api, S3Stub() as s3:
+        config = {
+            'COMPUTE_RESOURCE_ID': compute_resource_id,
+            'COMPUTE_RESOURCE_PRIVATE_KEY': compute_resource_private_key,
+            'NODE_ID': 'bench',
+            'NODE_NAME': 'bench',
+            'CONTAINER_METHOD': 'none',
+            'OUTPUT_ENDPOINT_URL': s3.endpoint_url,
+            'OUTPUT_AWS_ACCESS_KEY_ID': 'bench',
+            'OUTPUT_AWS_SECRET_ACCESS_KEY': 'bench',
+            'OUTPUT_BUCKET': 'bench',
+            'OUTPUT_BUCKET_BASE_URL': f'{s3.endpoint_url}/bench',
+            'NEUROBASS_PLUGIN_PACKAGES': 'noop_plugin'
+        }
+        with open(os.path.join(work_dir, '.neurobass-compute-resource-node.yaml'), 'w') as f:
+            yaml.dump(config, f)
+
+        job_ids = [f'job{i:04d}' for i in range(num_jobs)]
+        for i, job_id in enumerate(job_ids):
+            # a separate project per job so that getFile/setFile can be attributed to jobs
+            project_id = f'project{i:04d}'
+            api.add_file(project_id=project_id, file_name='input.dat', content='url:https://example.com/input.dat')
+            api.add_job({
+                'jobId': job_id,
+                'workspaceId': 'workspace',
+                'projectId': project_id,
+                'toolName': 'noop',
+                'status': 'pending',
+                'inputFiles': [{'name': 'input', 'fileName': 'input.dat', 'fileId': 'input'}],
+                'outputFiles': [{'name': 'output', 'fileName': 'output.dat'}],
+                'inputParameters': [{'name': 'output_size_bytes', 'value': output_size_bytes}, {'name': 'stream_output', 'value': stream_output}]
+            })
+
+        env = dict(os.environ)
+        env['NEUROBASS_URL'] = api.base_url
+        env['PYTHONPATH'] = str(this_directory.absolute()) + os.pathsep + env.get('PYTHONPATH', '')
+        env['AWS_EC2_METADATA_DISABLED'] = 'true'
+
+        timestamps = {job_id: {} for job_id in job_ids}
+        procs = {}
+        t_start = time.time()
+        for job_id in job_ids:
+            timestamps[job_id]['spawn'] = time.time()
+            procs[job_id] = subprocess.Popen(
+                ['neurobass', 'handle-job', '--job-id', job_id],
+                cwd=work_dir,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+        remaining = set(job_ids)
+        while remaining:
+            for job_id in list(remaining):
+                if procs[job_id].poll() is not None:
+                    timestamps[job_id]['exit'] = time.time()
+                    remaining.remove(job_id)
+            time.sleep(0.005)
+        t_end = time.time()
+
+        project_to_job = {api.jobs[job_id]['projectId']: job_id for job_id in job_ids}
+        for e in api.events:
+            p = e['payload']
+            t = e['timestamp']
+            job_id = p.get('jobId', None) or project_to_job.get(p.get('projectId', None), None)
+            if job_id is None:
+                continue
+            ts = timestamps[job_id]
+            ts.setdefault('first_request', t)
+            if p['type'] == 'setJobProperty' and p['property'] == 'status':
+                ts[p['value']] = t
+                if p['value'] == 'running':
+                    ts.setdefault('inputs_resolved', t)
+            elif p['type'] == 'getFile':
+                ts['inputs_resolved'] = t
+            elif p['type'] == 'setFile':
+                ts['output_registered'] = t
+        for u in s3.uploads:
+            job_id = Path(u['path']).stem
+            if job_id in timestamps:
+                timestamps[job_id]['upload_start'] = u['timestamp_start']
+                timestamps[job_id]['upload_end'] = u['timestamp_end']
+
+        jobs = []
+        for job_id in job_ids:
+            ts = timestamps[job_id]
+            phases = {}
+            for name, a, b in _phases:
+                if a in ts and b in ts:
+                    phases[name] = ts[b] - ts[a]
+            jobs.append({
+                'job_id': job_id,
+                'status': api.jobs[job_id]['status'],
+                'error': api.jobs[job_id].get('error', None),
+                'phases': phases,
+                'metrics': api.jobs[job_id].get('metrics', None)
+            })
+
+        summary = {}
+        for name, a, b in _phases:
+            x = np.array([j['phases'][name] for j in jobs if name in j['phases']])
+            if len(x) == 0:
+                continue
+            summary[name] = {
+                'mean_sec': float(np.mean(x)),
+                'median_sec': float(np.median(x)),
+                'p95_sec': float(np.percentile(x, 95)),
+                'max_sec': float(np.max(x))
+            }
+        num_completed = len([j for j in jobs if j['status'] == 'completed'])
+        total_uploaded = sum(u['size'] for u in s3.uploads)
+        return {
+            'num_jobs': num_jobs,
+            'num_completed': num_completed,
+            'num_invalid_signatures': api.num_invalid_signatures,
+            'num_api_requests': len(api.events),
+            'wall_time_sec': t_end - t_start,
+            'jobs_per_sec': num_jobs / (t_end - t_start),
+            'upload_bytes': total_uploaded,
+            'upload_mb_per_sec': total_uploaded / 1e6 / sum(u['timestamp_end'] - u['timestamp_start'] for u in s3.uploads) if s3.uploads else None,
+            'phases': summary,
+            'jobs': jobs
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the orchestration overhead of the job pipeline')
+    parser.add_argument('--output', default='bench_job_pipeline_results.json', help='Output JSON file')
+    parser.add_argument('--num-jobs', type=int, default=4, help='Number of concurrent jobs')
+    parser.add_argument('--output-size-bytes', type=int, default=1000 * 1000, help='Size of the output file of each job')
+    parser.add_argument('--stream-output', action='store_true', help='Stream the output to the bucket as it is written (context.open_output_file) instead of writing a local file and uploading it')
+    parser.add_argument('--work-dir', default=None, help='Compute resource directory (defaults to a temporary directory)')
+    args = parser.parse_args()
+
+    if shutil.which('neurobass') is None:
+        print('The neurobass command was not found. Install the package first (pip install -e .)')
+        sys.exit(1)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='neurobass_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        result = run_pipeline_benchmark(work_dir=work_dir, num_jobs=args.num_jobs, output_size_bytes=args.output_size_bytes, stream_output=args.stream_output)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+    out = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.time()
+        },
+        'result': result
+    }
+    with open(args.output, 'w') as f:
+        json.dump(out, f, indent=2)
+    print(f'Completed {result["num_completed"]} of {result["num_jobs"]} jobs in {result["wall_time_sec"]:.2f} sec ({result["jobs_per_sec"]:.2f} jobs/sec)')
+    for name, s in result['phases'].items():
+        print(f'  {name}: median {s["median_sec"]:.3f} sec, p95 {s["p95_sec"]:.3f} sec')
+    print(f'Wrote {args.output}')
+    if result['num_completed'] != result['num_jobs']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+from typing import Any, List
+import numpy as np
+import h5py
+import spikeinterface as si
+from neurobass.NeurobassPluginTypes import NeurobassProcessingToolContext, InputFile, OutputFile
+from neurobass.processing_tools.InputFileManager import InputFileManager
+from neurobass.processing_tools.spike_sorting.NwbRecording import NwbRecording
+from neurobass.processing_tools.spike_sorting.NwbMetadata import NwbFileMetadata
+from neurobass.processing_tools.spike_sorting.create_sorting_out_nwb_file import create_sorting_out_nwb_file
+from neurobass.processing_tools.spike_sorting.Kilosort3ProcessingTool import _make_binary_recording
+from synthetic_nwb import create_synthetic_nwb_file
+from range_http_server import RangeHTTPServer
+
+
+# Benchmarks for the NWB read and write hot paths, using synthetic recordings
+# served over a local HTTP server with range support to mimic remote access.
+#
+# python bench_nwb_io.py --output results.json
+# python bench_nwb_io.py --output results2.json --compare results.json
+
+class _BenchmarkContext(NeurobassProcessingToolContext):
+    def __init__(self, url: str):
+        self._url = url
+    def get_data(self) -> Any:
+        return {}
+    def get_input_file_url(self, input_file: InputFile) -> str:
+        return self._url
+    def upload_output_file(self, output_file: OutputFile, path: str):
+        pass
+
+def _file_variants(channel_counts: List[int]):
+    for num_channels in channel_counts:
+        yield {'num_channels': num_channels, 'chunked': False, 'compression': None}
+        yield {'num_channels': num_channels, 'chunked': True, 'compression': None}
+        yield {'num_channels': num_channels, 'chunked': True, 'compression': 'gzip'}
+
+def _variant_name(v: dict) -> str:
+    layout = 'chunked' if v['chunked'] else 'contiguous'
+    return f'ch{v["num_channels"]}_{layout}_{v["compression"] or "raw"}'
+
+def _open_recording(url: str, cache_dir: str, **kwargs):
+    context = _BenchmarkContext(url)
+    input_files = InputFileManager(context, disk_cache_dir=cache_dir)
+    f = input_files.get_h5py_file(InputFile(name='input', path='input.nwb', content_string=f'url:{url}'))
+    recording = NwbRecording(file=f, electrical_series_path='/acquisition/ElectricalSeries', **kwargs)
+    return recording, context, input_files
+
+def bench_open(url: str, work_dir: str) -> dict:
+    cache_dir = tempfile.mkdtemp(dir=work_dir)
+    t0 = time.time()
+    recording, context, input_files = _open_recording(url, cache_dir)
+    elapsed = time.time() - t0
+    bytes_read = context.get_metrics().to_dict()['counters'].get('input_bytes_read', 0)
+    input_files.close()
+    return {'elapsed_sec': elapsed, 'bytes_read': bytes_read}
+
+def bench_get_traces(url: str, work_dir: str, *, num_frames: int, channel_subset: bool, num_decode_threads: int=1) -> dict:
+    cache_dir = tempfile.mkdtemp(dir=work_dir)
+    recording, context, input_files = _open_recording(url, cache_dir, num_decode_threads=num_decode_threads)
+    num_frames = min(num_frames, recording.get_num_samples())
+    if channel_subset:
+        # every 4th channel - a non-contiguous selection
+        channel_ids = recording.get_channel_ids()[::4]
+    else:
+        channel_ids = None
+    t0 = time.time()
+    traces = recording.get_traces(start_frame=0, end_frame=num_frames, channel_ids=channel_ids)
+    elapsed = time.time() - t0
+    input_files.close()
+    return {
+        'elapsed_sec': elapsed,
+        'num_bytes': traces.nbytes,
+        'throughput_mb_per_sec': traces.nbytes / 1e6 / elapsed
+    }
+
+def bench_make_binary_recording(url: str, work_dir: str, *, num_workers: int=1) -> dict:
+    cache_dir = tempfile.mkdtemp(dir=work_dir)
+    recording, context, input_files = _open_recording(url, cache_dir)
+    out_dir = tempfile.mkdtemp(dir=work_dir)
+    t0 = time.time()
+    _make_binary_recording(recording, out_dir, num_workers=num_workers)
+    elapsed = time.time() - t0
+    input_files.close()
+    num_bytes = recording.get_num_samples() * recording.get_num_channels() * 2
+    shutil.rmtree(out_dir)
+    return {
+        'elapsed_sec': elapsed,
+        'num_bytes': num_bytes,
+        'throughput_mb_per_sec': num_bytes / 1e6 / elapsed
+    }
+
+def bench_create_sorting_out_nwb_file(nwb_fname: str, work_dir: str, *, num_units: int, num_spikes_per_unit: int) -> dict:
+    sampling_frequency = 30000
+    rng = np.random.default_rng(0)
+    units_dict = {
+        unit_id: np.sort(rng.integers(0, sampling_frequency * 3600, size=num_spikes_per_unit))
+        for unit_id in range(1, num_units + 1)
+    }
+    if hasattr(si.NumpySorting, 'from_unit_dict'):
+        sorting = si.NumpySorting.from_unit_dict([units_dict], sampling_frequency=sampling_frequency)
+    else:
+        sorting = si.NumpySorting.from_dict([units_dict], sampling_frequency=sampling_frequency)
+    out_fname = os.path.join(work_dir, f'sorting_{num_units}_{num_spikes_per_unit}.nwb')
+    with h5py.File(nwb_fname, 'r') as f:
+        t0 = time.time()
+        create_sorting_out_nwb_file(nwbfile_rec=NwbFileMetadata(f), sorting=sorting, sorting_out_fname=out_fname)
+        elapsed = time.time() - t0
+    return {'elapsed_sec': elapsed, 'output_size': os.path.getsize(out_fname)}
+
+def run_benchmarks(*, work_dir: str, channel_counts: List[int], duration_sec: float, read_duration_sec: float) -> list:
+    results = []
+    def add(benchmark: str, params: dict, result: dict):
+        print(f'{benchmark} {json.dumps(params)}: {result["elapsed_sec"]:.3f} sec')
+        results.append({'benchmark': benchmark, 'params': params, **result})
+
+    data_dir = os.path.join(work_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    variants = list(_file_variants(channel_counts))
+    for v in variants:
+        fname = os.path.join(data_dir, _variant_name(v) + '.nwb')
+        print(f'Generating {fname}')
+        create_synthetic_nwb_file(fname, num_channels=v['num_channels'], duration_sec=duration_sec, chunked=v['chunked'], compression=v['compression'])
+
+    with RangeHTTPServer(data_dir) as server:
+        for v in variants:
+            url = f'{server.base_url}/{_variant_name(v)}.nwb'
+            params = dict(v)
+            add('nwb_recording_open', params, bench_open(url, work_dir))
+            num_frames = int(read_duration_sec * 30000)
+            add('get_traces_full', {**params, 'num_frames': num_frames}, bench_get_traces(url, work_dir, num_frames=num_frames, channel_subset=False))
+            add('get_traces_channel_subset', {**params, 'num_frames': num_frames}, bench_get_traces(url, work_dir, num_frames=num_frames, channel_subset=True))
+            if v['compression'] is not None:
+                # parallel decompression of the raw chunks
+                num_decode_threads = os.cpu_count() or 1
+                add('get_traces_full_parallel_decode', {**params, 'num_frames': num_frames, 'num_decode_threads': num_decode_threads}, bench_get_traces(url, work_dir, num_frames=num_frames, channel_subset=False, num_decode_threads=num_decode_threads))
+            add('make_binary_recording', params, bench_make_binary_recording(url, work_dir))
+            num_workers = os.cpu_count() or 1
+            add('make_binary_recording_parallel', {**params, 'num_workers': num_workers}, bench_make_binary_recording(url, work_dir, num_workers=num_workers))
+
+    nwb_fname = os.path.join(data_dir, _variant_name(variants[0]) + '.nwb')
+    for num_units in [10, 100, 1000]:
+        for num_spikes_per_unit in [100, 10000]:
+            add('create_sorting_out_nwb_file', {'num_units': num_units, 'num_spikes_per_unit': num_spikes_per_unit}, bench_create_sorting_out_nwb_file(nwb_fname, work_dir, num_units=num_units, num_spikes_per_unit=num_spikes_per_unit))
+    return results
+
+def compare_results(results: list, baseline: list, *, threshold: float) -> list:
+    """Return the benchmarks that are slower than the baseline by more than the threshold (fraction)"""
+    def key(r):
+        return r['benchmark'] + ':' + json.dumps(r['params'], sort_keys=True)
+    baseline_by_key = {key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = baseline_by_key.get(key(r), None)
+        if b is None:
+            continue
+        if r['elapsed_sec'] > b['elapsed_sec'] * (1 + threshold):
+            regressions.append({'benchmark': r['benchmark'], 'params': r['params'], 'elapsed_sec': r['elapsed_sec'], 'baseline_elapsed_sec': b['elapsed_sec']})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the NWB read and write hot paths')
+    parser.add_argument('--output', default='bench_nwb_io_results.json', help='Output JSON file')
+    parser.add_argument('--channels', default='32,128,384,1024', help='Comma-separated channel counts')
+    parser.add_argument('--duration-sec', type=float, default=10, help='Duration of the synthetic recordings')
+    parser.add_argument('--read-duration-sec', type=float, default=5, help='Duration read in the get_traces benchmarks')
+    parser.add_argument('--work-dir', default=None, help='Working directory (defaults to a temporary directory)')
+    parser.add_argument('--compare', default=None, help='Baseline results JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed slowdown relative to the baseline (fraction)')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='neurobass_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = run_benchmarks(
+            work_dir=work_dir,
+            channel_counts=[int(x) for x in args.channels.split(',')],
+            duration_sec=args.duration_sec,
+            read_duration_sec=args.read_duration_sec
+        )
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+    out = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'h5py': h5py.__version__,
+            'spikeinterface': si.__version__,
+            'timestamp': time.time()
+        },
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(out, f, indent=2)
+    print(f'Wrote {args.output}')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare_results(results, baseline, threshold=args.threshold)
+        for r in regressions:
+            print(f'REGRESSION: {r["benchmark"]} {json.dumps(r["params"])}: {r["elapsed_sec"]:.3f} sec (baseline {r["baseline_elapsed_sec"]:.3f} sec)')
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from neurobass.crypto_keys import _verify_signature
+
+
+class FakeNeurobassApi:
+    """In-memory stand-in for the /api/neurobass endpoint, covering the requests made by handle_job
+
+    Signatures are verified exactly as the real API does, and every request is
+    recorded (with a timestamp) in self.events so that per-phase latencies can
+    be computed.
+    """
+    def __init__(self, *, compute_resource_id: str, port: int = 0):
+        self.compute_resource_id = compute_resource_id
+        self.jobs = {}
+        self.files = {}
+        self.events = []
+        self.num_invalid_signatures = 0
+        self._lock = threading.Lock()
+        api = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def log_message(self, format, *args):
+                pass
+            def do_POST(self):
+                if self.path != '/api/neurobass':
+                    self._respond(404, {'error': 'Not found'})
+                    return
+                body = self.rfile.read(int(self.headers.get('Content-Length', '0')))
+                rr = json.loads(body)
+                status, resp = api._handle(rr)
+                self._respond(status, resp)
+            def _respond(self, status: int, resp: dict):
+                data = json.dumps(resp).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+    def add_job(self, job: dict):
+        with self._lock:
+            self.jobs[job['jobId']] = dict(job)
+    def add_file(self, *, project_id: str, file_name: str, content: str):
+        with self._lock:
+            self.files[(project_id, file_name)] = {'projectId': project_id, 'fileName': file_name, 'content': content}
+    def __enter__(self):
+        self._thread.start()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handle(self, rr: dict):
+        payload = rr['payload']
+        if rr.get('fromClientId') != self.compute_resource_id or not _verify_signature(payload, rr['fromClientId'], rr['signature']):
+            with self._lock:
+                self.num_invalid_signatures += 1
+            return 401, {'error': 'Invalid signature'}
+        t = time.time()
+        with self._lock:
+            self.events.append({'timestamp': t, 'payload': payload})
+            return 200, self._handle_payload(payload)
+    def _handle_payload(self, req: dict) -> dict:
+        if req['type'] == 'getJob':
+            return {'type': 'getJob', 'job': self.jobs[req['jobId']]}
+        elif req['type'] == 'getFile':
+            return {'type': 'getFile', 'file': self.files[(req['projectId'], req['fileName'])]}
+        elif req['type'] == 'setFile':
+            self.files[(req['projectId'], req['fileName'])] = {'projectId': req['projectId'], 'fileName': req['fileName'], 'content': req['content']}
+            return {'type': 'setFile', 'success': True}
+        elif req['type'] == 'setJobProperty':
+            job = self.jobs.get(req['jobId'], None)
+            if job is None:
+                return {'type': 'setJobProperty', 'success': False, 'error': 'Job not found.'}
+            if req['property'] == 'status':
+                # same transitions as the real API
+                expected_previous = {'running': 'pending', 'completed': 'running', 'failed': 'running'}[req['value']]
+                if job['status'] != expected_previous:
+                    return {'type': 'setJobProperty', 'success': False, 'error': 'Failed to set job property.'}
+            job[req['property']] = req['value']
+            return {'type': 'setJobProperty', 'success': True}
+        else:
+            raise ValueError(f'Unexpected request type: {req["type"]}')
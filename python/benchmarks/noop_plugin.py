@@ -0,0 +1,54 @@
+import os
+from typing import List
+from pydantic import BaseModel, Field
+from neurobass import NeurobassPluginContext, NeurobassPlugin
+from neurobass.NeurobassPluginTypes import NeurobassProcessingTool, NeurobassProcessingToolContext, InputFile, OutputFile
+
+
+# A processing tool that does no work, used to measure the orchestration
+# overhead of the job pipeline. Register it on the node with
+# NEUROBASS_PLUGIN_PACKAGES=noop_plugin (with this directory on PYTHONPATH).
+
+class NoopModel(BaseModel):
+    """Does nothing except write an output file of the requested size"""
+    input: InputFile = Field(..., description="Input file (not read)")
+    output: OutputFile = Field(..., description="Output file")
+    output_size_bytes: int = Field(1000, description="Size of the output file")
+    stream_output: bool = Field(False, description="Stream the output to the bucket as it is written instead of writing a local file and uploading it")
+
+class NoopProcessingTool(NeurobassProcessingTool):
+    @classmethod
+    def get_name(cls) -> str:
+        return "noop"
+    @classmethod
+    def get_attributes(cls) -> dict:
+        return {
+            'wip': True,
+            'label': 'No-op (benchmarking)'
+        }
+    @classmethod
+    def get_tags(cls) -> List[str]:
+        return ['benchmark']
+    @classmethod
+    def get_model(cls) -> BaseModel:
+        return NoopModel
+    @classmethod
+    def run(cls, context: NeurobassProcessingToolContext):
+        data = context.get_validated_data(NoopModel)
+        # name the output after the job directory so that uploads can be attributed to jobs
+        output_name = f'{os.path.basename(os.getcwd())}.dat'
+        if data.stream_output:
+            with context.open_output_file(data.output, output_name) as f:
+                f.write(os.urandom(data.output_size_bytes))
+            return
+        if not os.path.exists('output'):
+            os.mkdir('output')
+        output_fname = f'output/{output_name}'
+        with open(output_fname, 'wb') as f:
+            f.write(os.urandom(data.output_size_bytes))
+        context.upload_output_file(data.output, output_fname)
+
+class NoopPlugin(NeurobassPlugin):
+    @classmethod
+    def initialize(cls, context: NeurobassPluginContext):
+        context.register_processing_tool(NoopProcessingTool)
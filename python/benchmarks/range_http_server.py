@@ -0,0 +1,79 @@
+import os
+import re
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+
+class RangeHTTPRequestHandler(SimpleHTTPRequestHandler):
+    """Static file handler with support for single byte-range requests, to mimic remote object storage"""
+    def log_message(self, format, *args):
+        pass
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) or not os.path.exists(path):
+            return super().send_head()
+        file_size = os.path.getsize(path)
+        range_header = self.headers.get('Range', None)
+        m = re.match(r'bytes=(\d*)-(\d*)$', range_header or '')
+        f = open(path, 'rb')
+        if m is None:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(file_size))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            self._range = (0, file_size)
+            return f
+        if m.group(1):
+            start = int(m.group(1))
+            end = int(m.group(2)) + 1 if m.group(2) else file_size
+        else:
+            # suffix range, e.g., bytes=-500
+            start = max(file_size - int(m.group(2)), 0)
+            end = file_size
+        end = min(end, file_size)
+        if start >= end:
+            f.close()
+            self.send_error(416, 'Requested Range Not Satisfiable')
+            return None
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Range', f'bytes {start}-{end - 1}/{file_size}')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        f.seek(start)
+        self._range = (start, end)
+        return f
+    def copyfile(self, source, outputfile):
+        start, end = self._range
+        remaining = end - start
+        while remaining > 0:
+            buf = source.read(min(remaining, 1024 * 1024))
+            if not buf:
+                break
+            outputfile.write(buf)
+            remaining -= len(buf)
+
+class RangeHTTPServer:
+    def __init__(self, directory: str, port: int = 0):
+        """Serve a directory over HTTP (with range support) in a background thread
+
+        Args:
+            directory (str): the directory to serve
+            port (int): the port (0 means pick a free port)
+        """
+        def handler(*args, **kwargs):
+            return RangeHTTPRequestHandler(*args, directory=directory, **kwargs)
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+    def __enter__(self):
+        self._thread.start()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
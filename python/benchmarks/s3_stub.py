@@ -0,0 +1,111 @@
+import time
+import threading
+from uuid import uuid4
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class S3Stub:
+    """Minimal local S3-compatible endpoint for boto3 uploads (PutObject and multipart uploads)
+
+    Objects are kept in memory only as sizes. Every completed upload is
+    recorded in self.uploads with its start and end timestamps.
+    """
+    def __init__(self, port: int = 0):
+        self.objects = {}
+        self.uploads = []
+        self._multipart = {}
+        self._lock = threading.Lock()
+        stub = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def log_message(self, format, *args):
+                pass
+            def do_PUT(self):
+                t0 = time.time()
+                u = urlparse(self.path)
+                q = parse_qs(u.query)
+                size = len(self._read_body())
+                if 'uploadId' in q:
+                    with stub._lock:
+                        stub._multipart[q['uploadId'][0]]['parts'][int(q['partNumber'][0])] = size
+                else:
+                    stub._add_upload(u.path, size, t0)
+                self._respond(200, b'', {'ETag': '"' + uuid4().hex + '"'})
+            def do_POST(self):
+                t0 = time.time()
+                u = urlparse(self.path)
+                q = parse_qs(u.query, keep_blank_values=True)
+                self._read_body()
+                if 'uploads' in q:
+                    upload_id = uuid4().hex
+                    with stub._lock:
+                        stub._multipart[upload_id] = {'parts': {}, 'timestamp_start': t0}
+                    bucket, key = u.path.lstrip('/').split('/', 1)
+                    xml = f'<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>'
+                    self._respond(200, xml.encode('utf-8'), {'Content-Type': 'application/xml'})
+                elif 'uploadId' in q:
+                    with stub._lock:
+                        mp = stub._multipart.pop(q['uploadId'][0])
+                    stub._add_upload(u.path, sum(mp['parts'].values()), mp['timestamp_start'])
+                    bucket, key = u.path.lstrip('/').split('/', 1)
+                    xml = f'<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key><ETag>"{uuid4().hex}"</ETag></CompleteMultipartUploadResult>'
+                    self._respond(200, xml.encode('utf-8'), {'Content-Type': 'application/xml'})
+                else:
+                    self._respond(400, b'', {})
+            def _read_body(self) -> bytes:
+                if self.headers.get('Transfer-Encoding', '') == 'chunked':
+                    body = _read_chunked(self.rfile)
+                else:
+                    body = self.rfile.read(int(self.headers.get('Content-Length', '0')))
+                if 'aws-chunked' in self.headers.get('Content-Encoding', ''):
+                    # newer botocore versions send the payload in aws-chunked encoding with trailing checksums
+                    body = _decode_aws_chunked(body)
+                return body
+            def _respond(self, status: int, data: bytes, headers: dict):
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+    @property
+    def endpoint_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+    def _add_upload(self, path: str, size: int, timestamp_start: float):
+        with self._lock:
+            self.objects[path] = size
+            self.uploads.append({'path': path, 'size': size, 'timestamp_start': timestamp_start, 'timestamp_end': time.time()})
+    def __enter__(self):
+        self._thread.start()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
+
+def _read_chunked(rfile) -> bytes:
+    ret = b''
+    while True:
+        size = int(rfile.readline().strip().split(b';')[0], 16)
+        if size == 0:
+            # skip trailers
+            while rfile.readline().strip():
+                pass
+            return ret
+        ret += rfile.read(size)
+        rfile.readline()
+
+def _decode_aws_chunked(body: bytes) -> bytes:
+    ret = b''
+    i = 0
+    while i < len(body):
+        j = body.index(b'\r\n', i)
+        size = int(body[i:j].split(b';')[0], 16)
+        if size == 0:
+            break
+        ret += body[j + 2:j + 2 + size]
+        i = j + 2 + size + 2
+    return ret
@@ -0,0 +1,73 @@
+from typing import Union
+import numpy as np
+import h5py
+
+
+def create_synthetic_nwb_file(
+    fname: str,
+    *,
+    num_channels: int,
+    duration_sec: float,
+    sampling_frequency: float = 30000,
+    chunked: bool = True,
+    compression: Union[str, None] = None,
+    chunk_num_frames: int = 30000,
+    seed: int = 0
+):
+    """Write a minimal NWB file containing a single int16 ElectricalSeries
+
+    Only the groups and datasets read by NwbRecording and NwbFileMetadata are
+    written (this is not a fully valid NWB file), so pynwb is not needed.
+
+    Args:
+        fname (str): output file path
+        num_channels (int): number of channels
+        duration_sec (float): duration of the recording
+        sampling_frequency (float): sampling frequency in Hz
+        chunked (bool): whether to use a chunked (vs contiguous) layout for the traces
+        compression (str): h5py compression filter for the traces, e.g., 'gzip' (requires chunked=True)
+        chunk_num_frames (int): number of frames per chunk when chunked
+        seed (int): random seed
+    """
+    if compression is not None and not chunked:
+        raise ValueError('Compression requires a chunked layout')
+    num_frames = int(duration_sec * sampling_frequency)
+    rng = np.random.default_rng(seed)
+    with h5py.File(fname, 'w') as f:
+        f.attrs['namespace'] = 'core'
+        f.attrs['neurodata_type'] = 'NWBFile'
+        f.create_dataset('session_description', data='synthetic recording')
+        f.create_dataset('session_start_time', data='2023-01-01T00:00:00+00:00')
+        f.create_dataset('identifier', data='synthetic')
+        general = f.create_group('general')
+        general.create_dataset('experimenter', data=['synthetic'])
+        general.create_dataset('lab', data='synthetic')
+        general.create_dataset('institution', data='synthetic')
+        subject = general.create_group('subject')
+        subject.create_dataset('subject_id', data='synthetic')
+        subject.create_dataset('species', data='Mus musculus')
+        subject.create_dataset('sex', data='U')
+        subject.create_dataset('age', data='P90D')
+
+        electrodes = general.create_group('extracellular_ephys').create_group('electrodes')
+        electrodes.create_dataset('id', data=np.arange(num_channels))
+        electrodes.create_dataset('x', data=np.zeros(num_channels, dtype=float))
+        electrodes.create_dataset('y', data=np.arange(num_channels, dtype=float) * 20)
+
+        es = f.create_group('acquisition').create_group('ElectricalSeries')
+        es.create_dataset('electrodes', data=np.arange(num_channels))
+        st = es.create_dataset('starting_time', data=0.0)
+        st.attrs['rate'] = sampling_frequency
+        ds = es.create_dataset(
+            'data',
+            shape=(num_frames, num_channels),
+            dtype=np.int16,
+            chunks=(min(chunk_num_frames, num_frames), num_channels) if chunked else None,
+            compression=compression
+        )
+        # write in blocks to limit memory usage
+        block_num_frames = 30000 * 10
+        for i in range(0, num_frames, block_num_frames):
+            n = min(block_num_frames, num_frames - i)
+            # low-amplitude noise compresses somewhat, like real data
+            ds[i:i + n, :] = rng.normal(0, 20, size=(n, num_channels)).astype(np.int16)
@@ -0,0 +1,186 @@
+from typing import Union
+import os
+import json
+import time
+import fcntl
+import hashlib
+import requests
+from pydantic import BaseModel
+from .NeurobassPluginTypes import NeurobassProcessingTool, InputFile, OutputFile
+from .input_paths import resolve_local_path
+
+
+class JobCache:
+    """Cache of job results on a compute resource node, so that an identical job does not need to run again
+
+    A job is identified by the tool name, the versions of the tool, of its
+    container images and of the packages it declares in its
+    'cache_dependencies' attribute, the normalized parameters (with defaults
+    filled in) and the identity of the input files (URL plus ETag or
+    Last-Modified, or size and modification time for local files). Only tools with the 'cacheable' attribute are cached. On a
+    hit, the output URLs and sizes of the previous job are reused.
+    """
+    def __init__(self, dir: str):
+        """
+        Args:
+            dir (str): the directory of the cache (job_cache/ in the compute resource directory)
+        """
+        self._dir = dir
+        if not os.path.exists(dir):
+            os.makedirs(dir, exist_ok=True)
+    def compute_key(self, *, tool: NeurobassProcessingTool, data: BaseModel) -> Union[str, None]:
+        """Compute the cache key of a job
+
+        Args:
+            tool (NeurobassProcessingTool): the processing tool
+            data (BaseModel): the input/output data of the job (from get_validated_data())
+
+        Returns:
+            Union[str, None]: the key, or None if the job cannot be cached
+        """
+        attributes = tool.get_attributes()
+        if not attributes.get('cacheable', False):
+            return None
+        if not getattr(data, 'use_job_cache', True):
+            return None
+        d = tool.get_descriptor().dump(data)
+        parameters = {}
+        inputs = {}
+        for k in sorted(d.keys()):
+            v = getattr(data, k)
+            if k == 'use_job_cache' or isinstance(v, OutputFile):
+                # the location of the outputs does not affect their content
+                continue
+            if isinstance(v, InputFile):
+                identity = _get_input_file_identity(v)
+                if identity is None:
+                    return None
+                inputs[k] = identity
+            else:
+                parameters[k] = d[k]
+        key_data = {
+            'tool_name': tool.get_name(),
+            'tool_version': attributes.get('version', None),
+            'container_images': attributes.get('container_images', []),
+            'package_versions': {
+                p: _get_package_version(p)
+                for p in ['neurobass'] + attributes.get('cache_dependencies', [])
+            },
+            'parameters': parameters,
+            'inputs': inputs
+        }
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    def lookup(self, key: str) -> Union[dict, None]:
+        """Look up the outputs of a previous job
+
+        Returns:
+            Union[dict, None]: the outputs ({name: {url, size}}), or None on a miss
+        """
+        fname = self._entry_fname(key)
+        if not os.path.exists(fname):
+            return None
+        with open(fname, 'r') as f:
+            entry = json.load(f)
+        # the outputs may have been removed from the bucket since
+        for x in entry['outputs'].values():
+            try:
+                resp = requests.head(x['url'], timeout=10, allow_redirects=True)
+                ok = resp.status_code == 200
+            except Exception:
+                ok = False
+            if not ok:
+                os.remove(fname)
+                return None
+        return entry
+    def store(self, key: str, *, tool_name: str, outputs: dict, elapsed_sec: float):
+        """Store the outputs of a completed job
+
+        Args:
+            key (str): the cache key
+            tool_name (str): the name of the tool
+            outputs (dict): the outputs ({name: {url, size}})
+            elapsed_sec (float): the time taken by the job (reported as time saved on hits)
+        """
+        entry = {
+            'key': key,
+            'tool_name': tool_name,
+            'outputs': outputs,
+            'elapsed_sec': elapsed_sec,
+            'timestamp': time.time()
+        }
+        fname = self._entry_fname(key)
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(entry, f, indent=2)
+        os.rename(fname + '.tmp', fname)
+    def record(self, event: str, *, tool_name: str, time_saved_sec: float=0):
+        """Update the cache statistics (stats.json)
+
+        Args:
+            event (str): 'hit', 'miss' or 'uncacheable'
+            tool_name (str): the name of the tool
+            time_saved_sec (float): for hits, the time taken by the original job
+        """
+        stats_fname = os.path.join(self._dir, 'stats.json')
+        with open(stats_fname + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            stats = self.get_stats()
+            for s in [stats['total'], stats['tools'].setdefault(tool_name, {})]:
+                s[event] = s.get(event, 0) + 1
+                s['time_saved_sec'] = s.get('time_saved_sec', 0) + time_saved_sec
+            with open(stats_fname + '.tmp', 'w') as f:
+                json.dump(stats, f, indent=2)
+            os.rename(stats_fname + '.tmp', stats_fname)
+    def get_stats(self) -> dict:
+        """Get the cache statistics
+
+        Returns:
+            dict: {total: {hit, miss, uncacheable, time_saved_sec}, tools: {name: {...}}}
+        """
+        stats_fname = os.path.join(self._dir, 'stats.json')
+        if not os.path.exists(stats_fname):
+            return {'total': {}, 'tools': {}}
+        with open(stats_fname, 'r') as f:
+            return json.load(f)
+    def _entry_fname(self, key: str):
+        return os.path.join(self._dir, f'{key}.json')
+
+def _get_input_file_identity(input_file: InputFile) -> Union[dict, None]:
+    if input_file.content_file is not None:
+        # inline content (spooled to the job directory)
+        return {'sha1': hashlib.sha1(input_file.get_buffer()).hexdigest()}
+    x = input_file.content_string
+    if not x.startswith('url:'):
+        return None
+    url = x[len('url:'):]
+    local_path = resolve_local_path(url)
+    if local_path is not None:
+        st = os.stat(local_path)
+        return {
+            'url': url,
+            'size': st.st_size,
+            'mtime': st.st_mtime
+        }
+    try:
+        resp = requests.head(url, timeout=10, allow_redirects=True)
+    except Exception:
+        return None
+    if resp.status_code != 200:
+        return None
+    etag = resp.headers.get('ETag', None)
+    last_modified = resp.headers.get('Last-Modified', None)
+    if etag is None and last_modified is None:
+        # no way to tell whether the content has changed
+        return None
+    return {
+        'url': url,
+        'etag': etag,
+        'last_modified': last_modified if etag is None else None,
+        'size': resp.headers.get('Content-Length', None)
+    }
+
+def _get_package_version(package_name: str) -> Union[str, None]:
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return version(package_name)
+    except PackageNotFoundError:
+        return None
@@ -0,0 +1,107 @@
+from typing import Union
+import os
+import json
+import time
+import fcntl
+import shutil
+
+
+class JobCheckpoints:
+    """Stage-level checkpoints of a job, so that a retried job resumes from the last completed stage
+
+    Each stage has a directory (<dir>/<stage>/) where the tool writes the
+    files of the stage (e.g., the staged binary recording or the sorting),
+    and is recorded in <dir>/manifest.json once it is complete. The manifest
+    also holds a fingerprint of the job (inputs, parameters); checkpoints of
+    a job with a different fingerprint are discarded. The directory is
+    locked while it is used, so that two jobs never share it: the
+    constructor raises BlockingIOError if it is locked.
+
+    Example:
+        checkpoints = context.get_checkpoints()
+        if not checkpoints.is_complete('sorting'):
+            ... write the sorting to checkpoints.get_stage_dir('sorting')
+            checkpoints.complete('sorting')
+        ... load the sorting from checkpoints.get_stage_dir('sorting')
+    """
+    def __init__(self, dir: str, *, fingerprint: str):
+        """
+        Args:
+            dir (str): the directory of the checkpoints
+            fingerprint (str): identifies the job; checkpoints with a different fingerprint are discarded
+        """
+        self._dir = dir
+        self._fingerprint = fingerprint
+        self._manifest_fname = os.path.join(dir, 'manifest.json')
+        os.makedirs(os.path.dirname(os.path.abspath(dir)), exist_ok=True)
+        self._lock_file = open(os.path.abspath(dir) + '.lock', 'w')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except:
+            self._lock_file.close()
+            raise
+        manifest = None
+        if os.path.exists(self._manifest_fname):
+            with open(self._manifest_fname, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('fingerprint', None) != fingerprint:
+                print('Discarding the checkpoints of a different job')
+                shutil.rmtree(dir)
+                manifest = None
+        if manifest is None:
+            os.makedirs(dir, exist_ok=True)
+            manifest = {'fingerprint': fingerprint, 'stages': {}}
+            self._write_manifest(manifest)
+        self._manifest = manifest
+        self._resumed_stages = []
+    def is_complete(self, stage: str) -> bool:
+        """Whether a stage was completed (by this or by a previous attempt of the job)"""
+        if stage in self._manifest['stages']:
+            if stage not in self._resumed_stages:
+                print(f'Resuming from checkpoint: {stage}')
+                self._resumed_stages.append(stage)
+            return True
+        return False
+    def get_stage_dir(self, stage: str) -> str:
+        """Get the directory of a stage
+
+        If the stage is not complete, the directory is emptied (it may hold
+        the partial files of an attempt that was interrupted).
+        """
+        path = os.path.join(self._dir, stage)
+        if stage not in self._manifest['stages'] and os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        return path
+    def get_info(self, stage: str) -> Union[dict, None]:
+        """Get the info recorded with a completed stage, or None if it is not complete"""
+        x = self._manifest['stages'].get(stage, None)
+        return x['info'] if x is not None else None
+    def complete(self, stage: str, info: Union[dict, None]=None):
+        """Record a stage as complete
+
+        Args:
+            stage (str): the stage
+            info (dict, optional): JSON-serializable info needed to resume from the stage
+        """
+        self._manifest['stages'][stage] = {
+            'completed_at': time.time(),
+            'info': info if info is not None else {}
+        }
+        self._write_manifest(self._manifest)
+    @property
+    def resumed_stages(self) -> list:
+        return list(self._resumed_stages)
+    def discard(self):
+        """Delete the checkpoints (once the job is complete) and release the lock"""
+        shutil.rmtree(self._dir, ignore_errors=True)
+        os.remove(self._lock_file.name)
+        self._lock_file.close()
+    def _write_manifest(self, manifest: dict):
+        # write and rename, so that the manifest is never partially written
+        tmp_fname = self._manifest_fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fname, self._manifest_fname)
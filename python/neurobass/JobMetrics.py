@@ -0,0 +1,107 @@
+import time
+import json
+import resource
+import threading
+from contextlib import contextmanager
+from typing import Dict, Union
+
+
+class JobMetrics:
+    """Structured timing and counter metrics for a job
+
+    Spans accumulate wall-clock time per named phase (e.g., download, sort,
+    write_nwb, upload), counters accumulate arbitrary quantities (e.g.,
+    input_bytes_read). Peak RSS and CPU time of the job process (and its
+    children) are collected automatically, as is an estimate of GPU time when
+    pynvml is available.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans: Dict[str, dict] = {}
+        self._counters: Dict[str, float] = {}
+        self._timestamp_start: Union[float, None] = None
+        self._timestamp_end: Union[float, None] = None
+        self._gpu_sampler: Union[_GpuSampler, None] = None
+    def start(self):
+        self._timestamp_start = time.time()
+        self._gpu_sampler = _GpuSampler.create()
+        if self._gpu_sampler is not None:
+            self._gpu_sampler.start()
+    def stop(self):
+        self._timestamp_end = time.time()
+        if self._gpu_sampler is not None:
+            self._gpu_sampler.stop()
+    @contextmanager
+    def span(self, name: str):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - t0
+            with self._lock:
+                s = self._spans.setdefault(name, {'count': 0, 'total_sec': 0})
+                s['count'] += 1
+                s['total_sec'] += elapsed
+    def counter(self, name: str, amount: float=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+    def to_dict(self) -> dict:
+        ru_self = resource.getrusage(resource.RUSAGE_SELF)
+        ru_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        timestamp_end = self._timestamp_end if self._timestamp_end is not None else time.time()
+        ret = {
+            'elapsed_sec': timestamp_end - self._timestamp_start if self._timestamp_start is not None else None,
+            'spans': {k: dict(v) for k, v in self._spans.items()},
+            'counters': dict(self._counters),
+            'resources': {
+                # ru_maxrss is in kilobytes on linux
+                'peak_rss_bytes': ru_self.ru_maxrss * 1024,
+                'peak_rss_children_bytes': ru_children.ru_maxrss * 1024,
+                'cpu_user_sec': ru_self.ru_utime + ru_children.ru_utime,
+                'cpu_system_sec': ru_self.ru_stime + ru_children.ru_stime
+            }
+        }
+        if self._gpu_sampler is not None:
+            ret['resources']['gpu_time_sec'] = self._gpu_sampler.gpu_time_sec
+            ret['resources']['gpu_peak_memory_bytes'] = self._gpu_sampler.peak_memory_bytes
+        return ret
+    def write(self, fname: str):
+        with open(fname, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+class _GpuSampler:
+    # Samples the utilization of all visible GPUs once per second. The GPU
+    # time is the integral of utilization, so it is only an estimate, and it
+    # includes other processes sharing the same GPUs.
+    @staticmethod
+    def create() -> Union['_GpuSampler', None]:
+        try:
+            import pynvml
+            pynvml.nvmlInit()
+            num_devices = pynvml.nvmlDeviceGetCount()
+        except Exception:
+            return None
+        if num_devices == 0:
+            return None
+        return _GpuSampler([pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(num_devices)])
+    def __init__(self, handles: list):
+        self._handles = handles
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.gpu_time_sec = 0
+        self.peak_memory_bytes = 0
+    def start(self):
+        self._thread.start()
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+    def _run(self):
+        import pynvml
+        interval = 1
+        while not self._stopped.wait(interval):
+            try:
+                for h in self._handles:
+                    self.gpu_time_sec += pynvml.nvmlDeviceGetUtilizationRates(h).gpu / 100 * interval
+                    self.peak_memory_bytes = max(self.peak_memory_bytes, pynvml.nvmlDeviceGetMemoryInfo(h).used)
+            except Exception:
+                return
@@ -0,0 +1,171 @@
+from typing import Awaitable, Callable, Union
+import time
+import asyncio
+
+
+class TransientRequestError(Exception):
+    """A request to the neurobass API that failed but may succeed if retried (timeout, connection error, 5xx or 429)"""
+    pass
+
+async def call_with_retries(fn: Callable[[], Awaitable], *, description: str, max_duration_sec: float=3600, max_interval_sec: float=60):
+    """Await fn(), retrying with exponential backoff while it raises TransientRequestError
+
+    Args:
+        fn (Callable[[], Awaitable]): the coroutine function to call (no arguments)
+        description (str): for the log messages
+        max_duration_sec (float): give up (and raise the last error) after this long
+        max_interval_sec (float): maximum interval between attempts
+
+    Returns:
+        the return value of fn
+    """
+    start = time.time()
+    interval = 1
+    while True:
+        try:
+            return await fn()
+        except TransientRequestError as e:
+            if time.time() - start + interval > max_duration_sec:
+                raise
+            print(f'Warning: {description} failed, retrying in {interval} sec: {str(e)}')
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, max_interval_sec)
+
+class JobTelemetry:
+    """Reports the console output of a running job and checks its status, from tasks of the event loop
+
+    The job itself never waits on the neurobass API: the handler only hands
+    over the latest console output (set_console_output), and waits on
+    cancelled. Requests that fail transiently are retried with exponential
+    backoff, and in the meantime only the latest console output is kept
+    (older snapshots are superseded), so a long outage costs neither memory
+    nor a backlog of requests - the latest state is sent once the API is
+    reachable again. The job is only considered cancelled if the API
+    actually reports that it is no longer running (or no longer exists).
+    """
+    def __init__(self, *,
+        get_job_status: Callable[[], Awaitable[str]],
+        set_console_output: Callable[[str], Awaitable[None]],
+        console_output_interval_sec: float=10,
+        status_check_interval_sec: float=60,
+        max_retry_interval_sec: float=120
+    ):
+        """
+        Args:
+            get_job_status (Callable[[], Awaitable[str]]): returns the status of the job (raises TransientRequestError on transient failures)
+            set_console_output (Callable[[str], Awaitable[None]]): reports the console output of the job
+            console_output_interval_sec (float): minimum interval between console output reports
+            status_check_interval_sec (float): interval between status checks
+            max_retry_interval_sec (float): maximum backoff after failures
+        """
+        self._get_job_status = get_job_status
+        self._set_console_output = set_console_output
+        self._console_output_interval_sec = console_output_interval_sec
+        self._status_check_interval_sec = status_check_interval_sec
+        self._max_retry_interval_sec = max_retry_interval_sec
+        self._console_output: Union[str, None] = None  # latest snapshot not yet reported
+        self._cancel_reason: Union[str, None] = None
+        self._cancelled = asyncio.Event()
+        self._tasks = []
+        self._stats = {'requests': 0, 'failed_requests': 0, 'superseded_console_outputs': 0, 'max_offline_sec': 0}
+        self._offline_since: Union[float, None] = None
+    def start(self):
+        """Start the console output and status check tasks (in the running event loop)"""
+        self._tasks = [
+            asyncio.create_task(self._console_output_loop()),
+            asyncio.create_task(self._status_check_loop())
+        ]
+    async def stop(self, *, flush_timeout_sec: float=60):
+        """Stop the tasks, trying to report the pending console output for up to flush_timeout_sec"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        console_output = self._console_output
+        self._console_output = None
+        if console_output is not None:
+            try:
+                await call_with_retries(
+                    lambda: self._set_console_output(console_output),
+                    description='reporting console output',
+                    max_duration_sec=flush_timeout_sec
+                )
+            except Exception as e:
+                print(f'Warning: unable to report the final console output: {str(e)}')
+    def set_console_output(self, console_output: str):
+        """Hand over the latest console output (replacing any snapshot not yet reported)"""
+        if self._console_output is not None:
+            self._stats['superseded_console_outputs'] += 1
+        self._console_output = console_output
+    async def cancelled(self):
+        """Wait until the job should stop (see cancel_reason)"""
+        await self._cancelled.wait()
+    @property
+    def cancel_reason(self) -> Union[str, None]:
+        """Why the job should stop (e.g., it was deleted or its status was changed), or None"""
+        return self._cancel_reason
+    def get_stats(self) -> dict:
+        return dict(self._stats)
+    def _cancel(self, reason: str):
+        self._cancel_reason = reason
+        self._cancelled.set()
+    async def _console_output_loop(self):
+        backoff = self._console_output_interval_sec
+        while True:
+            await asyncio.sleep(backoff)
+            console_output = self._console_output
+            self._console_output = None
+            if console_output is None:
+                backoff = self._console_output_interval_sec
+                continue
+            try:
+                ok = await self._attempt(lambda: self._set_console_output(console_output), 'reporting console output')
+            except Exception as e:
+                # rejected by the API - not worth retrying, and not a reason to stop the job
+                print(f'Warning: unable to report console output: {str(e)}')
+                ok = True
+            if ok:
+                backoff = self._console_output_interval_sec
+            else:
+                # keep it, unless a newer snapshot arrived in the meantime
+                if self._console_output is None:
+                    self._console_output = console_output
+                backoff = min(backoff * 2, self._max_retry_interval_sec)
+    async def _status_check_loop(self):
+        backoff = self._status_check_interval_sec
+        while True:
+            await asyncio.sleep(backoff)
+            status = None
+            async def check():
+                nonlocal status
+                status = await self._get_job_status()
+            try:
+                ok = await self._attempt(check, 'checking job status')
+            except Exception as e:
+                # the API answered, but the job is gone
+                self._cancel(f'Unable to get job: {str(e)}')
+                return
+            if ok:
+                backoff = self._status_check_interval_sec
+                if status != 'running':
+                    self._cancel(f'Unexpected job status: {status}')
+                    return
+            else:
+                backoff = min(backoff * 2, self._max_retry_interval_sec)
+    async def _attempt(self, fn: Callable[[], Awaitable], description: str) -> bool:
+        # returns False on a transient failure; other errors are raised
+        self._stats['requests'] += 1
+        try:
+            await fn()
+        except TransientRequestError as e:
+            self._stats['failed_requests'] += 1
+            if self._offline_since is None:
+                self._offline_since = time.time()
+            print(f'Warning: {description} failed (will retry): {str(e)}')
+            return False
+        if self._offline_since is not None:
+            offline_sec = time.time() - self._offline_since
+            self._stats['max_offline_sec'] = max(self._stats['max_offline_sec'], offline_sec)
+            print(f'Connection to the neurobass API restored after {offline_sec:.0f} sec')
+            self._offline_since = None
+        return True
@@ -0,0 +1,284 @@
+from typing import Any, Callable, Dict, List, Union
+import os
+import io
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+# S3 requires all the parts of a multipart upload except the last to be at
+# least 5 MiB, and allows at most 10000 parts
+_min_part_size = 5 * 1024 * 1024
+_max_num_parts = 10000
+
+class MultipartUpload:
+    """A multipart upload to an S3-compatible bucket, with the parts uploaded concurrently from a thread pool
+
+    The multipart upload is only created with the first part, so an output
+    that fits in a single part is uploaded with a single PutObject. At most
+    max_concurrency parts are in flight: upload_part blocks beyond that, which
+    bounds the memory held by the parts waiting to be uploaded.
+    """
+    def __init__(self, s3: Any, *, bucket: str, key: str, max_concurrency: int=4):
+        """
+        Args:
+            s3: the boto3 s3 client
+            bucket (str): the bucket
+            key (str): the key of the object
+            max_concurrency (int): maximum number of parts uploaded at the same time
+        """
+        self._s3 = s3
+        self._bucket = bucket
+        self._key = key
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._slots = threading.Semaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._upload_id: Union[str, None] = None
+        self._futures: Dict[int, Future] = {}
+        self._size = 0
+    @property
+    def size(self) -> int:
+        """Number of bytes submitted so far"""
+        return self._size
+    def upload_part(self, part_number: int, data: Union[bytes, memoryview]):
+        """Submit a part (part numbers start at 1, and parts may be submitted in any order)"""
+        if not (1 <= part_number <= _max_num_parts):
+            raise ValueError(f'Invalid part number: {part_number}')
+        if part_number in self._futures:
+            raise ValueError(f'Part already submitted: {part_number}')
+        self._raise_failed_part()
+        with self._lock:
+            if self._upload_id is None:
+                resp = self._s3.create_multipart_upload(Bucket=self._bucket, Key=self._key)
+                self._upload_id = resp['UploadId']
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._upload_part, part_number, data)
+        except:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        self._futures[part_number] = future
+        self._size += len(data)
+    def complete(self, last_data: Union[bytes, memoryview, None]=None, *, last_part_number: Union[int, None]=None):
+        """Wait for the parts and complete the upload
+
+        Args:
+            last_data (bytes, optional): the last part, if not already submitted; uploaded with PutObject if no other part was submitted
+            last_part_number (int, optional): the part number of last_data (default: after the highest submitted part number)
+        """
+        try:
+            if self._upload_id is None and not self._futures:
+                self._s3.put_object(Bucket=self._bucket, Key=self._key, Body=bytes(last_data) if last_data is not None else b'')
+                self._size += len(last_data) if last_data is not None else 0
+                return
+            if last_data is not None and len(last_data) > 0:
+                if last_part_number is None:
+                    last_part_number = max(self._futures.keys()) + 1
+                self.upload_part(last_part_number, last_data)
+            parts: List[dict] = []
+            for part_number in sorted(self._futures.keys()):
+                parts.append({'PartNumber': part_number, 'ETag': self._futures[part_number].result()})
+            self._s3.complete_multipart_upload(
+                Bucket=self._bucket,
+                Key=self._key,
+                UploadId=self._upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except:
+            self.abort()
+            raise
+        finally:
+            self._executor.shutdown(wait=True)
+    def abort(self):
+        """Abort the upload (the parts already uploaded are discarded)"""
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        if self._upload_id is not None:
+            try:
+                self._s3.abort_multipart_upload(Bucket=self._bucket, Key=self._key, UploadId=self._upload_id)
+            except Exception as e:
+                print(f'Warning: unable to abort the multipart upload of {self._key}: {str(e)}')
+    def _upload_part(self, part_number: int, data: Union[bytes, memoryview]) -> str:
+        resp = self._s3.upload_part(
+            Bucket=self._bucket,
+            Key=self._key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=bytes(data)
+        )
+        return resp['ETag']
+    def _raise_failed_part(self):
+        # fail early rather than when completing
+        for future in self._futures.values():
+            if future.done() and not future.cancelled() and future.exception() is not None:
+                raise future.exception()
+
+class MultipartUploadStream(io.RawIOBase):
+    """A writable (non-seekable) binary stream uploaded to an S3-compatible bucket as it is written
+
+    The content is cut into parts of part_size bytes that are uploaded
+    concurrently while the writer continues, so an output written
+    sequentially never touches the local disk. The upload is completed when
+    the stream is closed, or aborted if it is used as a context manager and
+    an exception is raised.
+    """
+    def __init__(self, s3: Any, *, bucket: str, key: str, part_size: int=16 * 1024 * 1024, max_concurrency: int=4, on_complete: Union[Callable[[int], None], None]=None):
+        """
+        Args:
+            s3: the boto3 s3 client
+            bucket (str): the bucket
+            key (str): the key of the object
+            part_size (int): size of the parts (at least 5 MiB, and at most 10000 parts per object)
+            max_concurrency (int): maximum number of parts uploaded at the same time
+            on_complete (Callable[[int], None], optional): called with the size of the object once the upload is complete
+        """
+        super().__init__()
+        self._on_complete = on_complete
+        if part_size < _min_part_size:
+            raise ValueError(f'Part size must be at least {_min_part_size} bytes: {part_size}')
+        self._upload = MultipartUpload(s3, bucket=bucket, key=key, max_concurrency=max_concurrency)
+        self._part_size = part_size
+        self._buffer = bytearray()
+        self._num_parts = 0
+        self._aborted = False
+    @property
+    def size(self) -> int:
+        """Number of bytes written so far"""
+        return self._upload.size + len(self._buffer)
+    def writable(self) -> bool:
+        return True
+    def write(self, b) -> int:
+        if self.closed:
+            raise ValueError('I/O operation on closed stream')
+        b = memoryview(b).cast('B')
+        n = len(b)
+        self._buffer += b
+        while len(self._buffer) >= self._part_size:
+            part = bytes(self._buffer[:self._part_size])
+            del self._buffer[:self._part_size]
+            self._num_parts += 1
+            self._upload.upload_part(self._num_parts, part)
+        return n
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if not self._aborted:
+                self._upload.complete(bytes(self._buffer), last_part_number=self._num_parts + 1)
+        finally:
+            self._buffer = bytearray()
+            super().close()
+        if not self._aborted and self._on_complete is not None:
+            self._on_complete(self._upload.size)
+    def abort(self):
+        """Abort the upload and close the stream"""
+        if self.closed:
+            return
+        self._aborted = True
+        self._upload.abort()
+        self.close()
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+class ProgressiveFileUpload:
+    """Uploads a local file to an S3-compatible bucket while it is being written, as its byte ranges are finished
+
+    For formats that cannot be written sequentially (e.g., HDF5), the file is
+    written locally, and the writer declares the byte ranges that will no
+    longer change with mark_finished(). The parts of the file covered by
+    finished ranges are uploaded right away, in any order, while the writer
+    continues; the rest of the file is uploaded by finish().
+
+    Example:
+        with ProgressiveFileUpload(s3, bucket=bucket, key=key, path=path) as upload:
+            ... write the file, calling upload.mark_finished(start, end) as ranges are finalized
+    """
+    def __init__(self, s3: Any, *, bucket: str, key: str, path: str, part_size: int=16 * 1024 * 1024, max_concurrency: int=4, on_complete: Union[Callable[[int], None], None]=None):
+        """
+        Args:
+            s3: the boto3 s3 client
+            bucket (str): the bucket
+            key (str): the key of the object
+            path (str): the local file
+            part_size (int): size of the parts (at least 5 MiB, and at most 10000 parts per object)
+            max_concurrency (int): maximum number of parts uploaded at the same time
+            on_complete (Callable[[int], None], optional): called with the size of the file once the upload is complete
+        """
+        self._on_complete = on_complete
+        if part_size < _min_part_size:
+            raise ValueError(f'Part size must be at least {_min_part_size} bytes: {part_size}')
+        self._upload = MultipartUpload(s3, bucket=bucket, key=key, max_concurrency=max_concurrency)
+        self._path = path
+        self._part_size = part_size
+        # finished ranges, as a sorted list of disjoint [start, end)
+        self._finished_ranges: List[List[int]] = []
+        self._uploaded_parts = set()
+        self._size: Union[int, None] = None
+    @property
+    def size(self) -> Union[int, None]:
+        """The size of the file, once finished"""
+        return self._size
+    def mark_finished(self, start: int, end: int):
+        """Declare that the bytes [start, end) of the file are written and will not change"""
+        if start >= end:
+            return
+        ranges = []
+        for r in self._finished_ranges:
+            if r[1] < start or r[0] > end:
+                ranges.append(r)
+            else:
+                # merge overlapping or adjacent ranges
+                start = min(start, r[0])
+                end = max(end, r[1])
+        ranges.append([start, end])
+        ranges.sort()
+        self._finished_ranges = ranges
+        # the parts entirely within [start, end)
+        for i in range(-(-start // self._part_size), end // self._part_size):
+            self._upload_part(i)
+    def finish(self):
+        """Upload the parts not uploaded yet and complete the upload (once the file is fully written)"""
+        size = os.path.getsize(self._path)
+        num_parts = max(1, -(-size // self._part_size))
+        if num_parts > _max_num_parts:
+            raise ValueError(f'File too large for the part size: {size} bytes')
+        if len(self._uploaded_parts) == 0 and num_parts == 1:
+            with open(self._path, 'rb') as f:
+                self._upload.complete(f.read())
+        else:
+            for i in range(num_parts - 1):
+                if i not in self._uploaded_parts:
+                    self._upload_part(i)
+            if num_parts - 1 in self._uploaded_parts:
+                self._upload.complete()
+            else:
+                self._upload.complete(self._read_part(num_parts - 1, size), last_part_number=num_parts)
+        self._size = size
+        if self._on_complete is not None:
+            self._on_complete(size)
+    def abort(self):
+        self._upload.abort()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.finish()
+    def _upload_part(self, i: int):
+        if i in self._uploaded_parts:
+            return
+        self._upload.upload_part(i + 1, self._read_part(i))
+        self._uploaded_parts.add(i)
+    def _read_part(self, i: int, size: Union[int, None]=None) -> bytes:
+        offset = i * self._part_size
+        n = self._part_size if size is None else min(self._part_size, size - offset)
+        with open(self._path, 'rb') as f:
+            data = os.pread(f.fileno(), n, offset)
+        if len(data) != n:
+            raise ValueError(f'Unexpected end of file: {self._path}')
+        return data
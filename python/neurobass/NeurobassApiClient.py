@@ -0,0 +1,135 @@
+from typing import Any, List, Union
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from .crypto_keys import _sign_message
+from .JobTelemetry import TransientRequestError
+
+
+# (connect, read) timeouts of the requests to the neurobass API
+_request_timeout = (10, 60)
+
+class NeurobassApiClient:
+    """Client for the neurobass API, authenticated as the compute resource
+
+    All requests go through a single requests.Session, so the connections to
+    the API are pooled and kept alive. The async methods run the requests in
+    a small thread pool, so that they can be awaited concurrently from the
+    event loop of the job handler (many requests in flight, no thread per
+    job).
+    """
+    def __init__(self, *, compute_resource_id: str, compute_resource_private_key: str, neurobass_url: str, max_concurrent_requests: int=8):
+        self._compute_resource_id = compute_resource_id
+        self._compute_resource_private_key = compute_resource_private_key
+        self._neurobass_url = neurobass_url
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent_requests)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_requests)
+    @staticmethod
+    def from_env() -> 'NeurobassApiClient':
+        """Create a client from COMPUTE_RESOURCE_ID, COMPUTE_RESOURCE_PRIVATE_KEY and NEUROBASS_URL"""
+        return NeurobassApiClient(
+            compute_resource_id=os.environ['COMPUTE_RESOURCE_ID'],
+            compute_resource_private_key=os.environ['COMPUTE_RESOURCE_PRIVATE_KEY'],
+            neurobass_url=os.environ.get('NEUROBASS_URL', 'https://neurobass.vercel.app')
+        )
+    def post(self, req: dict) -> Any:
+        """Post a request (blocking)
+
+        Raises:
+            TransientRequestError: on timeouts, connection errors, 5xx and 429 responses
+            ValueError: if the request is rejected
+        """
+        signature = _sign_message(req, self._compute_resource_id, self._compute_resource_private_key)
+        rr = {
+            'payload': req,
+            'fromClientId': self._compute_resource_id,
+            'signature': signature
+        }
+        try:
+            resp = self._session.post(f'{self._neurobass_url}/api/neurobass', json=rr, timeout=_request_timeout)
+        except requests.exceptions.RequestException as e:
+            # timeout, connection error, etc.
+            raise TransientRequestError(f'Error posting neurobass request: {str(e)}')
+        if resp.status_code != 200:
+            msg = resp.text
+            if resp.status_code >= 500 or resp.status_code == 429:
+                raise TransientRequestError(f'Error posting neurobass request ({resp.status_code}): {msg}')
+            raise ValueError(f'Error posting neurobass request: {msg}')
+        return resp.json()
+    async def apost(self, req: dict) -> Any:
+        """Post a request (see post) without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.post, req)
+    async def get_job(self, *, job_id: str) -> dict:
+        req = {
+            'type': 'getJob',
+            'timestamp': time.time(),
+            'jobId': job_id
+        }
+        resp = await self.apost(req)
+        if resp['type'] != 'getJob':
+            raise ValueError(f'Unexpected response type: {resp["type"]}')
+        return resp['job']
+    async def get_jobs(self, *, status: Union[str, None]=None) -> List[dict]:
+        """Get the jobs of the compute resource (optionally, only those with the given status)"""
+        req = {
+            'type': 'getJobs',
+            'timestamp': time.time(),
+            'computeResourceId': self._compute_resource_id
+        }
+        if status is not None:
+            req['status'] = status
+        resp = await self.apost(req)
+        if resp['type'] != 'getJobs':
+            raise ValueError(f'Unexpected response type: {resp["type"]}')
+        return resp['jobs']
+    async def get_file(self, *, project_id: str, file_name: str) -> dict:
+        req = {
+            'type': 'getFile',
+            'timestamp': time.time(),
+            'projectId': project_id,
+            'fileName': file_name
+        }
+        resp = await self.apost(req)
+        if resp['type'] != 'getFile':
+            raise ValueError(f'Unexpected response type: {resp["type"]}')
+        return resp['file']
+    async def set_file(self, *, project_id: str, workspace_id: str, file_name: str, content: str, size: int, job_id: str, metadata: dict):
+        req = {
+            'type': 'setFile',
+            'timestamp': time.time(),
+            'projectId': project_id,
+            'workspaceId': workspace_id,
+            'fileName': file_name,
+            'content': content,
+            'size': size,
+            'jobId': job_id,
+            'metadata': metadata
+        }
+        resp = await self.apost(req)
+        if resp['type'] != 'setFile':
+            raise ValueError(f'Unexpected response type: {resp["type"]}')
+    async def set_job_property(self, *, workspace_id: str, project_id: str, job_id: str, property: str, value: Any):
+        req = {
+            'type': 'setJobProperty',
+            'timestamp': time.time(),
+            'workspaceId': workspace_id,
+            'projectId': project_id,
+            'jobId': job_id,
+            'property': property,
+            'value': value
+        }
+        resp = await self.apost(req)
+        if resp['type'] != 'setJobProperty':
+            raise ValueError(f'Unexpected response type: {resp["type"]}')
+        if resp['success'] != True:
+            raise ValueError(f'Error setting job {property}: {resp["error"]}')
+    def close(self):
+        self._executor.shutdown()
+        self._session.close()
@@ -1,8 +1,19 @@
+import os
+import io
+import mmap
 from enum import Enum
-from typing import Any, List
+from typing import Any, BinaryIO, List, Type, Union
+import typing
+import types
+import copy
 from abc import ABC, abstractmethod
 from pydantic import BaseModel
 import inspect
+import json
+import hashlib
+from .JobMetrics import JobMetrics
+from .JobCheckpoints import JobCheckpoints
+from .input_paths import resolve_local_path
 
 try:
     # this works in pydantic v2
@@ -14,7 +25,41 @@ except:
 class InputFile(BaseModel):
     name: str
     path: str
-    content_string: str
+    # the content of the file as stored by neurobass, e.g., url:https://...
+    content_string: str = ''
+    # the file (relative to the job directory) holding the content, for inputs
+    # whose content is inline rather than a URL - it is spooled to the job
+    # directory by the handler instead of being embedded in job.json
+    content_file: Union[str, None] = None
+
+    def open(self) -> BinaryIO:
+        """Open the content of an inline input (e.g., a parameter table) for reading
+
+        For inputs given by URL, use context.get_input_file_url() instead.
+
+        Returns:
+            BinaryIO: the content, as a binary file object
+        """
+        if self.content_file is not None:
+            return open(self.content_file, 'rb')
+        if self.content_string.startswith('data:'):
+            return io.BytesIO(self.content_string[len('data:'):].encode('utf-8'))
+        raise ValueError(f'Input file {self.name} has no inline content: {self.content_string}')
+    def get_buffer(self) -> memoryview:
+        """Get the content of an inline input as a read-only buffer, memory-mapped from the job directory (no copy)
+
+        Returns:
+            memoryview: the content, e.g., for np.frombuffer()
+        """
+        if self.content_file is None:
+            with self.open() as f:
+                return memoryview(f.read())
+        with open(self.content_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # empty files cannot be mapped
+                return memoryview(b'')
+            # the mapping remains valid after the file is closed
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
 
 class OutputFile(BaseModel):
     name: str
@@ -29,6 +74,25 @@ class NeurobassProcessingToolContext(ABC):
             Any: the data that should match the schema
         """
         pass
+    def get_validated_data(self, model: Type[BaseModel]) -> BaseModel:
+        """Get the input/output data for the job as an instance of the model of the tool
+
+        The data is validated only once per job (run_job validates it with
+        the descriptor of the tool before the tool runs), so tools should use
+        this rather than constructing the model from get_data().
+
+        Args:
+            model (Type[BaseModel]): the model of the tool
+
+        Returns:
+            BaseModel: the validated data
+        """
+        validated_data = getattr(self, '_validated_data', None)
+        if type(validated_data) is not model:
+            data = self.get_data()
+            validated_data = model.model_validate(data) if hasattr(model, 'model_validate') else model.parse_obj(data)
+            self._validated_data = validated_data
+        return validated_data
     @abstractmethod
     def get_input_file_url(self, input_file: InputFile) -> str:
         """Return the URL of the input file
@@ -40,6 +104,16 @@ class NeurobassProcessingToolContext(ABC):
             str: the URL of the input file
         """
         pass
+    def get_input_file_local_path(self, input_file: InputFile) -> Union[str, None]:
+        """Return the path of the input file on the node, if it is available locally (see INPUT_PATH_MAPPINGS in input_paths.py)
+
+        Args:
+            input_file (InputFile): the input file
+
+        Returns:
+            Union[str, None]: the local path, or None if the file must be accessed by URL
+        """
+        return resolve_local_path(self.get_input_file_url(input_file))
     @abstractmethod
     def upload_output_file(self, output_file: OutputFile, path: str):
         """Upload a file to the output cloud bucket
@@ -48,7 +122,152 @@ class NeurobassProcessingToolContext(ABC):
             path (str): path of the local file to upload
         """
         pass
+    def open_output_file(self, output_file: OutputFile, file_name: str) -> BinaryIO:
+        """Open an output file for writing, for formats that can be written sequentially
+
+        The file is uploaded to the output cloud bucket as it is written
+        (without going through the local disk, if the context supports it).
+        The upload is completed when the stream is closed, and aborted if an
+        exception is raised within the with block.
+
+        Example:
+            with context.open_output_file(data.output, 'units.json') as f:
+                f.write(...)
+
+        Args:
+            output_file (OutputFile): the output file
+            file_name (str): the name of the uploaded file
 
+        Returns:
+            BinaryIO: the writable stream
+        """
+        # by default, the content is written to a local file that is uploaded when the stream is closed
+        os.makedirs('output_streams', exist_ok=True)
+        return _LocalOutputFileStream(self, output_file, f'output_streams/{file_name}')
+    def upload_output_file_progressively(self, output_file: OutputFile, path: str):
+        """Upload a local file while it is being written, for formats that cannot be written sequentially (e.g., HDF5)
+
+        The writer declares the byte ranges of the file that will no longer
+        change with mark_finished(start, end), so that they can be uploaded
+        right away (if the context supports it); the rest of the file is
+        uploaded when the with block exits.
+
+        Example:
+            with context.upload_output_file_progressively(data.output, 'output/sorting.nwb') as upload:
+                ... write the file, calling upload.mark_finished(start, end) as ranges are finalized
+
+        Args:
+            output_file (OutputFile): the output file
+            path (str): path of the local file
+        """
+        # by default, the file is uploaded once it is written
+        return _DeferredOutputFileUpload(self, output_file, path)
+    def get_metrics(self) -> JobMetrics:
+        """Get the metrics collected for the job
+
+        Returns:
+            JobMetrics: the job metrics
+        """
+        if not hasattr(self, '_metrics'):
+            self._metrics = JobMetrics()
+        return self._metrics
+    def span(self, name: str):
+        """Time a phase of the job, e.g., with context.span('sort'): ...
+
+        Args:
+            name (str): the name of the phase
+        """
+        return self.get_metrics().span(name)
+    def counter(self, name: str, amount: float=1):
+        """Increment a counter for the job, e.g., context.counter('bytes_read', n)
+
+        Args:
+            name (str): the name of the counter
+            amount (float): the amount to add
+        """
+        self.get_metrics().counter(name, amount)
+    def get_num_jobs(self) -> int:
+        """Get the number of parallel workers to use, matching the cores allocated to the job
+
+        Returns:
+            int: the number of workers (e.g., for n_jobs or thread pool limits)
+        """
+        x = os.environ.get('NEUROBASS_JOB_NUM_CPUS', None)
+        if x:
+            return int(x)
+        if hasattr(os, 'sched_getaffinity'):
+            return len(os.sched_getaffinity(0))
+        return os.cpu_count() or 1
+    def get_checkpoints(self) -> JobCheckpoints:
+        """Get the stage-level checkpoints of the job
+
+        The checkpoints are kept in the compute resource directory
+        (checkpoints/<fingerprint>/), keyed by a fingerprint of the inputs and
+        parameters of the job, so that a job that is resubmitted after a
+        failure (e.g., the node was restarted) resumes from the stages that
+        were completed by the previous attempt. They are deleted once the job
+        is complete.
+
+        Returns:
+            JobCheckpoints: the checkpoints
+        """
+        if not hasattr(self, '_checkpoints'):
+            from importlib.metadata import version, PackageNotFoundError
+            data = {}
+            for k, v in self.get_data().items():
+                if isinstance(v, InputFile) and v.content_file is not None:
+                    # inline content is identified by its content, not by the spooled file name
+                    data[k] = hashlib.sha1(v.get_buffer()).hexdigest()
+                elif isinstance(v, BaseModel):
+                    data[k] = v.model_dump() if hasattr(v, 'model_dump') else v.dict()
+                else:
+                    data[k] = v
+            try:
+                neurobass_version = version('neurobass')
+            except PackageNotFoundError:
+                neurobass_version = None
+            x = json.dumps({'data': data, 'neurobass_version': neurobass_version}, sort_keys=True, default=str)
+            fingerprint = hashlib.sha1(x.encode()).hexdigest()
+            checkpoints_dir = os.path.abspath(os.path.join(os.environ.get('COMPUTE_RESOURCE_DIR', '../..'), 'checkpoints'))
+            try:
+                self._checkpoints = JobCheckpoints(os.path.join(checkpoints_dir, fingerprint), fingerprint=fingerprint)
+            except BlockingIOError:
+                # an identical job is running on the node - this one does not resume
+                print('The checkpoints are in use by an identical job, using the job directory instead')
+                self._checkpoints = JobCheckpoints(os.path.abspath('checkpoints'), fingerprint=fingerprint)
+        return self._checkpoints
+
+
+class _LocalOutputFileStream(io.FileIO):
+    def __init__(self, context: NeurobassProcessingToolContext, output_file: OutputFile, path: str):
+        super().__init__(path, 'wb')
+        self._context = context
+        self._output_file = output_file
+        self._path = path
+        self._aborted = False
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        if not self._aborted:
+            self._context.upload_output_file(self._output_file, self._path)
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._aborted = True
+        self.close()
+
+class _DeferredOutputFileUpload:
+    def __init__(self, context: NeurobassProcessingToolContext, output_file: OutputFile, path: str):
+        self._context = context
+        self._output_file = output_file
+        self._path = path
+    def mark_finished(self, start: int, end: int):
+        pass
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._context.upload_output_file(self._output_file, self._path)
 
 class NeurobassProcessingTool(ABC):
     @classmethod
@@ -96,72 +315,165 @@ class NeurobassProcessingTool(ABC):
     def run(cls, context: NeurobassProcessingToolContext):
         pass
 
+    @classmethod
+    def get_descriptor(cls) -> 'NeurobassProcessingToolDescriptor':
+        """Get the compiled descriptor of the processing tool (computed once per class)
+
+        Returns:
+            NeurobassProcessingToolDescriptor: the schema, field types and validator of the tool
+        """
+        # look up in the class itself, not in a base class
+        descriptor = cls.__dict__.get('_neurobass_descriptor', None)
+        if descriptor is None:
+            descriptor = NeurobassProcessingToolDescriptor(cls)
+            cls._neurobass_descriptor = descriptor
+        return descriptor
+
     @classmethod
     def get_schema(cls) -> dict:
-        ret = {
+        return copy.deepcopy(cls.get_descriptor().schema)
+
+class NeurobassProcessingToolDescriptor:
+    """The schema and validator of a processing tool, computed from its model
+
+    Use NeurobassProcessingTool.get_descriptor() rather than constructing
+    it, so that it is computed only once per tool class.
+    """
+    def __init__(self, tool: NeurobassProcessingTool):
+        model = tool.get_model()
+        self.model = model
+        schema = {
             'properties': []
         }
-        if cls.__doc__ is not None:
-            ret['description'] = cls.__doc__
-        model = cls.get_model()
-        for field_name, field_type in model.__annotations__.items():
-            ff = model.__fields__[field_name]
-            if hasattr(ff, 'field_info'):
-                # this is for pydantic v1
-                field_info = ff.field_info
-            else:
-                # this is for pydantic v2
-                field_info = ff
-            field_default = field_info.default
-            if field_default == Ellipsis or field_default == PydanticUndefined:
-                field_default = None
-        
-            kwargs = {}
-            extra = getattr(field_info, 'extra', {})
-            valid_extra_keys = ['group']
-            for k in valid_extra_keys:
-                if k in extra:
-                    kwargs[k] = extra[k]
-            if inspect.isclass(field_type) and issubclass(field_type, InputFile):
-                field_type_str = 'InputFile'
-            elif inspect.isclass(field_type) and issubclass(field_type, OutputFile):
-                field_type_str = 'OutputFile'
-            elif inspect.isclass(field_type) and issubclass(field_type, Enum):
-                field_type_str = 'Enum'
-                kwargs['choices'] = [x.value for x in field_type]
-            else:
-                if field_type == float:
-                    field_type_str = 'float'
-                elif field_type == int:
-                    field_type_str = 'int'
-                elif field_type == bool:
-                    field_type_str = 'bool'
-                elif field_type == str:
-                    field_type_str = 'str'
-                elif field_type == List[int]:
-                    # handle this case specially
-                    field_type_str = 'List[int]'
-                elif field_type == List[str]:
-                    field_type_str = 'List[str]'
-                elif field_type == List[float]:
-                    # handle this case specially
-                    field_type_str = 'List[float]'
-                else:
-                    raise Exception(f'Unexpected field type: {field_type}')
-            if type(field_info.description) != str:
-                raise Exception(f'Unexpected description type: {type(field_info.description)}')
-            
-            pp = {
-                'name': field_name,
-                'type': field_type_str,
-                'description': field_info.description,
-                **kwargs
-            }
-            if field_default is not None:
-                pp['default'] = field_default
-
-            ret['properties'].append(pp)
+        if tool.__doc__ is not None:
+            schema['description'] = tool.__doc__
+        schema['properties'] = _get_model_properties(model)
+        self.schema = schema
+        if hasattr(model, 'model_validate'):
+            # pydantic v2
+            self._validate = model.model_validate
+            self._dump = lambda x: x.model_dump()
+        else:
+            # pydantic v1
+            self._validate = model.parse_obj
+            self._dump = lambda x: x.dict()
+    def validate(self, data: dict) -> BaseModel:
+        """Validate the input/output data of a job (e.g., from context.get_data())
+
+        Returns:
+            BaseModel: an instance of the model of the tool
+        """
+        return self._validate(data)
+    def dump(self, x: BaseModel) -> dict:
+        """Serialize an instance of the model of the tool"""
+        return self._dump(x)
+
+def _get_model_properties(model) -> List[dict]:
+    fields = model.model_fields if hasattr(model, 'model_fields') else model.__fields__
+    # resolves string annotations, and includes the fields of base models
+    type_hints = typing.get_type_hints(model)
+    properties = []
+    for field_name, ff in fields.items():
+        field_type = type_hints[field_name]
+        if hasattr(ff, 'field_info'):
+            # this is for pydantic v1
+            field_info = ff.field_info
+        else:
+            # this is for pydantic v2
+            field_info = ff
+        field_default = field_info.default
+        if field_default == Ellipsis or field_default == PydanticUndefined:
+            field_default = None
+
+        kwargs = {}
+        extra = getattr(field_info, 'extra', None) or getattr(field_info, 'json_schema_extra', None) or {}
+        if not isinstance(extra, dict):
+            # pydantic v2 allows a callable
+            extra = {}
+        valid_extra_keys = ['group']
+        for k in valid_extra_keys:
+            if k in extra:
+                kwargs[k] = extra[k]
+        field_type_str = _get_field_type_string(field_type, kwargs)
+        if type(field_info.description) != str:
+            raise Exception(f'Unexpected description type: {type(field_info.description)}')
+
+        pp = {
+            'name': field_name,
+            'type': field_type_str,
+            'description': field_info.description,
+            **kwargs
+        }
+        if field_default is not None:
+            # e.g., enum members or nested models, which the schema holds as JSON
+            pp['default'] = _to_json_compatible(field_default)
+
+        properties.append(pp)
+    return properties
+
+def _to_json_compatible(x: Any) -> Any:
+    try:
+        # pydantic v2
+        from pydantic_core import to_jsonable_python
+    except ImportError:
+        # pydantic v1
+        from pydantic.json import pydantic_encoder
+        return json.loads(json.dumps(x, default=pydantic_encoder))
+    return to_jsonable_python(x)
+
+# the type of int | None (python >= 3.10)
+_UnionType = getattr(types, 'UnionType', None)
+
+_simple_field_types = {float: 'float', int: 'int', bool: 'bool', str: 'str'}
+
+def _get_field_type_string(field_type, kwargs: dict, *, nested: bool=False) -> str:
+    # kwargs receives the additional properties of the field (choices, optional, properties of nested models)
+    origin = typing.get_origin(field_type)
+    args = typing.get_args(field_type)
+    if origin is Union or (_UnionType is not None and origin is _UnionType):
+        non_none_args = [a for a in args if a is not type(None)]
+        if len(non_none_args) != 1:
+            raise Exception(f'Unexpected field type: {field_type}')
+        if nested:
+            return f'Optional[{_get_field_type_string(non_none_args[0], {}, nested=True)}]'
+        # Optional[X] is described as X
+        kwargs['optional'] = True
+        return _get_field_type_string(non_none_args[0], kwargs)
+    if origin is list:
+        if len(args) != 1:
+            raise Exception(f'Unexpected field type: {field_type}')
+        item_kwargs = {}
+        ret = f'List[{_get_field_type_string(args[0], item_kwargs, nested=True)}]'
+        if not nested and 'properties' in item_kwargs:
+            kwargs['properties'] = item_kwargs['properties']
+        return ret
+    if origin is dict:
+        if len(args) != 2 or args[0] is not str:
+            raise Exception(f'Unexpected field type: {field_type}')
+        item_kwargs = {}
+        ret = f'Dict[str, {_get_field_type_string(args[1], item_kwargs, nested=True)}]'
+        if not nested and 'properties' in item_kwargs:
+            kwargs['properties'] = item_kwargs['properties']
         return ret
+    if inspect.isclass(field_type) and issubclass(field_type, InputFile):
+        if nested:
+            raise Exception(f'Unexpected field type: {field_type} (input files must be top-level fields)')
+        return 'InputFile'
+    if inspect.isclass(field_type) and issubclass(field_type, OutputFile):
+        if nested:
+            raise Exception(f'Unexpected field type: {field_type} (output files must be top-level fields)')
+        return 'OutputFile'
+    if inspect.isclass(field_type) and issubclass(field_type, Enum):
+        if nested:
+            return field_type.__name__
+        kwargs['choices'] = [x.value for x in field_type]
+        return 'Enum'
+    if inspect.isclass(field_type) and issubclass(field_type, BaseModel):
+        kwargs['properties'] = _get_model_properties(field_type)
+        return field_type.__name__
+    if field_type in _simple_field_types:
+        return _simple_field_types[field_type]
+    raise Exception(f'Unexpected field type: {field_type}')
 
 class NeurobassPluginContext(ABC):
     """The plugin context to be passed into the initialize method of the plugin
@@ -7,4 +7,5 @@ from .NeurobassPluginTypes import NeurobassProcessingToolContext, NeurobassProce
 
 # neurobass processing plugins
 from .processing_tools.spike_sorting.SpikeSortingPlugin import SpikeSortingPlugin
-from .processing_tools.calcium_imaging.CalciumImagingPlugin import CalciumImagingPlugin
\ No newline at end of file
+from .processing_tools.calcium_imaging.CalciumImagingPlugin import CalciumImagingPlugin
+from .processing_tools.nwb_meta.NwbMetaPlugin import NwbMetaPlugin
\ No newline at end of file
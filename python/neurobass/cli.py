@@ -1,9 +1,11 @@
+import json
 import click
 import neurobass
 from .init_compute_resource_node import init_compute_resource_node as init_compute_resource_node_function
 from .start_compute_resource_node import start_compute_resource_node as start_compute_resource_node_function
 from .run_job import run_job as run_job_function
 from .handle_job import handle_job as handle_job_function
+from .supervise import supervise as supervise_function
 
 @click.group(help="neurobass command line interface")
 def main():
@@ -28,6 +30,17 @@ def run_job():
 def handle_job(job_id: str):
     handle_job_function(job_id=job_id)
 
+@click.command(help='Handle the jobs whose IDs are read from stdin (or a unix socket), in a single process (used internally)')
+@click.option('--socket', 'socket_path', default=None, help='Path of a unix socket to read the job IDs from, instead of stdin')
+def supervise(socket_path: str):
+    supervise_function(socket_path=socket_path)
+
+@click.command(help='Show the job cache statistics of the compute resource node in the current directory')
+def job_cache_stats():
+    from .JobCache import JobCache
+    stats = JobCache('job_cache').get_stats()
+    print(json.dumps(stats, indent=2))
+
 @click.command(help='Initialize the singularity container')
 def init_singularity_container():
     neurobass.init_singularity_container()
@@ -40,5 +53,7 @@ main.add_command(init_compute_resource_node)
 main.add_command(start_compute_resource_node)
 main.add_command(run_job)
 main.add_command(handle_job)
+main.add_command(supervise)
+main.add_command(job_cache_stats)
 main.add_command(init_singularity_container)
 main.add_command(init_docker_container)
\ No newline at end of file
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import subprocess
+from pathlib import Path
+from typing import List, Union
+
+
+# Container images required by the processing tools are declared in the
+# 'container_images' attribute of each tool. They are pulled once per node
+# (serialized with a lock file), verified, and their readiness is written to
+# container_images.json in the compute resource directory. The node's job
+# manager does not start jobs for tools whose images are not yet ready.
+
+container_images_fname = 'container_images.json'
+
+# the image used by the node itself (see init_docker_container and
+# init_singularity_container), prepared along with those of the tools
+default_container_image = 'magland/neurobass-default'
+
+# a failed pull is retried (e.g., registry rate limits or a network outage),
+# after which the jobs of the tools that need the image fail with the error
+_max_pull_attempts = 3
+_pull_retry_interval_sec = 60
+
+def collect_container_images(processing_tools: list) -> dict:
+    """Collect the container images required by each processing tool
+
+    Args:
+        processing_tools (list): the registered processing tools
+
+    Returns:
+        dict: map from tool name to list of container images
+    """
+    ret = {}
+    for pt in processing_tools:
+        images = pt.get_attributes().get('container_images', [])
+        if images:
+            ret[pt.get_name()] = list(images)
+    return ret
+
+def prepare_container_images(*, dir: str, tool_images: dict, container_method: str):
+    """Pull and verify all container images required by the tools, recording readiness as we go
+
+    Args:
+        dir (str): the compute resource directory
+        tool_images (dict): map from tool name to list of container images (see collect_container_images)
+        container_method (str): 'docker' or 'singularity'
+    """
+    images = sorted(set([image for x in tool_images.values() for image in x] + [default_container_image]))
+    status = {
+        'container_method': container_method,
+        'images': {image: {'status': 'pending'} for image in images},
+        'tools': {}
+    }
+    _write_status(dir, status, tool_images)
+    for image in images:
+        print(f'Preparing container image: {image}')
+        for attempt in range(1, _max_pull_attempts + 1):
+            try:
+                info = ensure_container_image(image, container_method=container_method, dir=dir)
+                status['images'][image] = {'status': 'ready', **info}
+                break
+            except Exception as e:
+                if attempt < _max_pull_attempts:
+                    print(f'Warning: unable to prepare container image {image} (attempt {attempt} of {_max_pull_attempts}), retrying in {_pull_retry_interval_sec * attempt} sec: {e}')
+                    time.sleep(_pull_retry_interval_sec * attempt)
+                else:
+                    print(f'Warning: unable to prepare container image {image}: {e}')
+                    status['images'][image] = {'status': 'failed', 'error': str(e)}
+        _write_status(dir, status, tool_images)
+
+def get_container_images_error(*, dir: str, tool_name: str) -> Union[str, None]:
+    """Get the error of the container images of a tool that could not be prepared, if any
+
+    Args:
+        dir (str): the compute resource directory
+        tool_name (str): the name of the tool
+
+    Returns:
+        Union[str, None]: the error, or None if the images are ready or still being prepared
+    """
+    fname = os.path.join(dir, container_images_fname)
+    if not os.path.exists(fname):
+        return None
+    with open(fname, 'r') as f:
+        status = json.load(f)
+    return status['tools'].get(tool_name, {}).get('error', None)
+
+def ensure_container_image(image: str, *, container_method: str, dir: Union[str, None]=None, verify: bool=True) -> dict:
+    """Make sure a container image is available locally, pulling it at most once per node
+
+    Args:
+        image (str): the container image, optionally pinned with @sha256:...
+        container_method (str): 'docker' or 'singularity'
+        dir (str): the compute resource directory (defaults to COMPUTE_RESOURCE_DIR)
+        verify (bool): whether to re-verify the checksum of an already cached singularity image
+
+    Returns:
+        dict: information about the local image (digest, and sif path for singularity)
+    """
+    if dir is None:
+        dir = os.environ.get('COMPUTE_RESOURCE_DIR', '.')
+    with _ImageLock(dir, image):
+        if container_method == 'docker':
+            return _ensure_docker_image(image, dir=dir)
+        elif container_method == 'singularity':
+            return _ensure_singularity_image(image, dir=dir, verify=verify)
+        else:
+            raise ValueError(f'Unexpected container method: {container_method}')
+
+def resolve_singularity_image(image: str) -> str:
+    """Return the path of a local singularity image, pulling it if needed"""
+    # load local image file if it exists, otherwise use the node-level cache (pulling if needed)
+    if Path(image).exists():
+        return image
+    # the image was already verified when the node started
+    info = ensure_container_image(image, container_method='singularity', verify=False)
+    return info['sif_path']
+
+def _ensure_docker_image(image: str, *, dir: str) -> dict:
+    import docker
+    client = docker.from_env()
+    try:
+        img = client.images.get(image)
+    except docker.errors.ImageNotFound:
+        print(f'Docker: pulling image {image}')
+        img = client.images.pull(image)
+    repo_digests = img.attrs.get('RepoDigests', [])
+    expected_digest = _get_pinned_digest(image)
+    manifest_path = Path(dir) / 'container_images' / (_image_basename(image) + '.docker.json')
+    if expected_digest is None and manifest_path.exists():
+        # not pinned by the tool: pinned to the digest of the first pull on
+        # this node, so that the image does not silently change (e.g., if the
+        # tag is pulled again by something else)
+        with open(manifest_path, 'r') as f:
+            expected_digest = json.load(f)['digest']
+    if expected_digest is not None:
+        if not any(d.endswith(f'@{expected_digest}') for d in repo_digests):
+            raise ValueError(f'Digest mismatch for image {image} (expected {expected_digest}, delete {manifest_path} to accept the new image): {repo_digests}')
+    digest = repo_digests[0].split('@')[-1] if repo_digests else img.id
+    if not manifest_path.exists():
+        if _get_pinned_digest(image) is None:
+            print(f'Warning: container image {image} is not pinned by digest, pinning it to {digest} on this node')
+        with open(manifest_path, 'w') as f:
+            json.dump({'image': image, 'digest': digest, 'timestamp': time.time()}, f, indent=2)
+    return {
+        'digest': digest
+    }
+
+def _ensure_singularity_image(image: str, *, dir: str, verify: bool) -> dict:
+    cache_dir = Path(dir) / 'container_images'
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    sif_path = cache_dir / (_image_basename(image) + '.sif')
+    manifest_path = cache_dir / (_image_basename(image) + '.json')
+    if sif_path.exists() and manifest_path.exists():
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        # verify the cached file has not been modified or truncated
+        if not verify or _sha256_of_file(sif_path) == manifest['sha256']:
+            return {'digest': manifest['sha256'], 'sif_path': str(sif_path.absolute())}
+        print(f'Cached singularity image is corrupt, pulling again: {sif_path}')
+    tmp_path = cache_dir / (_image_basename(image) + '.sif.downloading')
+    if tmp_path.exists():
+        tmp_path.unlink()
+    print(f'Singularity: pulling image {image}')
+    subprocess.run(['singularity', 'pull', str(tmp_path), f'docker://{image}'], check=True)
+    os.rename(tmp_path, sif_path)
+    sha256 = _sha256_of_file(sif_path)
+    with open(manifest_path, 'w') as f:
+        json.dump({'image': image, 'sha256': sha256, 'timestamp': time.time()}, f, indent=2)
+    return {'digest': sha256, 'sif_path': str(sif_path.absolute())}
+
+def _write_status(dir: str, status: dict, tool_images: dict):
+    for tool_name, images in tool_images.items():
+        errors = [f'{image}: {status["images"][image]["error"]}' for image in images if status['images'][image]['status'] == 'failed']
+        status['tools'][tool_name] = {
+            'ready': all(status['images'][image]['status'] == 'ready' for image in images),
+            'error': f'Unable to prepare container images: {"; ".join(errors)}' if errors else None
+        }
+    # write atomically so the node never reads a partial file
+    fname = os.path.join(dir, container_images_fname)
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(status, f, indent=2)
+    os.rename(fname + '.tmp', fname)
+
+def _get_pinned_digest(image: str) -> Union[str, None]:
+    if '@' in image:
+        return image.split('@')[-1]
+    return None
+
+def _image_basename(image: str) -> str:
+    return image.replace('/', '_').replace(':', '_').replace('@', '_')
+
+def _sha256_of_file(path: Path) -> str:
+    hh = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(1024 * 1024 * 16)
+            if not buf:
+                break
+            hh.update(buf)
+    return hh.hexdigest()
+
+class _ImageLock:
+    def __init__(self, dir: str, image: str):
+        lock_dir = Path(dir) / 'container_images'
+        lock_dir.mkdir(parents=True, exist_ok=True)
+        self._path = lock_dir / (_image_basename(image) + '.lock')
+        self._f = None
+    def __enter__(self):
+        self._f = open(self._path, 'w')
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+        self._f = None
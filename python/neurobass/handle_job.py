@@ -1,54 +1,114 @@
+from typing import Awaitable, Callable, Union
 import os
+import sys
 import time
-import requests
-import subprocess
-import threading
-import queue
+import codecs
+import asyncio
 import yaml
 import json
-from .crypto_keys import _sign_message
+from .job_resources import JobResourceLimiter, get_tool_resource_limits
+from .container_images import get_container_images_error
+from .JobTelemetry import JobTelemetry, call_with_retries
+from .NeurobassApiClient import NeurobassApiClient
 
 
 def handle_job(*, job_id: str):
+    load_compute_resource_node_config()
+
+    api = NeurobassApiClient.from_env()
+    try:
+        asyncio.run(handle_job_async(job_id=job_id, api=api))
+    finally:
+        api.close()
+
+def load_compute_resource_node_config():
+    """Load .neurobass-compute-resource-node.yaml (in the current directory) into the environment"""
     config_fname = '.neurobass-compute-resource-node.yaml'
     if not os.path.exists(config_fname):
         raise ValueError(f'File not found: {config_fname}')
     with open(config_fname, 'r') as f:
         config = yaml.safe_load(f)
     for k, v in config.items():
-        if v: os.environ[k] = v
+        # structured values (e.g., JOB_RESOURCE_LIMITS) are passed as JSON
+        if v: os.environ[k] = v if isinstance(v, str) else json.dumps(v)
+
+async def handle_job_async(*, job_id: str, api: NeurobassApiClient, get_job_status: Union[Callable[[], Awaitable[str]], None]=None, echo_console_output: bool=True):
+    """Handle a job: claim it, run it in a "neurobass run-job" subprocess and report the outcome
 
-    job = _get_job(job_id=job_id)
+    Everything the handler waits on (the subprocess, its output, the API) is
+    awaited, so that one event loop can supervise many jobs, sharing the
+    pooled connections of the API client.
+
+    Args:
+        job_id (str): the job
+        api (NeurobassApiClient): the client for the neurobass API
+        get_job_status (Callable[[], Awaitable[str]], optional): for the status checks while the job runs (by default, the job is requested with api)
+        echo_console_output (bool): whether to print the console output of the job
+    """
+    job = await call_with_retries(lambda: api.get_job(job_id=job_id), description='getting job')
     if job['status'] != 'pending':
         raise ValueError(f'Unexpected job status: {job["status"]}')
     workspace_id = job['workspaceId']
     project_id = job['projectId']
-    _set_job_status(workspace_id=workspace_id, project_id=project_id, job_id=job_id, status='running')
+    async def set_job_property(property: str, value, *, max_duration_sec: float=3600):
+        await call_with_retries(
+            lambda: api.set_job_property(workspace_id=workspace_id, project_id=project_id, job_id=job_id, property=property, value=value),
+            description=f'setting job {property}',
+            max_duration_sec=max_duration_sec
+        )
+    async def set_job_status(status: str):
+        try:
+            await set_job_property('status', status)
+        except Exception:
+            # the status transitions are not idempotent: if a request was
+            # applied but timed out, its retries are rejected
+            job = await call_with_retries(lambda: api.get_job(job_id=job_id), description='getting job')
+            if job['status'] != status:
+                raise
+    await set_job_status('running')
 
     try:
+        # the jobs of a tool whose container images could not be pulled are
+        # started anyway (see JobManager.toolIsReady), so that they fail with the error
+        container_images_error = get_container_images_error(dir=os.environ.get('COMPUTE_RESOURCE_DIR', '.'), tool_name=job['toolName'])
+        if container_images_error is not None:
+            raise ValueError(container_images_error)
+
         job_dir = f'jobs/{job_id}'
         if os.path.exists(job_dir):
             raise ValueError(f'Job directory already exists: {job_dir}')
         os.makedirs(job_dir)
 
         job_fname = f'{job_dir}/job.json'
+        # the input files are requested concurrently
+        input_file_records = await asyncio.gather(*[
+            call_with_retries(lambda a=a: api.get_file(project_id=project_id, file_name=a['fileName']), description='getting input file')
+            for a in job['inputFiles']
+        ])
         input_files = []
-        for a in job['inputFiles']:
-            req = {
-                'type': 'getFile',
-                'timestamp': time.time(),
-                'projectId': job['projectId'],
-                'fileName': a['fileName']
-            }
-            resp = _post_neurobass_request(req)
-            if resp['type'] != 'getFile':
-                raise ValueError(f'Unexpected response type: {resp["type"]}')
-            content_string = resp['file']['content']
-            input_files.append({
-                'name': a['name'],
-                'path': a['fileName'],
-                'content_string': content_string
-            })
+        for i, (a, file_record) in enumerate(zip(job['inputFiles'], input_file_records)):
+            content = file_record['content']
+            if content.startswith('data:'):
+                # inline content is passed by reference: it is spooled to the
+                # job directory, where the tool can map it (see InputFile.open
+                # and InputFile.get_buffer), rather than embedded in job.json.
+                # The file is named after the index of the input - never after
+                # its name, which comes from the job definition (untrusted)
+                content_file = f'inputs/{i}'
+                os.makedirs(f'{job_dir}/inputs', exist_ok=True)
+                with open(f'{job_dir}/{content_file}', 'wb') as f:
+                    f.write(content[len('data:'):].encode('utf-8'))
+                input_files.append({
+                    'name': a['name'],
+                    'path': a['fileName'],
+                    'content_file': content_file
+                })
+            else:
+                input_files.append({
+                    'name': a['name'],
+                    'path': a['fileName'],
+                    'content_string': content
+                })
         output_files = []
         for a in job['outputFiles']:
             output_files.append({
@@ -71,190 +131,151 @@ def handle_job(*, job_id: str):
         with open(job_fname, 'w') as f:
             json.dump(job_json, f, indent=4)
 
-        # run "neurobass run-job" in the job directory
-        proc = subprocess.Popen(
-            ['neurobass', 'run-job'],
-            cwd=job_dir,
-            env=os.environ,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
+        # run "neurobass run-job" in the job directory, with the resource limits declared by the tool
+        resource_limits = get_tool_resource_limits(job['toolName'])
+        resource_limiter = JobResourceLimiter(job_id=job_id, limits=resource_limits)
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *resource_limiter.get_command(['neurobass', 'run-job']),
+                cwd=job_dir,
+                env={**os.environ, **resource_limiter.get_job_env()},
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT
+            )
+        except:
+            resource_limiter.cleanup()
+            raise
+
+        # the API is only ever called from the telemetry tasks while the job
+        # runs, so that a slow or unavailable API never stalls or fails the job
+        async def get_job_status_default():
+            return (await api.get_job(job_id=job_id))['status']
+        telemetry = JobTelemetry(
+            get_job_status=get_job_status if get_job_status is not None else get_job_status_default,
+            set_console_output=lambda x: api.set_job_property(workspace_id=workspace_id, project_id=project_id, job_id=job_id, property='consoleOutput', value=x)
         )
+        telemetry.start()
 
-        def output_reader(proc, outq: queue.Queue):
+        console_output = _ConsoleOutput(echo=echo_console_output)
+        async def output_reader():
+            last_report_time = 0
             while True:
-                x = proc.stdout.read(1)
+                x = await proc.stdout.read(4096)
                 if len(x) == 0:
                     break
-                outq.put(x)
-
-        outq = queue.Queue()
-        output_reader_thread = threading.Thread(target=output_reader, args=(proc, outq))
-        output_reader_thread.start()
-
-        all_output = b''
-        last_newline_index_in_output = -1
-        last_report_console_output_time = time.time()
-        console_output_changed = False
-        last_check_job_exists_time = time.time()
+                console_output.append(x)
+                # the telemetry only keeps the latest snapshot, so there is no point decoding it more often
+                if time.time() - last_report_time >= 1:
+                    last_report_time = time.time()
+                    telemetry.set_console_output(console_output.get_text())
 
+        output_reader_task = asyncio.create_task(output_reader())
+        wait_task = asyncio.create_task(proc.wait())
+        cancelled_task = asyncio.create_task(telemetry.cancelled())
         try:
-            while True:
-                try:
-                    retcode = proc.wait(1)
-                    if retcode != 0:
-                        raise ValueError(f'Error running job: {retcode}')
-                    break
-                except subprocess.TimeoutExpired:
-                    pass
-                while True:
-                    try:
-                        x = outq.get(block=False)
-                        print(x.decode('utf-8'), end='')
-
-                        if x == b'\n':
-                            last_newline_index_in_output = len(all_output)
-                        if x == b'\r':
-                            # handle carriage return (e.g. in progress bar)
-                            all_output = all_output[:last_newline_index_in_output + 1]
-                        all_output += x
-                        console_output_changed = True
-                    except queue.Empty:
-                        break
-                
-                if console_output_changed:
-                    elapsed = time.time() - last_report_console_output_time
-                    if elapsed > 10:
-                        last_report_console_output_time = time.time()
-                        console_output_changed = False
-                        _set_job_console_output(workspace_id=workspace_id, project_id=project_id, job_id=job_id, console_output=all_output.decode('utf-8'))
-                        print(all_output.decode('utf-8'))
-
-                elapsed = time.time() - last_check_job_exists_time
-                if elapsed > 60:
-                    last_check_job_exists_time = time.time()
-                    # this should throw an exception if the job does not exist
-                    job = _get_job(job_id=job_id)
-                    if job['status'] != 'running':
-                        raise ValueError(f'Unexpected job status: {job["status"]}')
+            await asyncio.wait([wait_task, cancelled_task], return_when=asyncio.FIRST_COMPLETED)
+            if not wait_task.done():
+                # e.g., the job was deleted or its status was changed
+                raise ValueError(telemetry.cancel_reason)
+            retcode = wait_task.result()
+            if retcode != 0:
+                raise ValueError(f'Error running job: {retcode}')
         finally:
-            output_reader_thread.join()
-            proc.stdout.close()
-            proc.terminate()
+            cancelled_task.cancel()
+            if proc.returncode is None:
+                proc.terminate()
+            await proc.wait()
+            await output_reader_task
+            telemetry.set_console_output(console_output.get_text())
+            await telemetry.stop()
+            with open(f'{job_dir}/job_telemetry.json', 'w') as f:
+                json.dump(telemetry.get_stats(), f, indent=2)
+            with open(f'{job_dir}/job_resource_usage.json', 'w') as f:
+                json.dump(resource_limiter.get_usage(), f, indent=2)
+            resource_limiter.cleanup()
 
-        # read the output files and set them in the job
+        await _report_job_metrics(api=api, workspace_id=workspace_id, project_id=project_id, job_id=job_id, job_dir=job_dir)
+
+        # read the output files and set them in the job (concurrently)
+        outputs = []
         for a in job['outputFiles']:
             output_fname = f'{job_dir}/outputs/{a["name"]}.json'
             if not os.path.exists(output_fname):
                 raise ValueError(f'Output file not found: {output_fname}')
             with open(output_fname, 'r') as f:
-                output = json.load(f)
-            req = {
-                'type': 'setFile',
-                'timestamp': time.time(),
-                'projectId': job['projectId'],
-                'workspaceId': job['workspaceId'],
-                'fileName': a['fileName'],
-                'content': f'url:{output["url"]}',
-                'size': output['size'],
-                'jobId': job['jobId'],
-                'metadata': {}
-            }
-            resp = _post_neurobass_request(req)
-            if resp['type'] != 'setFile':
-                raise ValueError(f'Unexpected response type: {resp["type"]}')
-        
+                outputs.append((a, json.load(f)))
+        await asyncio.gather(*[
+            call_with_retries(
+                lambda a=a, output=output: api.set_file(
+                    project_id=project_id,
+                    workspace_id=workspace_id,
+                    file_name=a['fileName'],
+                    content=f'url:{output["url"]}',
+                    size=output['size'],
+                    job_id=job_id,
+                    metadata={}
+                ),
+                description='setting output file'
+            )
+            for a, output in outputs
+        ])
+
         # set the job status to completed
-        _set_job_status(workspace_id=workspace_id, project_id=project_id, job_id=job_id, status='completed')
+        await set_job_status('completed')
     except Exception as err:
         error_message = str(err)
         print(f'Job error: {error_message}')
-        _set_job_error(workspace_id=workspace_id, project_id=project_id, job_id=job_id, error_message=error_message)
-        _set_job_status(workspace_id=workspace_id, project_id=project_id, job_id=job_id, status='failed')
+        await _report_job_metrics(api=api, workspace_id=workspace_id, project_id=project_id, job_id=job_id, job_dir=f'jobs/{job_id}')
+        await set_job_property('error', error_message)
+        await set_job_status('failed')
 
-def _get_job(*, job_id: str):
-    req = {
-        'type': 'getJob',
-        'timestamp': time.time(),
-        'jobId': job_id
-    }
-    resp = _post_neurobass_request(req)
-    if resp['type'] != 'getJob':
-        raise ValueError(f'Unexpected response type: {resp["type"]}')
-    job = resp['job']
-    return job
+class _ConsoleOutput:
+    """The console output of a job, as it would appear in a terminal (carriage returns overwrite the current line, e.g. in progress bars)"""
+    def __init__(self, *, echo: bool):
+        self._echo = echo
+        self._output = bytearray()
+        self._last_newline_index = -1
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    def append(self, x: bytes):
+        if self._echo:
+            print(self._decoder.decode(x), end='')
+            sys.stdout.flush()
+        parts = x.split(b'\r')
+        for i, part in enumerate(parts):
+            if i > 0:
+                # handle carriage return
+                del self._output[self._last_newline_index + 1:]
+                self._output += b'\r'
+            j = part.rfind(b'\n')
+            if j >= 0:
+                self._last_newline_index = len(self._output) + j
+            self._output += part
+    def get_text(self) -> str:
+        return self._output.decode('utf-8', errors='replace')
 
-def _set_job_status(*, workspace_id: str, project_id: str, job_id: str, status: str):
-    req = {
-        'type': 'setJobProperty',
-        'timestamp': time.time(),
-        'workspaceId': workspace_id,
-        'projectId': project_id,
-        'jobId': job_id,
-        'property': 'status',
-        'value': status
-    }
-    resp = _post_neurobass_request(req)
-    if resp['type'] != 'setJobProperty':
-        raise ValueError(f'Unexpected response type: {resp["type"]}')
-    if resp['success'] != True:
-        raise ValueError(f'Error setting job status: {resp["error"]}')
-
-def _set_job_error(*, workspace_id: str, project_id: str, job_id: str, error_message: str):
-    req = {
-        'type': 'setJobProperty',
-        'timestamp': time.time(),
-        'workspaceId': workspace_id,
-        'projectId': project_id,
-        'jobId': job_id,
-        'property': 'error',
-        'value': error_message
-    }
-    resp = _post_neurobass_request(req)
-    if resp['type'] != 'setJobProperty':
-        raise ValueError(f'Unexpected response type: {resp["type"]}')
-    if resp['success'] != True:
-        raise ValueError(f'Error setting job error: {resp["error"]}')
-
-def _set_job_console_output(*, workspace_id: str, project_id: str, job_id: str, console_output: str):
-    req = {
-        'type': 'setJobProperty',
-        'timestamp': time.time(),
-        'workspaceId': workspace_id,
-        'projectId': project_id,
-        'jobId': job_id,
-        'property': 'consoleOutput',
-        'value': console_output
-    }
-    resp = _post_neurobass_request(req)
-    if resp['type'] != 'setJobProperty':
-        raise ValueError(f'Unexpected response type: {resp["type"]}')
-    if resp['success'] != True:
-        raise ValueError(f'Error setting job console output: {resp["error"]}')
-
-# export type SetJobPropertyRequest = {
-#     type: 'setJobProperty'
-#     timestamp: number
-#     workspaceId: string
-#     projectId: string
-#     jobId: string
-#     property: string
-#     value: any
-#     computeResourceNodeId?: string
-#     computeResourceNodeName?: string
-# }
-
-def _post_neurobass_request(req):
-    compute_resource_id = os.environ['COMPUTE_RESOURCE_ID']
-    compute_resource_private_key = os.environ['COMPUTE_RESOURCE_PRIVATE_KEY']
-    signature = _sign_message(req, compute_resource_id, compute_resource_private_key)
-    rr = {
-        'payload': req,
-        'fromClientId': compute_resource_id,
-        'signature': signature
-    }
-    neurobass_url = os.environ.get('NEUROBASS_URL', 'https://neurobass.vercel.app')
-    resp = requests.post(f'{neurobass_url}/api/neurobass', json=rr)
-    if resp.status_code != 200:
-        msg = resp.text
-        raise ValueError(f'Error posting neurobass request: {msg}')
-    return resp.json()
\ No newline at end of file
+async def _report_job_metrics(*, api: NeurobassApiClient, workspace_id: str, project_id: str, job_id: str, job_dir: str):
+    # job_metrics.json is written by run_job, and job_resource_usage.json and
+    # job_telemetry.json by the handler. Failing to report the metrics should never cause the job to fail.
+    metrics_fname = f'{job_dir}/job_metrics.json'
+    resource_usage_fname = f'{job_dir}/job_resource_usage.json'
+    telemetry_fname = f'{job_dir}/job_telemetry.json'
+    if not os.path.exists(metrics_fname) and not os.path.exists(resource_usage_fname):
+        return
+    try:
+        metrics = {}
+        if os.path.exists(metrics_fname):
+            with open(metrics_fname, 'r') as f:
+                metrics = json.load(f)
+        if os.path.exists(resource_usage_fname):
+            with open(resource_usage_fname, 'r') as f:
+                metrics['job_resources'] = json.load(f)
+        if os.path.exists(telemetry_fname):
+            with open(telemetry_fname, 'r') as f:
+                metrics['job_telemetry'] = json.load(f)
+        await call_with_retries(
+            lambda: api.set_job_property(workspace_id=workspace_id, project_id=project_id, job_id=job_id, property='metrics', value=metrics),
+            description='reporting job metrics',
+            max_duration_sec=300
+        )
+    except Exception as err:
+        print(f'Warning: unable to report job metrics: {str(err)}')
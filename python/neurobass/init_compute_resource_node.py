@@ -17,7 +17,13 @@ env_var_keys = [
     'OUTPUT_AWS_ACCESS_KEY_ID',
     'OUTPUT_AWS_SECRET_ACCESS_KEY',
     'OUTPUT_BUCKET',
-    'OUTPUT_BUCKET_BASE_URL'
+    'OUTPUT_BUCKET_BASE_URL',
+    'CONTAINER_POOL_SIZE',
+    'NEUROBASS_PLUGIN_PACKAGES',
+    'NEUROBASS_CGROUP_ROOT',
+    'JOB_RESOURCE_LIMITS',
+    'INPUT_PATH_MAPPINGS',
+    'JOB_SUPERVISOR'
 ]
 
 def init_compute_resource_node(*, dir: str, compute_resource_id: Optional[str]=None, compute_resource_private_key: Optional[str]=None):
@@ -1,8 +1,11 @@
 import subprocess
+from .container_images import ensure_container_image, default_container_image
 
 
 def init_docker_container():
     """Initialize the docker container"""
-    cmd = 'docker run --rm magland/neurobass-default bash -c "python3 -c \\"import numpy; print(numpy.__version__)\\""'
-    version = subprocess.check_output(cmd, shell=True).decode('utf-8').strip()
+    # pulled (and verified) once per node, as when the node starts
+    ensure_container_image(default_container_image, container_method='docker')
+    cmd = ['docker', 'run', '--rm', default_container_image, 'python3', '-c', 'import numpy; print(numpy.__version__)']
+    version = subprocess.check_output(cmd).decode('utf-8').strip()
     print(f'numpy version: {version}')
\ No newline at end of file
@@ -1,8 +1,11 @@
 import subprocess
+from .container_images import resolve_singularity_image, default_container_image
 
 
 def init_singularity_container():
     """Initialize the singularity container"""
-    cmd = 'singularity exec docker://magland/neurobass-default python3 -c "import numpy; print(numpy.__version__)"'
-    version = subprocess.check_output(cmd, shell=True).decode('utf-8').strip()
+    # the image is cached (and verified) once per node, as when the node starts
+    sif_path = resolve_singularity_image(default_container_image)
+    cmd = ['singularity', 'exec', sif_path, 'python3', '-c', 'import numpy; print(numpy.__version__)']
+    version = subprocess.check_output(cmd).decode('utf-8').strip()
     print(f'numpy version: {version}')
\ No newline at end of file
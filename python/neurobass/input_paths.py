@@ -0,0 +1,61 @@
+from typing import List, Tuple, Union
+import os
+from urllib.parse import urlparse, unquote
+
+
+# Inputs that are on storage mounted on the node (local disk, NFS, ...) can be
+# opened directly rather than over HTTP. A URL is resolved to a local path if
+# it starts with one of the prefixes configured in INPUT_PATH_MAPPINGS, a
+# ';'-separated list of <url_prefix>=<local_path>, e.g.,
+#     INPUT_PATH_MAPPINGS=https://archive.example.org/data/=/mnt/archive/data/
+# or if it is a file:// URL of a file under one of the local paths.
+
+def get_input_path_mappings() -> List[Tuple[str, str]]:
+    """Get the URL prefix to local path mappings configured on the node
+
+    Returns:
+        List[Tuple[str, str]]: the (url_prefix, local_path) pairs, longest prefix first
+    """
+    x = os.environ.get('INPUT_PATH_MAPPINGS', '')
+    ret = []
+    for item in x.split(';'):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' not in item:
+            raise ValueError(f'Invalid input path mapping (expected <url_prefix>=<local_path>): {item}')
+        url_prefix, local_path = item.rsplit('=', 1)
+        ret.append((url_prefix.strip(), local_path.strip()))
+    return sorted(ret, key=lambda m: -len(m[0]))
+
+def resolve_local_path(url: str) -> Union[str, None]:
+    """Resolve the URL of an input file to a path on the node, if the file is available locally
+
+    The path must be under the local path of one of the INPUT_PATH_MAPPINGS
+    (after resolving symlinks and ..), also for file:// URLs, so that a job
+    can never read other files of the node.
+
+    Returns:
+        Union[str, None]: the local path, or None if the URL is not mapped or the file does not exist
+    """
+    mappings = get_input_path_mappings()
+    roots = [os.path.realpath(local_path) for _, local_path in mappings]
+    if url.startswith('file://'):
+        path = os.path.realpath(unquote(urlparse(url).path))
+        if not any(_is_under(path, root) for root in roots):
+            raise ValueError(f'Local input path is not under one of the INPUT_PATH_MAPPINGS: {path}')
+    else:
+        path = None
+        for (url_prefix, _), root in zip(mappings, roots):
+            if url.startswith(url_prefix):
+                path = os.path.realpath(os.path.join(root, unquote(url[len(url_prefix):]).lstrip('/')))
+                if not _is_under(path, root):
+                    # e.g., .. in the URL, or a symlink out of the root
+                    return None
+                break
+    if path is None or not os.path.isfile(path):
+        return None
+    return path
+
+def _is_under(path: str, root: str) -> bool:
+    return path.startswith(root.rstrip(os.sep) + os.sep)
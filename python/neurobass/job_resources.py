@@ -0,0 +1,381 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import signal
+import tempfile
+import ctypes
+import platform
+import resource
+from pathlib import Path
+from typing import Dict, List, Union
+
+
+# The resource limits of the jobs of each tool are configured on the node, in
+# JOB_RESOURCE_LIMITS (in the environment or in the node configuration), a JSON
+# object mapping tool names to limits, e.g.,
+#     {"mountainsort5": {"num_cpus": 8, "memory_gb": 32, "io_priority": "best_effort", "io_priority_level": 4}}
+# The jobs of the tools that are not listed are not limited. The job handler
+# enforces the limits on the run-job process (and its descendants) with a
+# cgroup v2 when NEUROBASS_CGROUP_ROOT points to a delegated cgroup, and
+# otherwise with setrlimit, CPU affinity and ioprio_set.
+#
+# Each job that has num_cpus is pinned to its own set of cores, taken from
+# a single NUMA node when possible, with its memory allocated on that node. The
+# thread pools of the job (OpenMP, MKL, OpenBLAS, numba) are sized to match via
+# the environment (see JobResourceLimiter.get_job_env).
+#
+# The limits are applied by running this file as a script in front of the job
+# command (see JobResourceLimiter.get_command): a fresh, single-threaded
+# process applies them to itself and then execs the job, rather than running
+# Python between fork and exec in the (multi-threaded) job handler. Without a
+# cgroup, the same process also measures the resource usage of the job: it
+# runs the job as its only child and gets its usage with wait4, as
+# getrusage(RUSAGE_CHILDREN) in the handler would add up all the jobs that it
+# handled. For this, the module only depends on the standard library.
+
+_this_file = os.path.abspath(__file__)
+
+def get_tool_resource_limits(tool_name: str) -> dict:
+    """Get the resource limits of the jobs of a tool, from JOB_RESOURCE_LIMITS
+
+    Returns:
+        dict: the resource limits (empty if none are configured)
+    """
+    x = os.environ.get('JOB_RESOURCE_LIMITS', '')
+    if not x:
+        return {}
+    try:
+        limits = json.loads(x)
+    except json.JSONDecodeError as e:
+        raise ValueError(f'Invalid JOB_RESOURCE_LIMITS: {str(e)}')
+    return limits.get(tool_name, {})
+
+class JobResourceLimiter:
+    def __init__(self, *, job_id: str, limits: dict, dir: str='.'):
+        """Enforce resource limits on a job process
+
+        Args:
+            job_id (str): the job ID
+            limits (dict): the resource limits (see get_tool_resource_limits)
+            dir (str): the compute resource directory (used to coordinate core allocation between jobs)
+        """
+        self.job_id = job_id
+        self.limits = limits
+        self._dir = dir
+        self._cores: Union[List[int], None] = None
+        self._numa_node: Union[int, None] = None
+        self._cgroup_dir: Union[Path, None] = None
+        self._usage_fname: Union[str, None] = None
+        self._timestamp_start = time.time()
+
+        num_cpus = limits.get('num_cpus', None)
+        if num_cpus is not None:
+            self._cores, self._numa_node = _allocate_cores(dir=dir, job_id=job_id, num_cores=int(num_cpus))
+        cgroup_root = os.environ.get('NEUROBASS_CGROUP_ROOT', None)
+        if cgroup_root and limits:
+            try:
+                self._cgroup_dir = _create_job_cgroup(Path(cgroup_root), job_id=job_id, limits=limits, cores=self._cores, numa_node=self._numa_node)
+            except Exception as e:
+                print(f'Warning: unable to create cgroup for job (falling back to setrlimit): {e}')
+                self._cgroup_dir = None
+        if self._cgroup_dir is None:
+            fd, self._usage_fname = tempfile.mkstemp(prefix=f'neurobass-job-{job_id}-', suffix='.json')
+            os.close(fd)
+        if num_cpus is not None and self._cores is None:
+            if self._cgroup_dir is not None and (self._cgroup_dir / 'cpu.max').exists():
+                print(f'Not enough free cores to pin job to {num_cpus} cores; using a CPU quota only')
+            else:
+                print(f'Warning: not enough free cores to pin job to {num_cpus} cores, and no cgroup for a CPU quota; the CPU usage of the job is not limited')
+    @property
+    def cores(self) -> Union[List[int], None]:
+        return self._cores
+    @property
+    def numa_node(self) -> Union[int, None]:
+        return self._numa_node
+    def get_job_env(self) -> dict:
+        """Get the environment variables that size the thread pools of the job to its allocation
+
+        Returns:
+            dict: the environment variables (empty if the tool does not declare num_cpus)
+        """
+        if self._cores is not None:
+            num_threads = len(self._cores)
+        elif self.limits.get('num_cpus', None) is not None:
+            num_threads = max(1, int(self.limits['num_cpus']))
+        else:
+            return {}
+        ret = {'NEUROBASS_JOB_NUM_CPUS': str(num_threads)}
+        for k in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMBA_NUM_THREADS']:
+            ret[k] = str(num_threads)
+        if self._cores is not None:
+            ret['NEUROBASS_JOB_CORES'] = ','.join(str(c) for c in self._cores)
+        if self._numa_node is not None:
+            ret['NEUROBASS_JOB_NUMA_NODE'] = str(self._numa_node)
+        return ret
+    def get_command(self, cmd: List[str]) -> List[str]:
+        """Get the command that runs cmd with the limits applied (and, without a cgroup, its resource usage measured)
+
+        Args:
+            cmd (List[str]): the command of the job
+
+        Returns:
+            List[str]: the command to run instead (cmd itself if there is nothing to do)
+        """
+        if not self.limits and self._usage_fname is None:
+            return cmd
+        config = {
+            'limits': self.limits,
+            'cgroup_dir': str(self._cgroup_dir) if self._cgroup_dir is not None else None,
+            'cores': self._cores,
+            'numa_node': self._numa_node,
+            'usage_fname': self._usage_fname
+        }
+        # -I: the directory of this file is not added to sys.path (its modules would shadow the standard library)
+        return [sys.executable, '-I', _this_file, json.dumps(config), *cmd]
+    def get_usage(self) -> dict:
+        """Get the resource usage of the job (call after the job process has exited)"""
+        ret = {
+            'limits': self.limits,
+            'cores': self._cores,
+            'numa_node': self._numa_node,
+            'elapsed_sec': time.time() - self._timestamp_start
+        }
+        if self._cgroup_dir is not None:
+            ret['method'] = 'cgroup'
+            for fname, key in [('memory.peak', 'peak_memory_bytes')]:
+                p = self._cgroup_dir / fname
+                if p.exists():
+                    ret[key] = int(p.read_text().strip())
+            p = self._cgroup_dir / 'cpu.stat'
+            if p.exists():
+                for line in p.read_text().splitlines():
+                    k, v = line.split()
+                    if k in ['usage_usec', 'user_usec', 'system_usec']:
+                        ret['cpu_' + k.replace('_usec', '_sec')] = int(v) / 1e6
+            p = self._cgroup_dir / 'memory.events'
+            if p.exists():
+                for line in p.read_text().splitlines():
+                    k, v = line.split()
+                    if k == 'oom_kill':
+                        ret['oom_kill'] = int(v)
+        else:
+            ret['method'] = 'rlimit'
+            # measured with wait4 on the job process (including its descendants that were waited for)
+            if self._usage_fname is not None and os.path.getsize(self._usage_fname) > 0:
+                with open(self._usage_fname, 'r') as f:
+                    ret.update(json.load(f))
+        return ret
+    def cleanup(self):
+        if self._usage_fname is not None and os.path.exists(self._usage_fname):
+            os.remove(self._usage_fname)
+        if self._cores is not None:
+            _release_cores(dir=self._dir, job_id=self.job_id)
+        if self._cgroup_dir is not None:
+            try:
+                self._cgroup_dir.rmdir()
+            except Exception as e:
+                print(f'Warning: unable to remove cgroup {self._cgroup_dir}: {e}')
+
+def _run_job(cmd: List[str], *, usage_fname: str) -> int:
+    # runs the job as the only child of this process, and writes its resource usage
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.execvp(cmd[0], cmd)
+        finally:
+            os._exit(127)
+    # the handler stops the job by terminating this process
+    for sig in [signal.SIGTERM, signal.SIGINT]:
+        signal.signal(sig, lambda signum, frame: os.kill(pid, signum))
+    _, status, ru = os.wait4(pid, 0)
+    with open(usage_fname, 'w') as f:
+        json.dump({
+            'peak_memory_bytes': ru.ru_maxrss * 1024,
+            'cpu_user_sec': ru.ru_utime,
+            'cpu_system_sec': ru.ru_stime
+        }, f)
+    return status
+
+def _apply_limits(*, limits: dict, cgroup_dir: Union[str, None], cores: Union[List[int], None], numa_node: Union[int, None]):
+    # applies the limits to the current process (inherited by the job that it execs)
+    if cgroup_dir is not None:
+        with open(os.path.join(cgroup_dir, 'cgroup.procs'), 'w') as f:
+            f.write(str(os.getpid()))
+    else:
+        memory_gb = limits.get('memory_gb', None)
+        if memory_gb is not None:
+            # RLIMIT_DATA (rather than RLIMIT_AS) so that large virtual reservations are still allowed
+            nbytes = int(memory_gb * 1024 * 1024 * 1024)
+            resource.setrlimit(resource.RLIMIT_DATA, (nbytes, nbytes))
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+    if numa_node is not None:
+        _set_preferred_numa_node(numa_node)
+    io_priority = limits.get('io_priority', None)
+    if io_priority is not None:
+        _set_io_priority(io_priority, int(limits.get('io_priority_level', 4)))
+    nice = limits.get('nice', None)
+    if nice is not None:
+        os.nice(int(nice))
+
+def _create_job_cgroup(cgroup_root: Path, *, job_id: str, limits: dict, cores: Union[List[int], None], numa_node: Union[int, None]) -> Path:
+    # cgroup_root must be a delegated cgroup v2 directory with no processes of its own
+    controllers = (cgroup_root / 'cgroup.controllers').read_text().split()
+    wanted = [c for c in ['cpu', 'memory', 'io', 'cpuset'] if c in controllers]
+    with open(cgroup_root / 'cgroup.subtree_control', 'w') as f:
+        f.write(' '.join('+' + c for c in wanted))
+    cgroup_dir = cgroup_root / f'neurobass-job-{job_id}'
+    cgroup_dir.mkdir(exist_ok=True)
+    memory_gb = limits.get('memory_gb', None)
+    if memory_gb is not None and 'memory' in wanted:
+        (cgroup_dir / 'memory.max').write_text(str(int(memory_gb * 1024 * 1024 * 1024)))
+        # don't let the job push the rest of the node into swap
+        if (cgroup_dir / 'memory.swap.max').exists():
+            (cgroup_dir / 'memory.swap.max').write_text('0')
+    num_cpus = limits.get('num_cpus', None)
+    if num_cpus is not None and 'cpu' in wanted:
+        period = 100000
+        (cgroup_dir / 'cpu.max').write_text(f'{int(float(num_cpus) * period)} {period}')
+    if cores is not None and 'cpuset' in wanted:
+        (cgroup_dir / 'cpuset.cpus').write_text(','.join(str(c) for c in cores))
+        if numa_node is not None:
+            (cgroup_dir / 'cpuset.mems').write_text(str(numa_node))
+    io_priority = limits.get('io_priority', None)
+    if io_priority is not None and 'io' in wanted and (cgroup_dir / 'io.weight').exists():
+        # map the ioprio classes onto cgroup io weights (1-10000, default 100)
+        level = int(limits.get('io_priority_level', 4))
+        weight = {'realtime': 1000, 'best_effort': 100 + (4 - level) * 20, 'idle': 1}[io_priority]
+        (cgroup_dir / 'io.weight').write_text(f'default {weight}')
+    return cgroup_dir
+
+def _set_io_priority(io_priority: str, level: int):
+    # ioprio_set(IOPRIO_WHO_PROCESS, 0, ...) - there is no wrapper in the standard library
+    syscall_numbers = {'x86_64': 251, 'aarch64': 30}
+    nr = syscall_numbers.get(platform.machine(), None)
+    if nr is None:
+        return
+    io_class = {'realtime': 1, 'best_effort': 2, 'idle': 3}[io_priority]
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.syscall(nr, 1, 0, (io_class << 13) | level)
+
+def _set_preferred_numa_node(numa_node: int):
+    # set_mempolicy(MPOL_PREFERRED, ...) - allocate on the node of the pinned cores,
+    # but fall back to other nodes rather than failing when it is full
+    syscall_numbers = {'x86_64': 238, 'aarch64': 237}
+    nr = syscall_numbers.get(platform.machine(), None)
+    if nr is None or numa_node >= 64:
+        return
+    MPOL_PREFERRED = 1
+    nodemask = ctypes.c_ulong(1 << numa_node)
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.syscall(nr, MPOL_PREFERRED, ctypes.byref(nodemask), 64)
+
+def get_numa_nodes() -> Dict[int, List[int]]:
+    """Get the cores (available to this process) of each NUMA node
+
+    Returns:
+        Dict[int, List[int]]: the cores of each NUMA node (a single node 0 if the topology is unknown)
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        available = sorted(os.sched_getaffinity(0))
+    else:
+        available = list(range(os.cpu_count() or 1))
+    ret = {}
+    node_dir = Path('/sys/devices/system/node')
+    if node_dir.exists():
+        for p in sorted(node_dir.glob('node[0-9]*')):
+            cores = [c for c in _parse_cpu_list((p / 'cpulist').read_text()) if c in available]
+            if len(cores) > 0:
+                ret[int(p.name[len('node'):])] = cores
+    if len(ret) == 0:
+        ret = {0: available}
+    return ret
+
+def _parse_cpu_list(x: str) -> List[int]:
+    # e.g., '0-3,8-11'
+    ret = []
+    for part in x.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            a, b = part.split('-')
+            ret.extend(range(int(a), int(b) + 1))
+        else:
+            ret.append(int(part))
+    return ret
+
+def _allocate_cores(*, dir: str, job_id: str, num_cores: int):
+    numa_nodes = get_numa_nodes()
+    num_cores = min(num_cores, sum(len(v) for v in numa_nodes.values()))
+    with _CoreAllocations(dir) as allocations:
+        used = set([c for x in allocations.values() for c in x['cores']])
+        free = {k: [c for c in v if c not in used] for k, v in numa_nodes.items()}
+        if sum(len(v) for v in free.values()) < num_cores:
+            return None, None
+        # the NUMA node with the fewest free cores that still fits the job, so
+        # that larger blocks are left for larger jobs
+        candidates = [k for k, v in free.items() if len(v) >= num_cores]
+        if len(candidates) > 0:
+            numa_node = min(candidates, key=lambda k: len(free[k]))
+            cores = free[numa_node][:num_cores]
+        else:
+            # spans NUMA nodes - take from the nodes with the most free cores first
+            numa_node = None
+            cores = []
+            for k in sorted(free.keys(), key=lambda k: -len(free[k])):
+                cores.extend(free[k][:num_cores - len(cores)])
+        allocations[job_id] = {'pid': os.getpid(), 'cores': cores, 'numa_node': numa_node}
+        return cores, numa_node
+
+def _release_cores(*, dir: str, job_id: str):
+    with _CoreAllocations(dir) as allocations:
+        if job_id in allocations:
+            del allocations[job_id]
+
+class _CoreAllocations:
+    # The cores pinned to running jobs, shared by all job handlers on the node
+    # (stored in a json file protected by a lock file)
+    def __init__(self, dir: str):
+        self._fname = os.path.join(dir, 'core_allocations.json')
+        self._lock_file = None
+        self._allocations = {}
+    def __enter__(self) -> dict:
+        self._lock_file = open(self._fname + '.lock', 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        if os.path.exists(self._fname):
+            with open(self._fname, 'r') as f:
+                self._allocations = json.load(f)
+        # drop allocations of job handlers that are no longer running
+        self._allocations = {k: v for k, v in self._allocations.items() if _pid_exists(v['pid'])}
+        return self._allocations
+    def __exit__(self, exc_type, exc_value, traceback):
+        with open(self._fname, 'w') as f:
+            json.dump(self._allocations, f, indent=2)
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+        self._lock_file = None
+
+def _pid_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+if __name__ == '__main__':
+    # python job_resources.py <config> <cmd>... (see JobResourceLimiter.get_command)
+    config = json.loads(sys.argv[1])
+    usage_fname = config.pop('usage_fname')
+    _apply_limits(**config)
+    if usage_fname is None:
+        os.execvp(sys.argv[2], sys.argv[2:])
+    status = _run_job(sys.argv[2:], usage_fname=usage_fname)
+    if os.WIFSIGNALED(status):
+        # exit the same way as the job
+        signal.signal(os.WTERMSIG(status), signal.SIG_DFL)
+        os.kill(os.getpid(), os.WTERMSIG(status))
+    sys.exit(os.WEXITSTATUS(status))
@@ -1,7 +1,7 @@
 import fs from 'fs'
 import postNeurobassRequestFromComputeResource from "./postNeurobassRequestFromComputeResource"
 import PubsubClient from './PubsubClient'
-import JobManager from "./JobManager"
+import JobManager, { readContainerImagesReadiness } from "./JobManager"
 import { GetPubsubSubscriptionRequest, GetJobsRequest, SetComputeResourceSpecRequest } from "./types/NeurobassRequest"
 
 class JobExecutor {
@@ -97,6 +97,33 @@ class JobExecutor {
             setTimeout(doCheckForNewJobs, 1000 * 60 * 5)
         }
         doCheckForNewJobs()
+
+        // while container images are being pulled, check for pending jobs as soon as they become ready (or fail)
+        let lastPreparedImages = ''
+        const doCheckContainerImages = async () => {
+            if (this.#stopped) {
+                return
+            }
+            const readiness = readContainerImagesReadiness(this.a.dir)
+            if (!readiness) {
+                return
+            }
+            const imageStatuses = Object.values(readiness.images).map(x => x.status)
+            const preparedImages = Object.entries(readiness.images).filter(([, x]) => (x.status !== 'pending')).map(([k, x]) => `${k} (${x.status})`).join(', ')
+            if (preparedImages !== lastPreparedImages) {
+                lastPreparedImages = preparedImages
+                if (preparedImages) {
+                    console.info(`Container images prepared: ${preparedImages}`)
+                    await this._processPendingJobs()
+                }
+            }
+            if ((imageStatuses.length > 0) && (!imageStatuses.includes('pending'))) {
+                // all images have been either pulled or failed
+                return
+            }
+            setTimeout(doCheckContainerImages, 1000 * 15)
+        }
+        doCheckContainerImages()
     }
     private async _processPendingJobs() {
         if (this.#stopped) {
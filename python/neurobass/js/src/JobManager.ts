@@ -4,12 +4,17 @@ import path from 'path';
 import treeKill from 'tree-kill';
 import postNeurobassRequestFromComputeResource from "./postNeurobassRequestFromComputeResource";
 import { NBJob } from "./types/neurobass-types";
-import { GetJobRequest, NeurobassResponse } from "./types/NeurobassRequest";
+import { GetJobRequest, NeurobassResponse, SetJobPropertyRequest } from "./types/NeurobassRequest";
 
 const numSimultaneousJobs = parseInt(process.env.NUM_SIMULTANEOUS_JOBS || '1')
 
+// by default, the jobs are handled by a single "neurobass supervise" process
+// rather than by one "neurobass handle-job" process per job
+const useJobSupervisor = process.env.JOB_SUPERVISOR !== 'false'
+
 class JobManager {
     #runningJobs: RunningJob[] = []
+    #supervisor: ChildProcessWithoutNullStreams | null = null
     constructor(private config: {dir: string, onJobCompletedOrFailed: (job: RunningJob) => void}) {
 
     }
@@ -22,7 +27,14 @@ class JobManager {
         if (this.#runningJobs.length >= numSimultaneousJobs) {
             return false
         }
-        const a = new RunningJob(this.config.dir, job)
+
+        // don't start the job until the container images for the tool have been pulled
+        if (!this.toolIsReady(job.toolName)) {
+            console.info(`Container images for ${job.toolName} are not ready yet. Not starting job ${job.jobId}.`)
+            return false
+        }
+
+        const a = new RunningJob(this.config.dir, job, useJobSupervisor ? this._getSupervisor() : null)
         const okay = await a.initiate()
         if (okay) {
             this._addRunningJob(a)
@@ -31,6 +43,61 @@ class JobManager {
     }
     stop() {
         this.#runningJobs.forEach(j => j.stop())
+        if (this.#supervisor) {
+            try {
+                treeKill(this.#supervisor.pid)
+            }
+            catch (e) {
+                console.warn(e)
+                console.warn('Unable to kill job supervisor in JobManager:stop()')
+            }
+            this.#supervisor = null
+        }
+    }
+    private _getSupervisor(): ChildProcessWithoutNullStreams {
+        if (!this.#supervisor) {
+            console.info('Starting job supervisor')
+            const supervisor = spawn('neurobass', ['supervise'], {
+                cwd: this.config.dir
+            })
+            supervisor.stdout.on('data', (data) => {
+                process.stdout.write(data)
+            })
+            supervisor.stderr.on('data', (data) => {
+                process.stderr.write(data)
+            })
+            supervisor.on('error', (err) => {
+                console.warn(err)
+            })
+            // e.g., EPIPE if the supervisor exited (the job is then never claimed, see RunningJob:initiate())
+            supervisor.stdin.on('error', (err) => {
+                console.warn(`Unable to send job to job supervisor: ${err.message}`)
+            })
+            supervisor.on('exit', (code) => {
+                console.warn(`Job supervisor exited with code ${code}`)
+                if (this.#supervisor === supervisor) {
+                    this.#supervisor = null
+                }
+                // the jobs it was handling would otherwise remain running forever
+                // (a new supervisor is started for the next job)
+                this.#runningJobs.filter(j => j.isHandledBy(supervisor)).forEach(j => {
+                    j.fail(`Job supervisor exited with code ${code}`).catch(err => {
+                        console.warn(`Unable to fail job ${j.job.jobId}: ${err.message}`)
+                    })
+                })
+            })
+            this.#supervisor = supervisor
+        }
+        return this.#supervisor
+    }
+    toolIsReady(toolName: string): boolean {
+        // container_images.json is written by the python side when the node starts
+        const readiness = readContainerImagesReadiness(this.config.dir)
+        if (!readiness) return true
+        const t = readiness.tools[toolName]
+        if (!t) return true
+        // if the images could not be pulled, the job is started anyway so that the handler fails it with the error
+        return t.ready || !!t.error
     }
     async cleanupOldJobs() {
         // list all folders in jobs directory
@@ -97,38 +164,62 @@ class JobManager {
     }
 }
 
+export type ContainerImagesReadiness = {
+    container_method: string
+    images: {[image: string]: {status: 'pending' | 'ready' | 'failed', error?: string}}
+    tools: {[toolName: string]: {ready: boolean, error?: string | null}}
+}
+
+export const readContainerImagesReadiness = (dir: string): ContainerImagesReadiness | undefined => {
+    const fname = path.join(dir, 'container_images.json')
+    if (!fs.existsSync(fname)) return undefined
+    try {
+        return JSON.parse(fs.readFileSync(fname, 'utf8'))
+    }
+    catch (err) {
+        console.warn(`Unable to read ${fname}: ${err.message}`)
+        return undefined
+    }
+}
+
 export class RunningJob {
     #onCompletedOrFailedCallbacks: (() => void)[] = []
     #childProcess: ChildProcessWithoutNullStreams | null = null
     #status: 'pending' | 'queued' | 'running' | 'completed' | 'failed' = 'pending'
     #stopped = false
-    constructor(private dir: string, public job: NBJob) {
+    constructor(private dir: string, public job: NBJob, private supervisor: ChildProcessWithoutNullStreams | null) {
     }
     async initiate(): Promise<boolean> {
         if (this.#childProcess) {
             throw Error('Unexpected: Child process already running')
         }
         console.info(`Initiating job: ${this.job.jobId} - ${this.job.toolName}`)
-        
-        const cmd = 'neurobass'
-        const args = ['handle-job', '--job-id', this.job.jobId]
 
-        this.#childProcess = spawn(cmd, args, {
-            cwd: this.dir
-        })
+        if (this.supervisor) {
+            // the supervisor reads the job IDs from its stdin, one per line
+            this.supervisor.stdin.write(`${this.job.jobId}\n`)
+        }
+        else {
+            const cmd = 'neurobass'
+            const args = ['handle-job', '--job-id', this.job.jobId]
 
-        this.#childProcess.on('error', (err) => {
-            console.warn(err)
-            this._updateStatus()
-        })
+            this.#childProcess = spawn(cmd, args, {
+                cwd: this.dir
+            })
 
-        this.#childProcess.on('exit', (code) => {
-            this._updateStatus()
-        })
+            this.#childProcess.on('error', (err) => {
+                console.warn(err)
+                this._updateStatus()
+            })
 
-        this.#childProcess.on('close', (code) => {
-            this._updateStatus()
-        })
+            this.#childProcess.on('exit', (code) => {
+                this._updateStatus()
+            })
+
+            this.#childProcess.on('close', (code) => {
+                this._updateStatus()
+            })
+        }
 
         const timer = Date.now()
         while (Date.now() - timer < 20000) {
@@ -166,7 +257,32 @@ export class RunningJob {
     onCompletedOrFailed(callback: () => void) {
         this.#onCompletedOrFailedCallbacks.push(callback)
     }
+    isHandledBy(supervisor: ChildProcessWithoutNullStreams) {
+        return this.supervisor === supervisor
+    }
+    async fail(error: string) {
+        // for a job whose handler is gone (e.g., the job supervisor exited)
+        if (this.#status !== 'running') return
+        console.warn(`Setting job ${this.job.jobId} to failed: ${error}`)
+        for (const [property, value] of [['error', error], ['status', 'failed']]) {
+            const req: SetJobPropertyRequest = {
+                type: 'setJobProperty',
+                timestamp: Date.now() / 1000,
+                workspaceId: this.job.workspaceId,
+                projectId: this.job.projectId,
+                jobId: this.job.jobId,
+                property,
+                value
+            }
+            const resp = await this._postNeurobassRequest(req)
+            if ((resp.type !== 'setJobProperty') || (!resp.success)) {
+                console.warn(`Unable to set job ${property}`, resp)
+            }
+        }
+        await this._updateStatus()
+    }
     stop() {
+        // (jobs handled by the supervisor are stopped along with it, see JobManager:stop())
         if (this.#childProcess) {
             try {
                 treeKill(this.#childProcess.pid)
@@ -175,8 +291,8 @@ export class RunningJob {
                 console.warn(e)
                 console.warn('Unable to kill child process in RunningJob:stop()')
             }
-            this.#stopped = true
         }
+        this.#stopped = true
     }
     public get status() {
         return this.#status
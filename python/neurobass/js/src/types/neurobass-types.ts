@@ -83,6 +83,7 @@ export type NBJob = {
     computeResourceNodeId?: string
     computeResourceNodeName?: string
     consoleOutput?: string
+    metrics?: any
     timestampQueued?: number
     timestampRunning?: number
     timestampFinished?: number
@@ -119,6 +120,7 @@ export const isNBJob = (x: any): x is NBJob => {
         computeResourceNodeId: optional(isString),
         computeResourceNodeName: optional(isString),
         consoleOutput: optional(isString),
+        metrics: optional(() => true),
         timestampQueued: optional(isNumber),
         timestampRunning: optional(isNumber),
         timestampFinished: optional(isNumber),
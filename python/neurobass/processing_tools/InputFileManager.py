@@ -0,0 +1,86 @@
+from typing import Dict
+from ..NeurobassPluginTypes import NeurobassProcessingToolContext, InputFile
+
+
+class InputFileManager:
+    """Opens each input file of a job at most once and shares the handle
+
+    Reopening a remote HDF5 file repeats the superblock and metadata traversal,
+    so all readers within a job (recording, metadata, etc.) should go through
+    the same manager. Inputs available on storage mounted on the node (see
+    input_paths.py) are opened directly.
+    """
+    def __init__(self, context: NeurobassProcessingToolContext, *, disk_cache_dir: str='/tmp/remfile_cache'):
+        self._context = context
+        self._disk_cache_dir = disk_cache_dir
+        self._h5py_files: Dict[str, 'h5py.File'] = {}
+    def get_h5py_file(self, input_file: InputFile) -> 'h5py.File':
+        """Get the (shared) open h5py file for an input
+
+        Args:
+            input_file (InputFile): the input file
+
+        Returns:
+            h5py.File: the open file, in read-only mode
+        """
+        import h5py
+        if input_file.name not in self._h5py_files:
+            local_path = self._context.get_input_file_local_path(input_file)
+            if local_path is not None:
+                # on storage mounted on the node - no HTTP and no remfile cache
+                print(f'Opening local input file: {local_path}')
+                self._context.counter('input_local_files', 1)
+                with self._context.span('open_input'):
+                    self._h5py_files[input_file.name] = h5py.File(local_path, 'r')
+            else:
+                import remfile
+                url = self._context.get_input_file_url(input_file)
+                disk_cache = remfile.DiskCache(self._disk_cache_dir)
+                remf = remfile.File(url, disk_cache=disk_cache)
+                with self._context.span('open_input'):
+                    self._h5py_files[input_file.name] = h5py.File(_CountingFile(remf, self._context), 'r')
+        return self._h5py_files[input_file.name]
+    def get_meta_h5py_file(self, url: str) -> 'h5py.File':
+        """Get the (shared) open h5py file for the meta file of an input (see create_nwb_meta_file)
+
+        Args:
+            url (str): the URL of the meta file
+
+        Returns:
+            h5py.File: the open file, in read-only mode
+        """
+        import h5py
+        from ..input_paths import resolve_local_path
+        key = f'meta:{url}'
+        if key not in self._h5py_files:
+            local_path = resolve_local_path(url)
+            if local_path is not None:
+                self._h5py_files[key] = h5py.File(local_path, 'r')
+            else:
+                import remfile
+                disk_cache = remfile.DiskCache(self._disk_cache_dir)
+                remf = remfile.File(url, disk_cache=disk_cache)
+                with self._context.span('open_meta_file'):
+                    self._h5py_files[key] = h5py.File(_CountingFile(remf, self._context), 'r')
+        return self._h5py_files[key]
+    def close(self):
+        for f in self._h5py_files.values():
+            f.close()
+        self._h5py_files = {}
+
+class _CountingFile:
+    # File-like wrapper that reports the bytes read through it to the job metrics
+    def __init__(self, f, context: NeurobassProcessingToolContext):
+        self._f = f
+        self._context = context
+    def read(self, size: int=-1):
+        x = self._f.read(size)
+        self._context.counter('input_bytes_read', len(x))
+        self._context.counter('input_read_calls', 1)
+        return x
+    def seek(self, offset: int, whence: int=0):
+        return self._f.seek(offset, whence)
+    def tell(self):
+        return self._f.tell()
+    def close(self):
+        return self._f.close()
@@ -0,0 +1,62 @@
+import os
+from typing import List
+from pydantic import BaseModel, Field
+from ...NeurobassPluginTypes import NeurobassProcessingTool, NeurobassProcessingToolContext, InputFile, OutputFile
+from ..InputFileManager import InputFileManager
+from .create_nwb_meta_file import create_nwb_meta_file
+
+
+class NwbMetaFileModel(BaseModel):
+    """Create the meta file of an NWB file: a compact HDF5 file with all the groups, attributes and small datasets of the NWB file (but not the data of the large datasets), plus the location of each chunk of the large datasets.
+The web app and the processing tools can read the metadata from it instead of traversing the (possibly very large) NWB file.
+    """
+    input: InputFile = Field(..., description="Input NWB file")
+    output: OutputFile = Field(..., description="Output meta file (.h5)")
+    max_inline_bytes: int = Field(64 * 1024, description="Datasets up to this size (in bytes) are copied to the meta file")
+    include_chunk_index: bool = Field(True, description="Whether to record the location of each chunk of the large datasets")
+    use_job_cache: bool = Field(True, description="Reuse the output of a previous identical job (same input, parameters and tool version) if available")
+
+class NwbMetaFileProcessingTool(NeurobassProcessingTool):
+    @classmethod
+    def get_name(cls) -> str:
+        return "nwb_meta_file"
+    @classmethod
+    def get_attributes(cls) -> dict:
+        return {
+            'wip': False,
+            'label': 'NWB meta file',
+            'cacheable': True
+        }
+    @classmethod
+    def get_tags(cls) -> List[str]:
+        return ['nwb', 'utility']
+    @classmethod
+    def get_model(cls) -> BaseModel:
+        return NwbMetaFileModel
+    @classmethod
+    def run(cls, context: NeurobassProcessingToolContext):
+        _run(context)
+
+def _run(context: NeurobassProcessingToolContext):
+    working_dir = 'working'
+    os.mkdir(working_dir)
+
+    data = context.get_validated_data(NwbMetaFileModel)
+
+    input_files = InputFileManager(context)
+    f = input_files.get_h5py_file(data.input)
+
+    meta_fname = f'{working_dir}/meta.h5'
+    with context.span('create_meta_file'):
+        stats = create_nwb_meta_file(
+            f,
+            meta_fname,
+            max_inline_bytes=data.max_inline_bytes,
+            include_chunk_index=data.include_chunk_index
+        )
+    print(f'Meta file: {stats["num_groups"]} groups, {stats["num_datasets"]} datasets ({stats["num_inline_datasets"]} inline), {stats["num_chunks"]} chunks, {os.path.getsize(meta_fname)} bytes')
+    context.counter('meta_file_bytes', os.path.getsize(meta_fname))
+    input_files.close()
+
+    print('Uploading output file')
+    context.upload_output_file(data.output, meta_fname)
@@ -0,0 +1,8 @@
+from neurobass import NeurobassPluginContext, NeurobassPlugin
+from ...NeurobassPluginTypes import NeurobassPluginContext
+from .NwbMetaFileProcessingTool import NwbMetaFileProcessingTool
+
+class NwbMetaPlugin(NeurobassPlugin):
+    @classmethod
+    def initialize(cls, context: NeurobassPluginContext):
+        context.register_processing_tool(NwbMetaFileProcessingTool)
\ No newline at end of file
@@ -0,0 +1,231 @@
+from typing import Dict, Union
+import numpy as np
+import h5py
+
+
+# A meta file is a compact HDF5 companion of an NWB file (see RemoteH5File in
+# the web app, which takes it as metaUrl). It has the same groups, links,
+# attributes and datasets as the NWB file, with the data of the small
+# datasets copied. The large datasets have the same shape, dtype and
+# chunking but their storage is never allocated, so they take no space; their
+# data must be read from the NWB file itself.
+#
+# For each large dataset, the location of its data in the NWB file is
+# recorded in a chunk table (one row per chunk: the chunk offset in each
+# dimension, then the byte offset, the size in bytes and the filter mask) in
+# the /neurobass_meta/chunk_index group, so that the data can be fetched with
+# plain byte-range requests without traversing the chunk B-tree.
+
+_chunk_index_group = 'neurobass_meta/chunk_index'
+
+def create_nwb_meta_file(
+    file: h5py.File,
+    meta_fname: str,
+    *,
+    max_inline_elements: int=100,
+    max_inline_bytes: int=64 * 1024,
+    include_chunk_index: bool=True
+) -> dict:
+    """Write the meta file of an open NWB file
+
+    Args:
+        file (h5py.File): the open NWB file (may be remote)
+        meta_fname (str): the output meta file
+        max_inline_elements (int): datasets with at most this many elements are always copied (RemoteH5File reads these from the meta file)
+        max_inline_bytes (int): datasets of at most this size are also copied
+        include_chunk_index (bool): whether to write the chunk tables of the large datasets
+
+    Returns:
+        dict: {num_groups, num_datasets, num_inline_datasets, num_chunks} - a summary of what was written
+    """
+    stats = {'num_groups': 0, 'num_datasets': 0, 'num_inline_datasets': 0, 'num_chunks': 0}
+    with h5py.File(meta_fname, 'w') as meta:
+        # first create all the objects, then copy the attributes and the
+        # inline data (object references need their target to exist)
+        objects = {}  # object id in the NWB file -> path in the meta file
+        copied = [(file, meta)]
+        inline_datasets = []
+        large_datasets = []
+        def visit(src_group: h5py.Group, dst_group: h5py.Group):
+            for name in src_group.keys():
+                link = src_group.get(name, getlink=True)
+                if isinstance(link, h5py.SoftLink):
+                    dst_group[name] = h5py.SoftLink(link.path)
+                    continue
+                if isinstance(link, h5py.ExternalLink):
+                    dst_group[name] = h5py.ExternalLink(link.filename, link.path)
+                    continue
+                obj = src_group[name]
+                if obj.id in objects:
+                    # another hard link to an object that was already copied
+                    dst_group[name] = meta[objects[obj.id]]
+                    continue
+                if isinstance(obj, h5py.Group):
+                    dst = dst_group.create_group(name)
+                    objects[obj.id] = dst.name
+                    copied.append((obj, dst))
+                    stats['num_groups'] += 1
+                    visit(obj, dst)
+                elif isinstance(obj, h5py.Dataset):
+                    inline = _is_inline(obj, max_inline_elements=max_inline_elements, max_inline_bytes=max_inline_bytes)
+                    dst = _create_dataset(dst_group, name, obj)
+                    objects[obj.id] = dst.name
+                    copied.append((obj, dst))
+                    stats['num_datasets'] += 1
+                    if inline:
+                        inline_datasets.append((obj, dst))
+                        stats['num_inline_datasets'] += 1
+                    else:
+                        large_datasets.append(obj)
+        objects[file.id] = '/'
+        visit(file, meta)
+
+        def copy_attrs(src, dst):
+            for k, v in src.attrs.items():
+                try:
+                    v = _convert_references(v, file, meta, objects)
+                except _UnresolvedReference:
+                    continue
+                dst.attrs[k] = v
+        for src, dst in copied:
+            copy_attrs(src, dst)
+        for src, dst in inline_datasets:
+            if src.shape is None:
+                continue
+            x = src[()]
+            if h5py.check_dtype(ref=src.dtype) is not None:
+                try:
+                    x = _convert_references(x, file, meta, objects)
+                except _UnresolvedReference:
+                    continue
+            dst[()] = x
+
+        if include_chunk_index:
+            index_group = meta.create_group(_chunk_index_group)
+            for i, ds in enumerate(large_datasets):
+                table, layout = _get_chunk_table(ds)
+                if table is None:
+                    continue
+                x = index_group.create_dataset(str(i), data=table)
+                x.attrs['path'] = ds.name
+                x.attrs['layout'] = layout
+                x.attrs['chunks'] = ds.chunks if ds.chunks is not None else ds.shape
+                x.attrs['filters'] = _get_filter_codes(ds)
+                stats['num_chunks'] += len(table)
+    return stats
+
+def read_chunk_index(meta_file: h5py.File) -> Dict[str, dict]:
+    """Read the chunk tables of a meta file
+
+    Returns:
+        Dict[str, dict]: for each large dataset path, {layout, chunks, filters, chunk_offsets, byte_offsets, sizes, filter_masks}
+    """
+    ret = {}
+    if _chunk_index_group not in meta_file:
+        return ret
+    for x in meta_file[_chunk_index_group].values():
+        table = x[()]
+        ndim = table.shape[1] - 3
+        ret[x.attrs['path']] = {
+            'layout': x.attrs['layout'],
+            'chunks': tuple(int(c) for c in x.attrs['chunks']),
+            'filters': [int(c) for c in x.attrs['filters']],
+            'chunk_offsets': table[:, :ndim],
+            'byte_offsets': table[:, ndim],
+            'sizes': table[:, ndim + 1],
+            'filter_masks': table[:, ndim + 2]
+        }
+    return ret
+
+def get_meta_dataset(meta_file: Union[h5py.File, None], file: h5py.File, path: str) -> h5py.Dataset:
+    """Get a dataset from the meta file if its data was copied there, otherwise from the NWB file
+
+    Args:
+        meta_file (Union[h5py.File, None]): the meta file (if None, the NWB file is used)
+        file (h5py.File): the NWB file
+        path (str): path of the dataset
+
+    Returns:
+        h5py.Dataset: the dataset
+    """
+    if meta_file is not None and path in meta_file:
+        ds = meta_file[path]
+        if isinstance(ds, h5py.Dataset) and (ds.size == 0 or ds.id.get_storage_size() > 0):
+            return ds
+    return file[path]
+
+class _UnresolvedReference(Exception):
+    pass
+
+def _is_inline(ds: h5py.Dataset, *, max_inline_elements: int, max_inline_bytes: int) -> bool:
+    if ds.shape is None:
+        # null dataspace
+        return True
+    if ds.dtype.fields is not None and any(h5py.check_dtype(ref=t[0]) is not None for t in ds.dtype.fields.values()):
+        # compound with references (e.g., TimeSeriesReferenceVectorData) - not converted
+        return False
+    if ds.size <= max_inline_elements:
+        return True
+    return ds.size * ds.dtype.itemsize <= max_inline_bytes
+
+def _create_dataset(group: h5py.Group, name: str, ds: h5py.Dataset) -> h5py.Dataset:
+    # the same shape and chunking; the storage is only allocated if data is written
+    if ds.shape is None:
+        return group.create_dataset(name, data=h5py.Empty(ds.dtype))
+    dtype = h5py.ref_dtype if h5py.check_dtype(ref=ds.dtype) is not None else ds.dtype
+    kwargs = {}
+    if ds.fillvalue is not None and ds.dtype.kind in 'iufb':
+        kwargs['fillvalue'] = ds.fillvalue
+    return group.create_dataset(name, shape=ds.shape, dtype=dtype, maxshape=ds.maxshape if ds.chunks is not None else None, chunks=ds.chunks, **kwargs)
+
+def _convert_references(x, file: h5py.File, meta: h5py.File, objects: dict):
+    # object references point into the NWB file - point them to the same objects in the meta file
+    def convert(ref):
+        if isinstance(ref, h5py.RegionReference):
+            raise _UnresolvedReference()
+        if not ref:
+            return ref
+        try:
+            target = file[ref]
+        except Exception:
+            raise _UnresolvedReference()
+        path = objects.get(target.id, None)
+        if path is None:
+            raise _UnresolvedReference()
+        return meta[path].ref
+    if isinstance(x, h5py.Reference):
+        return convert(x)
+    if isinstance(x, np.ndarray) and x.dtype == object and x.size > 0 and isinstance(x.flat[0], h5py.Reference):
+        ret = np.empty(x.shape, dtype=h5py.ref_dtype)
+        for i, ref in enumerate(x.flat):
+            ret.flat[i] = convert(ref)
+        return ret
+    return x
+
+def _get_filter_codes(ds: h5py.Dataset) -> list:
+    plist = ds.id.get_create_plist()
+    return [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+
+def _get_chunk_table(ds: h5py.Dataset):
+    ndim = len(ds.shape)
+    if ds.chunks is None:
+        offset = ds.id.get_offset()
+        if offset is None:
+            # not allocated, or compact
+            return None, None
+        table = np.zeros((1, ndim + 3), dtype=np.int64)
+        table[0, ndim] = offset
+        table[0, ndim + 1] = ds.id.get_storage_size()
+        return table, 'contiguous'
+    rows = []
+    def add(info):
+        rows.append(list(info.chunk_offset) + [info.byte_offset, info.size, info.filter_mask])
+    try:
+        # a single traversal of the chunk B-tree (HDF5 >= 1.12.3 / 1.14)
+        ds.id.chunk_iter(add)
+    except (AttributeError, RuntimeError, NotImplementedError):
+        rows = []
+        for i in range(ds.id.get_num_chunks()):
+            add(ds.id.get_chunk_info(i))
+    table = np.array(rows, dtype=np.int64).reshape(len(rows), ndim + 3)
+    return table, 'chunked'
@@ -3,12 +3,11 @@ import json
 from typing import List
 from pydantic import BaseModel, Field
 from ...NeurobassPluginTypes import NeurobassProcessingTool, NeurobassProcessingToolContext, InputFile, OutputFile
-import pynwb
-import h5py
-import remfile
 import spikeinterface as si
 import spikeinterface.preprocessing as spre
+from ..InputFileManager import InputFileManager
 from .NwbRecording import NwbRecording
+from .NwbMetadata import NwbFileMetadata
 from .create_sorting_out_nwb_file import create_sorting_out_nwb_file
     
 
@@ -24,6 +23,11 @@ For more information see https://github.com/MouseLand/Kilosort
     input: InputFile = Field(..., description="Input NWB file")
     output: OutputFile = Field(..., description="Output NWB file")
     electrical_series_path: str = Field(..., description="Path to the electrical series in the NWB file, e.g., /acquisition/ElectricalSeries")
+    additional_electrical_series_paths: List[str] = Field([], description="Paths to additional electrical series in the NWB file to sort together with the first one, concatenated in time (they must have the same sampling rate and channels)")
+    start_time_sec: float = Field(None, description="Start of the time window to sort, in seconds relative to the start of the recording (if None, start from the beginning)")
+    end_time_sec: float = Field(None, description="End of the time window to sort, in seconds relative to the start of the recording (if None, sort to the end)")
+    channel_ids: List[int] = Field([], description="Subset of channel ids to sort (if empty, all channels are sorted)")
+    input_meta_url: str = Field('', description="URL of the meta file of the input NWB file (see the nwb_meta_file tool), if available - the metadata is then read from it rather than from the input")
     
     detect_threshold: float = Field(6, description="Threshold for spike detection", group=sorting_params_group)
     projection_threshold: List[float] = Field([10, 4], description="Threshold on projections", group=sorting_params_group)
@@ -70,20 +74,24 @@ def _run(context: NeurobassProcessingToolContext):
     working_dir = 'working'
     os.mkdir(working_dir)
 
-    data = Kilosort2p5Model(**context.get_data())
-
-    nwb_url = context.get_input_file_url(data.input)
+    data = context.get_validated_data(Kilosort2p5Model)
 
     recording_electrical_series_path = data.electrical_series_path
 
-    # open the remote file
-    disk_cache = remfile.DiskCache('/tmp/remfile_cache')
-    remf = remfile.File(nwb_url, disk_cache=disk_cache)
-    f = h5py.File(remf, 'r')
+    # open the remote file (once - the handle is shared for the rest of the job)
+    input_files = InputFileManager(context)
+    f = input_files.get_h5py_file(data.input)
+    meta_f = input_files.get_meta_h5py_file(data.input_meta_url) if data.input_meta_url else None
 
     recording = NwbRecording(
         file=f,
-        electrical_series_path=recording_electrical_series_path
+        electrical_series_path=[recording_electrical_series_path] + data.additional_electrical_series_paths,
+        start_time_sec=data.start_time_sec,
+        end_time_sec=data.end_time_sec,
+        channel_ids=data.channel_ids,
+        concatenate=True,
+        num_decode_threads=context.get_num_jobs(),
+        meta_file=meta_f
     )
 
     if working_dir == 'working':
@@ -92,13 +100,18 @@ def _run(context: NeurobassProcessingToolContext):
     # placeholder
     sorting = si.NpzSortingExtractor()
 
-    with pynwb.NWBHDF5IO(file=h5py.File(remf, 'r'), mode='r') as io:
-        nwbfile_rec = io.read()
-        
-        if not os.path.exists('output'):
-            os.mkdir('output')
-        sorting_out_fname = 'output/sorting.nwb'
+    # read only the session/subject metadata, without io.read()
+    nwbfile_rec = NwbFileMetadata(meta_f if meta_f is not None else f)
+
+    if not os.path.exists('output'):
+        os.mkdir('output')
+    sorting_out_fname = 'output/sorting.nwb'
 
-        create_sorting_out_nwb_file(nwbfile_rec=nwbfile_rec, sorting=sorting, sorting_out_fname=sorting_out_fname)
+    create_sorting_out_nwb_file(
+        nwbfile_rec=nwbfile_rec,
+        sorting=sorting,
+        sorting_out_fname=sorting_out_fname,
+        spike_time_offset_sec=recording.get_start_time_offset_sec()
+    )
 
     context.upload_output_file(data.output, sorting_out_fname)
\ No newline at end of file
@@ -1,16 +1,19 @@
 import os
+import json
 from typing import List
 from pydantic import BaseModel, Field
 from ...NeurobassPluginTypes import NeurobassProcessingTool, NeurobassProcessingToolContext, InputFile, OutputFile
 import numpy as np
-import pynwb
-import h5py
-import remfile
 import spikeinterface as si
 import spikeinterface.preprocessing as spre
+from ..InputFileManager import InputFileManager
 from .NwbRecording import NwbRecording
+from .NwbMetadata import NwbFileMetadata
 from .create_sorting_out_nwb_file import create_sorting_out_nwb_file
+from .helpers.unit_summaries import compute_unit_summaries
+from .helpers.extract_templates import extract_templates
 from .helpers.run_kilosort3 import run_kilosort3
+from .helpers.write_binary_recording import write_int16_binary_recording
 
 
 sorting_params_group = 'sorting_params'
@@ -26,6 +29,13 @@ For more information see https://github.com/MouseLand/Kilosort
     input: InputFile = Field(..., description="Input NWB file")
     output: OutputFile = Field(..., description="Output NWB file")
     electrical_series_path: str = Field(..., description="Path to the electrical series in the NWB file, e.g., /acquisition/ElectricalSeries")
+    additional_electrical_series_paths: List[str] = Field([], description="Paths to additional electrical series in the NWB file to sort together with the first one, concatenated in time (they must have the same sampling rate and channels)")
+    start_time_sec: float = Field(None, description="Start of the time window to sort, in seconds relative to the start of the recording (if None, start from the beginning)")
+    end_time_sec: float = Field(None, description="End of the time window to sort, in seconds relative to the start of the recording (if None, sort to the end)")
+    channel_ids: List[int] = Field([], description="Subset of channel ids to sort (if empty, all channels are sorted)")
+    input_meta_url: str = Field('', description="URL of the meta file of the input NWB file (see the nwb_meta_file tool), if available - the metadata is then read from it rather than from the input")
+    use_job_cache: bool = Field(True, description="Reuse the output of a previous identical job (same input, parameters and tool version) if available")
+    extract_templates: bool = Field(False, description="After sorting, extract the templates (mean waveforms) and the spike amplitudes, and add them to the output")
     
     detect_threshold: float = Field(6, description="Threshold for spike detection", group=sorting_params_group)
     projection_threshold: List[float] = Field([9, 9], description="Threshold on projections", group=sorting_params_group)
@@ -41,7 +51,7 @@ For more information see https://github.com/MouseLand/Kilosort
     ntbuff: int = Field(64, description="Samples of symmetrical buffer for whitening and spike detection", group=sorting_params_group)
     nfilt_factor: int = Field(4, description="Max number of clusters per good channel (even temporary ones) 4", group=sorting_params_group)
     do_correction: bool = Field(True, description="If True drift registration is applied", group=sorting_params_group)
-    NT: int = Field(None, description="Batch size (if None it is automatically computed)", group=sorting_params_group)
+    NT: int = Field(None, description="Batch size (if None it is planned from the number of channels, the sampling rate and the available GPU and host memory)", group=sorting_params_group)
     AUCsplit: float = Field(0.8, description="Threshold on the area under the curve (AUC) criterion for performing a split in the final step", group=sorting_params_group)
     wave_length: int = Field(61, description="size of the waveform extracted around each detected peak, (Default 61, maximum 81)", group=sorting_params_group)
     keep_good_only: bool = Field(False, description="If True only 'good' units are returned", group=sorting_params_group)
@@ -56,7 +66,10 @@ class Kilosort3ProcessingTool(NeurobassProcessingTool):
     def get_attributes(cls) -> dict:
         return {
             'wip': True,
-            'label': 'Kilosort 3'
+            'label': 'Kilosort 3',
+            'container_images': ['spikeinterface/kilosort3-compiled-base'],
+            'cacheable': True,
+            'cache_dependencies': ['spikeinterface']
         }
     @classmethod
     def get_tags(cls) -> List[str]:
@@ -72,26 +85,38 @@ def _run(context: NeurobassProcessingToolContext):
     working_dir = 'working'
     os.mkdir(working_dir)
 
-    data = Kilosort3Model(**context.get_data())
-
-    nwb_url = context.get_input_file_url(data.input)
+    data = context.get_validated_data(Kilosort3Model)
 
     recording_electrical_series_path = data.electrical_series_path
 
-    # open the remote file
-    disk_cache = remfile.DiskCache('/tmp/remfile_cache')
-    remf = remfile.File(nwb_url, disk_cache=disk_cache)
-    f = h5py.File(remf, 'r')
+    # open the remote file (once - the handle is shared for the rest of the job)
+    input_files = InputFileManager(context)
+    f = input_files.get_h5py_file(data.input)
+    meta_f = input_files.get_meta_h5py_file(data.input_meta_url) if data.input_meta_url else None
 
     recording = NwbRecording(
         file=f,
-        electrical_series_path=recording_electrical_series_path
+        electrical_series_path=[recording_electrical_series_path] + data.additional_electrical_series_paths,
+        start_time_sec=data.start_time_sec,
+        end_time_sec=data.end_time_sec,
+        channel_ids=data.channel_ids,
+        concatenate=True,
+        num_decode_threads=context.get_num_jobs(),
+        meta_file=meta_f
     )
 
+    # the stages are checkpointed, so that a retried job resumes from the last completed one
+    checkpoints = context.get_checkpoints()
+
     # important to make a binary recording so that it can be serialized in the format expected by kilosort
     # it's important that it's a single segment with int16 dtype
     # during this step, the entire recording will be downloaded to disk
-    recording2 = _make_binary_recording(recording)
+    binary_recording_dir = checkpoints.get_stage_dir('binary_recording')
+    if not checkpoints.is_complete('binary_recording'):
+        with context.span('download'):
+            _make_binary_recording(recording, binary_recording_dir, num_workers=context.get_num_jobs())
+        checkpoints.complete('binary_recording')
+    recording2 = _load_binary_recording(recording, binary_recording_dir)
 
     # run kilosort3 in the container
     container_method = os.getenv('CONTAINER_METHOD', 'none')
@@ -117,37 +142,80 @@ def _run(context: NeurobassProcessingToolContext):
         'skip_kilosort_preprocessing': data.skip_kilosort_preprocessing,
         'scaleproc': data.scaleproc
     }
-    sorting = run_kilosort3(
-        recording=recording2,
-        sorting_params=sorting_params,
-        output_folder=working_dir,
-        use_docker=container_method == 'docker',
-        use_singularity=container_method == 'singularity'
-    )
+    sorting_dir = checkpoints.get_stage_dir('sorting')
+    if not checkpoints.is_complete('sorting'):
+        with context.span('sort'):
+            sorting = run_kilosort3(
+                recording=recording2,
+                sorting_params=sorting_params,
+                output_folder=working_dir,
+                use_docker=container_method == 'docker',
+                use_singularity=container_method == 'singularity'
+            )
+        si.NpzSortingExtractor.write_sorting(sorting, f'{sorting_dir}/sorting.npz')
+        checkpoints.complete('sorting')
+    sorting = si.NpzSortingExtractor(f'{sorting_dir}/sorting.npz')
+
+    output_dir = checkpoints.get_stage_dir('output')
+    sorting_out_fname = f'{output_dir}/sorting.nwb'
+    if not checkpoints.is_complete('output'):
+        recording_filtered = spre.bandpass_filter(recording2, freq_min=data.freq_min, freq_max=6000)
+
+        # per-unit summaries (firing rates, autocorrelograms, ...) for the viewers
+        with context.span('unit_summaries'):
+            unit_summaries = compute_unit_summaries(
+                sorting,
+                num_frames=recording.get_num_samples(),
+                recording=recording_filtered
+            )
 
-    with pynwb.NWBHDF5IO(file=h5py.File(remf, 'r'), mode='r') as io:
-        nwbfile_rec = io.read()
-        
-        if not os.path.exists('output'):
-            os.mkdir('output')
-        sorting_out_fname = 'output/sorting.nwb'
+        templates = None
+        if data.extract_templates:
+            with context.span('extract_templates'):
+                templates = extract_templates(
+                    recording_filtered,
+                    sorting,
+                    working_dir=working_dir,
+                    num_workers=context.get_num_jobs()
+                )
+
+        # read only the session/subject metadata, without io.read()
+        nwbfile_rec = NwbFileMetadata(meta_f if meta_f is not None else f)
+
+        with context.span('write_nwb'):
+            create_sorting_out_nwb_file(
+                nwbfile_rec=nwbfile_rec,
+                sorting=sorting,
+                sorting_out_fname=sorting_out_fname,
+                spike_time_offset_sec=recording.get_start_time_offset_sec(),
+                unit_summaries=unit_summaries,
+                templates=templates
+            )
+        checkpoints.complete('output')
 
-        create_sorting_out_nwb_file(nwbfile_rec=nwbfile_rec, sorting=sorting, sorting_out_fname=sorting_out_fname)
-        
     context.upload_output_file(data.output, sorting_out_fname)
 
-def _make_binary_recording(recording: si.BaseRecording) -> si.BinaryRecordingExtractor:
-    os.mkdir('binary_recording')
-    fname = 'binary_recording/recording.dat'
-    if recording.get_num_segments() != 1:
-        raise NotImplementedError("Can only write recordings with a single segment")
-    if recording.get_dtype() != np.int16:
-        raise NotImplementedError("Can only write recordings with dtype int16") # important so it won't be rewritten for kilosort3
-    si.BinaryRecordingExtractor.write_recording(
-        recording=recording,
-        file_paths=[fname],
-        dtype='int16'
+def _make_binary_recording(recording: si.BaseRecording, dir: str, chunk_duration_sec: float=10, num_workers: int=1):
+    fname = f'{dir}/recording.dat'
+    # kilosort expects a single int16 segment, so the segments are streamed one
+    # after the other into the same file, and recordings of other dtypes
+    # (e.g., float32) are scaled to int16 while streaming
+    scaling = write_int16_binary_recording(
+        recording,
+        fname,
+        chunk_duration_sec=chunk_duration_sec,
+        num_workers=num_workers
     )
+    if scaling['scales'] is not None:
+        print(f'Converted {recording.get_dtype()} to int16 with per-channel scales in [{min(scaling["scales"]):.4g}, {max(scaling["scales"]):.4g}]')
+    # the gains needed to map the int16 values (and therefore output amplitudes) back to microvolts
+    with open(f'{dir}/scaling.json', 'w') as f:
+        json.dump(scaling, f)
+
+def _load_binary_recording(recording: si.BaseRecording, dir: str) -> si.BinaryRecordingExtractor:
+    fname = f'{dir}/recording.dat'
+    with open(f'{dir}/scaling.json', 'r') as f:
+        scaling = json.load(f)
     ret = si.BinaryRecordingExtractor(
         file_paths=[fname],
         sampling_frequency=recording.get_sampling_frequency(),
@@ -156,4 +224,6 @@ def _make_binary_recording(recording: si.BaseRecording) -> si.BinaryRecordingExt
         dtype='int16'
     )
     ret.set_channel_locations(recording.get_channel_locations())
-    return ret
\ No newline at end of file
+    ret.set_channel_gains(scaling['gain_to_uV'])
+    ret.set_channel_offsets(scaling['offset_to_uV'])
+    return ret
@@ -4,13 +4,14 @@ import os
 import json
 from pydantic import BaseModel, Field
 from ...NeurobassPluginTypes import NeurobassProcessingTool, NeurobassProcessingToolContext, InputFile, OutputFile
-import pynwb
-import h5py
-import remfile
 import spikeinterface as si
 import spikeinterface.preprocessing as spre
+from ..InputFileManager import InputFileManager
 from .NwbRecording import NwbRecording
+from .NwbMetadata import NwbFileMetadata
 from .create_sorting_out_nwb_file import create_sorting_out_nwb_file
+from .helpers.unit_summaries import compute_unit_summaries
+from .helpers.extract_templates import extract_templates
 
 class SchemeEnum(str, Enum):
     scheme1 = '1'
@@ -28,6 +29,13 @@ class Mountainsort5Model(BaseModel):
     input: InputFile = Field(..., description="Input NWB file")
     output: OutputFile = Field(..., description="Output NWB file")
     electrical_series_path: str = Field(..., description="Path to the electrical series in the NWB file, e.g., /acquisition/ElectricalSeries")
+    additional_electrical_series_paths: List[str] = Field([], description="Paths to additional electrical series in the NWB file to sort together with the first one, concatenated in time (they must have the same sampling rate and channels)")
+    start_time_sec: float = Field(None, description="Start of the time window to sort, in seconds relative to the start of the recording (if None, start from the beginning)")
+    end_time_sec: float = Field(None, description="End of the time window to sort, in seconds relative to the start of the recording (if None, sort to the end)")
+    channel_ids: List[int] = Field([], description="Subset of channel ids to sort (if empty, all channels are sorted)")
+    input_meta_url: str = Field('', description="URL of the meta file of the input NWB file (see the nwb_meta_file tool), if available - the metadata is then read from it rather than from the input")
+    use_job_cache: bool = Field(True, description="Reuse the output of a previous identical job (same input, parameters and tool version) if available")
+    extract_templates: bool = Field(False, description="After sorting, extract the templates (mean waveforms) and the spike amplitudes, and add them to the output")
     
     scheme: SchemeEnum = Field("2", description="Which sorting scheme to use: '1, '2', or '3'", group=sorting_params_group)
     detect_threshold: float = Field(5.5, le=100, description="Detection threshold - recommend to use the default", group=sorting_params_group)
@@ -59,7 +67,9 @@ class Mountainsort5ProcessingTool(NeurobassProcessingTool):
         return {
             'wip': False,
             'logo_url': 'https://avatars.githubusercontent.com/u/32853892?s=200&v=4',
-            'label': 'MountainSort 5'
+            'label': 'MountainSort 5',
+            'cacheable': True,
+            'cache_dependencies': ['mountainsort5', 'spikeinterface']
         }
     @classmethod
     def get_tags(cls) -> List[str]:
@@ -73,35 +83,46 @@ class Mountainsort5ProcessingTool(NeurobassProcessingTool):
 
 def _run(context: NeurobassProcessingToolContext):
     import mountainsort5 as ms5
+    from threadpoolctl import threadpool_limits
 
     working_dir = 'working'
     os.mkdir(working_dir)
 
-    data = Mountainsort5Model(**context.get_data())
-
-    nwb_url = context.get_input_file_url(data.input)
+    data = context.get_validated_data(Mountainsort5Model)
 
     recording_electrical_series_path = data.electrical_series_path
 
-    # open the remote file
-    disk_cache = remfile.DiskCache('/tmp/remfile_cache')
-    remf = remfile.File(nwb_url, disk_cache=disk_cache)
-    f = h5py.File(remf, 'r')
+    # open the remote file (once - the handle is shared for the rest of the job)
+    input_files = InputFileManager(context)
+    f = input_files.get_h5py_file(data.input)
+    meta_f = input_files.get_meta_h5py_file(data.input_meta_url) if data.input_meta_url else None
 
     recording = NwbRecording(
         file=f,
-        electrical_series_path=recording_electrical_series_path
+        electrical_series_path=[recording_electrical_series_path] + data.additional_electrical_series_paths,
+        start_time_sec=data.start_time_sec,
+        end_time_sec=data.end_time_sec,
+        channel_ids=data.channel_ids,
+        concatenate=True,
+        num_decode_threads=context.get_num_jobs(),
+        meta_file=meta_f
     )
 
+    # the cores allocated to the job: n_jobs is passed to spikeinterface (as the
+    # default of its chunked processing, e.g. of the preprocessing below) and
+    # bounds the BLAS/OpenMP thread pools of the sorter
+    n_jobs = context.get_num_jobs()
+    si.set_global_job_kwargs(n_jobs=n_jobs)
+
     # Make sure the recording is preprocessed appropriately
     # lazy preprocessing
-    if data.sorting_params.filter:
-        freq_min = data.sorting_params.freq_min
-        freq_max = data.sorting_params.freq_max
+    if data.filter:
+        freq_min = data.freq_min
+        freq_max = data.freq_max
         recording_filtered = spre.bandpass_filter(recording, freq_min=freq_min, freq_max=freq_max)
     else:
         recording_filtered = recording
-    if data.sorting_params.whiten:
+    if data.whiten:
         recording_preprocessed: si.BaseRecording = spre.whiten(recording_filtered, dtype='float32')
     else:
         recording_preprocessed = recording_filtered
@@ -142,21 +163,56 @@ def _run(context: NeurobassProcessingToolContext):
         block_sorting_parameters=scheme2_sorting_parameters, block_duration_sec=sp.scheme3_block_duration_sec
     )
 
+    # the stages are checkpointed, so that a retried job resumes from the last completed one
+    checkpoints = context.get_checkpoints()
+
     scheme = sp.scheme
-    if scheme == "1":
-        sorting = ms5.sorting_scheme1(recording=recording_preprocessed, sorting_parameters=scheme1_sorting_parameters)
-    elif p["scheme"] == "2":
-        sorting = ms5.sorting_scheme2(recording=recording_preprocessed, sorting_parameters=scheme2_sorting_parameters)
-    elif p["scheme"] == "3":
-        sorting = ms5.sorting_scheme3(recording=recording_preprocessed, sorting_parameters=scheme3_sorting_parameters)
-
-    with pynwb.NWBHDF5IO(file=h5py.File(remf, 'r'), mode='r') as io:
-        nwbfile_rec = io.read()
-
-        if not os.path.exists('output'):
-            os.mkdir('output')
-        sorting_out_fname = 'output/sorting.nwb'
-
-        create_sorting_out_nwb_file(nwbfile_rec=nwbfile_rec, sorting=sorting, sorting_out_fname=sorting_out_fname)
-        
+    sorting_dir = checkpoints.get_stage_dir('sorting')
+    if not checkpoints.is_complete('sorting'):
+        with context.span('sort'), threadpool_limits(limits=n_jobs):
+            if scheme == "1":
+                sorting = ms5.sorting_scheme1(recording=recording_preprocessed, sorting_parameters=scheme1_sorting_parameters)
+            elif scheme == "2":
+                sorting = ms5.sorting_scheme2(recording=recording_preprocessed, sorting_parameters=scheme2_sorting_parameters)
+            elif scheme == "3":
+                sorting = ms5.sorting_scheme3(recording=recording_preprocessed, sorting_parameters=scheme3_sorting_parameters)
+        si.NpzSortingExtractor.write_sorting(sorting, f'{sorting_dir}/sorting.npz')
+        checkpoints.complete('sorting')
+    sorting = si.NpzSortingExtractor(f'{sorting_dir}/sorting.npz')
+
+    output_dir = checkpoints.get_stage_dir('output')
+    sorting_out_fname = f'{output_dir}/sorting.nwb'
+    if not checkpoints.is_complete('output'):
+        # per-unit summaries (firing rates, autocorrelograms, ...) for the viewers
+        with context.span('unit_summaries'):
+            unit_summaries = compute_unit_summaries(
+                sorting,
+                num_frames=recording.get_num_samples(),
+                recording=recording_filtered
+            )
+
+        templates = None
+        if data.extract_templates:
+            with context.span('extract_templates'):
+                templates = extract_templates(
+                    recording_filtered,
+                    sorting,
+                    working_dir=working_dir,
+                    num_workers=n_jobs
+                )
+
+        # read only the session/subject metadata, without io.read()
+        nwbfile_rec = NwbFileMetadata(meta_f if meta_f is not None else f)
+
+        with context.span('write_nwb'):
+            create_sorting_out_nwb_file(
+                nwbfile_rec=nwbfile_rec,
+                sorting=sorting,
+                sorting_out_fname=sorting_out_fname,
+                spike_time_offset_sec=recording.get_start_time_offset_sec(),
+                unit_summaries=unit_summaries,
+                templates=templates
+            )
+        checkpoints.complete('output')
+
     context.upload_output_file(data.output, sorting_out_fname)
\ No newline at end of file
@@ -0,0 +1,93 @@
+from typing import Union, List
+import h5py
+
+
+class NwbFileMetadata:
+    """Lazy, read-only view of the session metadata of an open NWB file
+
+    Exposes the same attribute names as pynwb.NWBFile for the fields needed by
+    create_sorting_out_nwb_file, but reads each field directly from the HDF5
+    file on access instead of building the full object tree with io.read().
+    """
+    def __init__(self, file: h5py.File):
+        self._file = file
+    @property
+    def session_description(self) -> Union[str, None]:
+        return _read_str(self._file, 'session_description')
+    @property
+    def session_start_time(self):
+        x = _read_str(self._file, 'session_start_time')
+        return _parse_datetime(x) if x is not None else None
+    @property
+    def experimenter(self) -> Union[List[str], None]:
+        return _read_str_list(self._file, 'general/experimenter')
+    @property
+    def experiment_description(self) -> Union[str, None]:
+        return _read_str(self._file, 'general/experiment_description')
+    @property
+    def lab(self) -> Union[str, None]:
+        return _read_str(self._file, 'general/lab')
+    @property
+    def institution(self) -> Union[str, None]:
+        return _read_str(self._file, 'general/institution')
+    @property
+    def session_id(self) -> Union[str, None]:
+        return _read_str(self._file, 'general/session_id')
+    @property
+    def keywords(self) -> Union[List[str], None]:
+        return _read_str_list(self._file, 'general/keywords')
+    @property
+    def subject(self) -> Union['NwbSubjectMetadata', None]:
+        if 'general/subject' not in self._file:
+            return None
+        return NwbSubjectMetadata(self._file['general/subject'])
+
+class NwbSubjectMetadata:
+    def __init__(self, group: h5py.Group):
+        self._group = group
+    @property
+    def subject_id(self) -> Union[str, None]:
+        return _read_str(self._group, 'subject_id')
+    @property
+    def age(self) -> Union[str, None]:
+        return _read_str(self._group, 'age')
+    @property
+    def date_of_birth(self):
+        x = _read_str(self._group, 'date_of_birth')
+        return _parse_datetime(x) if x is not None else None
+    @property
+    def sex(self) -> Union[str, None]:
+        return _read_str(self._group, 'sex')
+    @property
+    def species(self) -> Union[str, None]:
+        return _read_str(self._group, 'species')
+    @property
+    def description(self) -> Union[str, None]:
+        return _read_str(self._group, 'description')
+
+def _decode(x) -> str:
+    return x.decode('utf-8') if isinstance(x, bytes) else str(x)
+
+def _read_str(group: h5py.Group, path: str) -> Union[str, None]:
+    if path not in group:
+        return None
+    x = group[path][()]
+    if hasattr(x, 'shape') and x.shape != ():
+        # some older files store scalar text as a length-1 array
+        if len(x) == 0:
+            return None
+        x = x[0]
+    return _decode(x)
+
+def _read_str_list(group: h5py.Group, path: str) -> Union[List[str], None]:
+    if path not in group:
+        return None
+    x = group[path][()]
+    if not hasattr(x, 'shape') or x.shape == ():
+        return [_decode(x)]
+    return [_decode(a) for a in x]
+
+def _parse_datetime(x: str):
+    # same parser that pynwb uses when reading
+    from dateutil.parser import parse
+    return parse(x)
@@ -2,32 +2,96 @@ from typing import Union, List
 import numpy as np
 import h5py
 import spikeinterface as si
+from .ParallelChunkReader import ParallelChunkReader
+from ..nwb_meta.create_nwb_meta_file import get_meta_dataset
 
 
 class NwbRecording(si.BaseRecording):
     def __init__(self,
-        file: h5py.File,
-        electrical_series_path: str
+        file: Union[h5py.File, List[h5py.File]],
+        electrical_series_path: Union[str, List[str]],
+        start_time_sec: Union[float, None]=None,
+        end_time_sec: Union[float, None]=None,
+        channel_ids: Union[List[int], None]=None,
+        concatenate: bool=False,
+        num_decode_threads: int=1,
+        meta_file: Union[h5py.File, List[h5py.File], None]=None
     ) -> None:
-        electrical_series = file[electrical_series_path]
-        electrical_series_data = electrical_series['data']
-        dtype = electrical_series_data.dtype
-
-        # Get sampling frequency
-        if 'starting_time' in electrical_series.keys():
-            t_start = electrical_series['starting_time'][()]
-            sampling_frequency = electrical_series['starting_time'].attrs['rate']
-        elif 'timestamps' in electrical_series.keys():
-            t_start = electrical_series['timestamps'][0]
-            sampling_frequency = 1 / np.median(np.diff(electrical_series['timestamps'][:1000]))
-        
-        # Get channel ids
-        electrode_indices = electrical_series['electrodes'][:]
-        electrodes_table = file['/general/extracellular_ephys/electrodes']
-        channel_ids = [electrodes_table['id'][i] for i in electrode_indices]
-        
+        """A spikeinterface recording backed by one or more ElectricalSeries in NWB files
+
+        Args:
+            file (h5py.File or List[h5py.File]): the open NWB file (may be remote), or one file per electrical series
+            electrical_series_path (str or List[str]): path to the electrical series, e.g., /acquisition/ElectricalSeries, or a list of paths
+            start_time_sec (float, optional): start of the time window, relative to the start of the recording
+            end_time_sec (float, optional): end of the time window, relative to the start of the recording
+            channel_ids (List[int], optional): subset of channel ids to expose (all channels if None or empty)
+            concatenate (bool): if True, multiple electrical series are exposed as a single (virtually concatenated) segment rather than one segment each
+            num_decode_threads (int): number of threads for decompressing chunks of compressed datasets (see ParallelChunkReader)
+            meta_file (h5py.File or List[h5py.File], optional): the meta file of each NWB file (see create_nwb_meta_file), from which the metadata is read instead of from the NWB file
+
+        Only the selected time window and channels are ever read from the file,
+        so for a remote file only the corresponding bytes are downloaded. With
+        multiple electrical series, all must have the same sampling frequency
+        and dtype and contain the selected channels; the time window is only
+        supported for a single series or with concatenate=True, in which case
+        it is relative to the start of the concatenation.
+        """
+        electrical_series_paths = [electrical_series_path] if isinstance(electrical_series_path, str) else list(electrical_series_path)
+        files = list(file) if isinstance(file, (list, tuple)) else [file] * len(electrical_series_paths)
+        if len(electrical_series_paths) == 0:
+            raise ValueError('No electrical series specified')
+        if len(files) != len(electrical_series_paths):
+            raise ValueError(f'Number of files ({len(files)}) does not match number of electrical series ({len(electrical_series_paths)})')
+        if meta_file is None:
+            meta_files = [None] * len(files)
+        else:
+            meta_files = list(meta_file) if isinstance(meta_file, (list, tuple)) else [meta_file] * len(files)
+            if len(meta_files) != len(files):
+                raise ValueError(f'Number of meta files ({len(meta_files)}) does not match number of files ({len(files)})')
+        sources = [_read_electrical_series(f, p, meta_file=m) for f, p, m in zip(files, electrical_series_paths, meta_files)]
+        source0 = sources[0]
+        sampling_frequency = source0['sampling_frequency']
+        dtype = source0['data'].dtype
+        for src in sources[1:]:
+            if not np.isclose(src['sampling_frequency'], sampling_frequency):
+                raise ValueError(f'Sampling frequency of {src["path"]} ({src["sampling_frequency"]}) does not match {source0["path"]} ({sampling_frequency})')
+            if src['data'].dtype != dtype:
+                raise ValueError(f'Dtype of {src["path"]} ({src["data"].dtype}) does not match {source0["path"]} ({dtype})')
+            if src['conversion'] != source0['conversion'] or src['offset'] != source0['offset']:
+                raise ValueError(f'Conversion factors of {src["path"]} do not match {source0["path"]}')
+
+        # Get the time window (over the concatenation when there are multiple series)
+        if len(sources) > 1 and not concatenate and (start_time_sec is not None or end_time_sec is not None):
+            raise ValueError('A time window can only be used with multiple electrical series when concatenate=True')
+        num_samples_total = sum(src['data'].shape[0] for src in sources)
+        start_frame = int(round(start_time_sec * sampling_frequency)) if start_time_sec is not None else 0
+        end_frame = int(round(end_time_sec * sampling_frequency)) if end_time_sec is not None else num_samples_total
+        start_frame = max(start_frame, 0)
+        end_frame = min(end_frame, num_samples_total)
+        if end_frame <= start_frame:
+            raise ValueError(f'Empty time window: start_time_sec={start_time_sec}, end_time_sec={end_time_sec}')
+        self._start_frame = start_frame
+
+        # Get channel ids, and the columns of each series for those channels
+        all_channel_ids = source0['channel_ids']
+        if not channel_ids:
+            channel_ids = all_channel_ids
+        for channel_id in channel_ids:
+            for src in sources:
+                if channel_id not in src['channel_ids']:
+                    raise ValueError(f'Channel id not found in electrical series {src["path"]}: {channel_id}')
+        for src in sources:
+            if list(channel_ids) == list(src['channel_ids']):
+                src['channel_indices'] = None
+            else:
+                src['channel_indices'] = [src['channel_ids'].index(channel_id) for channel_id in channel_ids]
+        electrode_indices = source0['electrode_indices']
+        if source0['channel_indices'] is not None:
+            electrode_indices = electrode_indices[source0['channel_indices']]
+        electrodes_table = source0['electrodes_table']
+
         si.BaseRecording.__init__(self, channel_ids=channel_ids, sampling_frequency=sampling_frequency, dtype=dtype)
-        
+
         # Set electrode locations
         if 'x' in electrodes_table:
             channel_loc_x = [electrodes_table['x'][i] for i in electrode_indices]
@@ -50,29 +114,209 @@ class NwbRecording(si.BaseRecording):
         if channel_loc_x is not None:
             ndim = 2 if channel_loc_z is None else 3
             locations = np.zeros((len(electrode_indices), ndim), dtype=float)
-            for i, electrode_index in enumerate(electrode_indices):
-                locations[i, 0] = channel_loc_x[electrode_index]
-                locations[i, 1] = channel_loc_y[electrode_index]
+            for i in range(len(electrode_indices)):
+                locations[i, 0] = channel_loc_x[i]
+                locations[i, 1] = channel_loc_y[i]
                 if channel_loc_z is not None:
-                    locations[i, 2] = channel_loc_z[electrode_index]
+                    locations[i, 2] = channel_loc_z[i]
             self.set_dummy_probe_from_locations(locations)
 
-        recording_segment = NwbRecordingSegment(
-            electrical_series_data=electrical_series_data,
-            sampling_frequency=sampling_frequency
-        )
-        self.add_recording_segment(recording_segment)
+        # Set the gains and offsets to microvolts (NWB: volts = data * channel_conversion * conversion + offset)
+        gains = source0['conversion'] * 1e6 * np.ones(len(channel_ids))
+        if source0['channel_conversion'] is not None:
+            channel_conversion = source0['channel_conversion']
+            if source0['channel_indices'] is not None:
+                channel_conversion = channel_conversion[source0['channel_indices']]
+            gains = gains * channel_conversion
+        self.set_channel_gains(gains)
+        self.set_channel_offsets(source0['offset'] * 1e6 * np.ones(len(channel_ids)))
+
+        for src in sources:
+            src['chunk_reader'] = ParallelChunkReader.create(src['data'], num_workers=num_decode_threads) if isinstance(src['data'], h5py.Dataset) else None
+
+        if len(sources) == 1:
+            self.add_recording_segment(NwbRecordingSegment(
+                electrical_series_data=source0['data'],
+                sampling_frequency=sampling_frequency,
+                start_frame=start_frame,
+                end_frame=end_frame,
+                channel_indices=source0['channel_indices'],
+                chunk_reader=source0['chunk_reader']
+            ))
+        else:
+            segments = [
+                NwbRecordingSegment(
+                    electrical_series_data=src['data'],
+                    sampling_frequency=sampling_frequency,
+                    channel_indices=src['channel_indices'],
+                    chunk_reader=src['chunk_reader']
+                )
+                for src in sources
+            ]
+            if concatenate:
+                self.add_recording_segment(NwbConcatenatedRecordingSegment(
+                    segments=segments,
+                    sampling_frequency=sampling_frequency,
+                    start_frame=start_frame,
+                    end_frame=end_frame
+                ))
+            else:
+                for segment in segments:
+                    self.add_recording_segment(segment)
+
+    def get_start_time_offset_sec(self) -> float:
+        """Time of the first exposed sample relative to the start of the full recording
+
+        Add this to spike times computed from this recording to get times relative to the full recording.
+        """
+        return self._start_frame / self.get_sampling_frequency()
 
 class NwbRecordingSegment(si.BaseRecordingSegment):
-    def __init__(self, electrical_series_data: h5py.Dataset, sampling_frequency: float) -> None:
+    def __init__(self,
+        electrical_series_data: Union[h5py.Dataset, np.memmap],
+        sampling_frequency: float,
+        start_frame: int=0,
+        end_frame: Union[int, None]=None,
+        channel_indices: Union[List[int], None]=None,
+        chunk_reader: Union[ParallelChunkReader, None]=None
+    ) -> None:
         self._electrical_series_data = electrical_series_data
+        self._chunk_reader = chunk_reader
+        self._start_frame = start_frame
+        self._end_frame = end_frame if end_frame is not None else electrical_series_data.shape[0]
+        self._channel_indices = np.array(channel_indices) if channel_indices is not None else None
         si.BaseRecordingSegment.__init__(self, sampling_frequency=sampling_frequency)
 
     def get_num_samples(self) -> int:
-        return self._electrical_series_data.shape[0]
+        return self._end_frame - self._start_frame
 
     def get_traces(self, start_frame: int, end_frame: int, channel_indices: Union[List[int], None]=None) -> np.ndarray:
-        if channel_indices is None:
-            return self._electrical_series_data[start_frame:end_frame, :]
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.get_num_samples()
+        # translate to frames of the full electrical series
+        i1 = self._start_frame + start_frame
+        i2 = self._start_frame + end_frame
+        if self._channel_indices is not None:
+            if channel_indices is None:
+                columns = self._channel_indices
+            else:
+                columns = self._channel_indices[channel_indices]
         else:
-            return self._electrical_series_data[start_frame:end_frame, channel_indices]
\ No newline at end of file
+            if channel_indices is None:
+                if self._chunk_reader is not None:
+                    return self._chunk_reader.read(i1, i2, 0, self._electrical_series_data.shape[1])
+                return self._electrical_series_data[i1:i2, :]
+            columns = np.array(channel_indices)
+        return _read_columns(self._electrical_series_data, i1, i2, columns, chunk_reader=self._chunk_reader)
+
+class NwbConcatenatedRecordingSegment(si.BaseRecordingSegment):
+    def __init__(self,
+        segments: List[NwbRecordingSegment],
+        sampling_frequency: float,
+        start_frame: int=0,
+        end_frame: Union[int, None]=None
+    ) -> None:
+        """Several segments exposed as one, with frames translated lazily (nothing is copied until get_traces)"""
+        self._segments = segments
+        # frame of the concatenation at which each segment starts
+        self._offsets = np.cumsum([0] + [seg.get_num_samples() for seg in segments])
+        self._start_frame = start_frame
+        self._end_frame = end_frame if end_frame is not None else int(self._offsets[-1])
+        si.BaseRecordingSegment.__init__(self, sampling_frequency=sampling_frequency)
+
+    def get_num_samples(self) -> int:
+        return self._end_frame - self._start_frame
+
+    def get_traces(self, start_frame: int, end_frame: int, channel_indices: Union[List[int], None]=None) -> np.ndarray:
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.get_num_samples()
+        i1 = self._start_frame + start_frame
+        i2 = self._start_frame + end_frame
+        pieces = []
+        for k, seg in enumerate(self._segments):
+            o1, o2 = int(self._offsets[k]), int(self._offsets[k + 1])
+            if o2 <= i1 or o1 >= i2:
+                continue
+            pieces.append(seg.get_traces(max(i1, o1) - o1, min(i2, o2) - o1, channel_indices))
+        if len(pieces) == 1:
+            return pieces[0]
+        # only the requested chunk is assembled
+        return np.concatenate(pieces, axis=0)
+
+def _read_electrical_series(file: h5py.File, electrical_series_path: str, meta_file: Union[h5py.File, None]=None) -> dict:
+    # The metadata comes from the meta file if there is one (only the datasets
+    # whose data is not in the meta file, e.g., long timestamps, are read from the NWB file)
+    if meta_file is not None and electrical_series_path in meta_file:
+        electrical_series = meta_file[electrical_series_path]
+    else:
+        meta_file = None
+        electrical_series = file[electrical_series_path]
+    def get_dataset(name: str) -> h5py.Dataset:
+        return get_meta_dataset(meta_file, file, f'{electrical_series_path}/{name}')
+
+    # Get sampling frequency
+    if 'starting_time' in electrical_series.keys():
+        sampling_frequency = electrical_series['starting_time'].attrs['rate']
+    elif 'timestamps' in electrical_series.keys():
+        timestamps = get_dataset('timestamps')
+        sampling_frequency = 1 / np.median(np.diff(timestamps[:1000]))
+    else:
+        raise ValueError(f'Unable to determine the sampling frequency of {electrical_series_path}')
+
+    electrode_indices = get_dataset('electrodes')[:]
+    electrodes_table_path = '/general/extracellular_ephys/electrodes'
+    electrodes_group = (meta_file if meta_file is not None else file)[electrodes_table_path]
+    # only the columns that are used
+    electrodes_table = {
+        name: get_meta_dataset(meta_file, file, f'{electrodes_table_path}/{name}')
+        for name in ['id', 'x', 'y', 'z', 'rel_x', 'rel_y', 'rel_z']
+        if name in electrodes_group
+    }
+    electrode_ids = electrodes_table['id'][:]
+    data = file[f'{electrical_series_path}/data']
+    attrs = electrical_series['data'].attrs
+    return {
+        'path': electrical_series_path,
+        'data': _memmap_if_local(file, data),
+        'conversion': float(attrs.get('conversion', 1.0)),
+        'offset': float(attrs.get('offset', 0.0)),
+        'channel_conversion': get_dataset('channel_conversion')[:] if 'channel_conversion' in electrical_series.keys() else None,
+        'sampling_frequency': sampling_frequency,
+        'electrode_indices': electrode_indices,
+        'electrodes_table': electrodes_table,
+        'channel_ids': [electrode_ids[i] for i in electrode_indices]
+    }
+
+def _memmap_if_local(file: h5py.File, data: h5py.Dataset) -> Union[h5py.Dataset, np.memmap]:
+    # A contiguous, uncompressed dataset in a file on the local filesystem
+    # (e.g., an input on a mounted archive) is memory-mapped rather than read through h5py
+    if file.driver != 'sec2' or data.chunks is not None or data.compression is not None:
+        return data
+    offset = data.id.get_offset()
+    if offset is None or not data.dtype.isnative:
+        return data
+    return np.memmap(file.filename, dtype=data.dtype, mode='r', offset=offset, shape=data.shape)
+
+def _read_columns(data: h5py.Dataset, i1: int, i2: int, columns: np.ndarray, chunk_reader: Union[ParallelChunkReader, None]=None) -> np.ndarray:
+    # h5py requires the column selection to be strictly increasing,
+    # so read the sorted unique columns and then reorder
+    unique_columns, inverse = np.unique(columns, return_inverse=True)
+    if chunk_reader is not None:
+        # whole chunks are decoded anyway, so read the block spanning the columns
+        c1 = unique_columns[0]
+        x = chunk_reader.read(i1, i2, c1, unique_columns[-1] + 1)
+        return x[:, columns - c1]
+    if len(unique_columns) == data.shape[1]:
+        x = data[i1:i2, :]
+    elif unique_columns[-1] - unique_columns[0] + 1 == len(unique_columns):
+        # contiguous block of columns - use a simple slice
+        x = data[i1:i2, unique_columns[0]:unique_columns[-1] + 1]
+    else:
+        x = data[i1:i2, unique_columns.tolist()]
+    if len(unique_columns) == len(columns) and np.all(unique_columns == columns):
+        return x
+    return x[:, inverse]
@@ -0,0 +1,116 @@
+from typing import Union
+import zlib
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import h5py
+
+
+# HDF5 filter ids
+_H5Z_FILTER_DEFLATE = 1
+_H5Z_FILTER_SHUFFLE = 2
+_H5Z_FILTER_BLOSC = 32001
+_H5Z_FILTER_ZSTD = 32015
+
+class ParallelChunkReader:
+    """Reads a chunked, compressed 2D HDF5 dataset by fetching the raw chunks and decompressing them in a thread pool
+
+    h5py decompresses chunks serially on the calling thread (holding the
+    GIL). Here each chunk is fetched with read_direct_chunk (still serialized
+    by h5py) and decoded with codecs that release the GIL (zlib, and blosc or
+    zstd via numcodecs when available), so decoding scales with the number
+    of threads.
+    """
+    def __init__(self, dataset: h5py.Dataset, *, num_workers: int):
+        self._dataset = dataset
+        self._dtype = dataset.dtype
+        self._shape = dataset.shape
+        self._chunks = dataset.chunks
+        self._filters = _get_filters(dataset)
+        self._fillvalue = dataset.fillvalue
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+        # the threads are stopped on close(), or once the reader is no longer used
+        self._finalizer = weakref.finalize(self, self._executor.shutdown, wait=False)
+    @staticmethod
+    def create(dataset: h5py.Dataset, *, num_workers: int) -> Union['ParallelChunkReader', None]:
+        """Create a reader for the dataset, or return None if it would not help (single worker, not chunked or compressed) or the filters are not supported"""
+        if num_workers <= 1 or dataset.chunks is None or len(dataset.shape) != 2:
+            return None
+        filters = _get_filters(dataset)
+        if filters is None or len(filters) == 0:
+            return None
+        for code in filters:
+            if code in [_H5Z_FILTER_BLOSC, _H5Z_FILTER_ZSTD]:
+                try:
+                    import numcodecs  # noqa: F401
+                except ImportError:
+                    return None
+        return ParallelChunkReader(dataset, num_workers=num_workers)
+    def read(self, i1: int, i2: int, c1: int, c2: int) -> np.ndarray:
+        """Read rows i1:i2 and columns c1:c2"""
+        i2 = min(i2, self._shape[0])
+        c2 = min(c2, self._shape[1])
+        ret = np.empty((i2 - i1, c2 - c1), dtype=self._dtype)
+        cr, cc = self._chunks
+        tasks = [
+            (r0, col0)
+            for r0 in range(i1 // cr * cr, i2, cr)
+            for col0 in range(c1 // cc * cc, c2, cc)
+        ]
+        def read_chunk(task):
+            r0, col0 = task
+            x = self._read_chunk(r0, col0)
+            # the part of the chunk that falls within the requested block
+            a1, a2 = max(i1, r0), min(i2, r0 + cr)
+            b1, b2 = max(c1, col0), min(c2, col0 + cc)
+            ret[a1 - i1:a2 - i1, b1 - c1:b2 - c1] = x[a1 - r0:a2 - r0, b1 - col0:b2 - col0]
+        for _ in self._executor.map(read_chunk, tasks):
+            pass
+        return ret
+    def close(self):
+        self._finalizer()
+    def _read_chunk(self, r0: int, col0: int) -> np.ndarray:
+        cr, cc = self._chunks
+        if self._dataset.id.get_chunk_info_by_coord((r0, col0)).byte_offset is None:
+            # the chunk was never written
+            return np.full((cr, cc), self._fillvalue, dtype=self._dtype)
+        filter_mask, raw = self._dataset.id.read_direct_chunk((r0, col0))
+        # decode in the reverse order of the filter pipeline
+        for i in reversed(range(len(self._filters))):
+            if filter_mask & (1 << i):
+                continue
+            raw = _decode(self._filters[i], raw, self._dtype.itemsize)
+        return np.frombuffer(raw, dtype=self._dtype).reshape(cr, cc)
+
+def _get_filters(dataset: h5py.Dataset) -> Union[list, None]:
+    plist = dataset.id.get_create_plist()
+    ret = []
+    for i in range(plist.get_nfilters()):
+        code = plist.get_filter(i)[0]
+        if code not in [_H5Z_FILTER_DEFLATE, _H5Z_FILTER_SHUFFLE, _H5Z_FILTER_BLOSC, _H5Z_FILTER_ZSTD]:
+            # e.g., fletcher32 or scale-offset
+            return None
+        ret.append(code)
+    return ret
+
+def _decode(code: int, raw: bytes, itemsize: int) -> bytes:
+    if code == _H5Z_FILTER_DEFLATE:
+        return zlib.decompress(raw)
+    elif code == _H5Z_FILTER_SHUFFLE:
+        if itemsize == 1:
+            return raw
+        x = np.frombuffer(raw, dtype=np.uint8)
+        n = len(x) // itemsize
+        ret = np.empty(len(x), dtype=np.uint8)
+        ret[:n * itemsize] = x[:n * itemsize].reshape(itemsize, n).T.ravel()
+        # trailing bytes (if any) are not shuffled
+        ret[n * itemsize:] = x[n * itemsize:]
+        return ret.tobytes()
+    elif code == _H5Z_FILTER_BLOSC:
+        from numcodecs import blosc
+        return blosc.decompress(raw)
+    elif code == _H5Z_FILTER_ZSTD:
+        from numcodecs import Zstd
+        return Zstd().decode(raw)
+    else:
+        raise ValueError(f'Unsupported filter: {code}')
@@ -1,8 +1,13 @@
+from typing import Union
 import pynwb
 from uuid import uuid4
 
 
-def create_sorting_out_nwb_file(*, nwbfile_rec, sorting, sorting_out_fname):
+def create_sorting_out_nwb_file(*, nwbfile_rec, sorting, sorting_out_fname, spike_time_offset_sec: float=0, unit_summaries: Union[dict, None]=None, templates: Union[dict, None]=None):
+    # nwbfile_rec can be a pynwb.NWBFile or a lazy NwbFileMetadata
+    # unit_summaries (see helpers/unit_summaries.py) and templates (see
+    # helpers/extract_templates.py) are added as columns of the units table
+    subject_rec = nwbfile_rec.subject
     nwbfile = pynwb.NWBFile(
         session_description=nwbfile_rec.session_description,
         identifier=str(uuid4()),
@@ -12,22 +17,31 @@ def create_sorting_out_nwb_file(*, nwbfile_rec, sorting, sorting_out_fname):
         lab=nwbfile_rec.lab,
         institution=nwbfile_rec.institution,
         subject=pynwb.file.Subject(
-            subject_id=nwbfile_rec.subject.subject_id,
-            age=nwbfile_rec.subject.age,
-            date_of_birth=nwbfile_rec.subject.date_of_birth,
-            sex=nwbfile_rec.subject.sex,
-            species=nwbfile_rec.subject.species,
-            description=nwbfile_rec.subject.description
-        ),
+            subject_id=subject_rec.subject_id,
+            age=subject_rec.age,
+            date_of_birth=subject_rec.date_of_birth,
+            sex=subject_rec.sex,
+            species=subject_rec.species,
+            description=subject_rec.description
+        ) if subject_rec is not None else None,
         session_id=nwbfile_rec.session_id,
         keywords=nwbfile_rec.keywords
     )
 
-    for unit_id in sorting.get_unit_ids():
-        st = sorting.get_unit_spike_train(unit_id) / sorting.get_sampling_frequency()
+    unit_columns = {}
+    for x in [unit_summaries, templates]:
+        if x is None:
+            continue
+        for name, values in x['columns'].items():
+            nwbfile.add_unit_column(name=name, description=x['descriptions'][name], index=name in x.get('indexed', []))
+            unit_columns[name] = values
+
+    for i, unit_id in enumerate(sorting.get_unit_ids()):
+        st = sorting.get_unit_spike_train(unit_id) / sorting.get_sampling_frequency() + spike_time_offset_sec
         nwbfile.add_unit(
             id=unit_id,
-            spike_times=st
+            spike_times=st,
+            **{name: values[i] for name, values in unit_columns.items()}
         )
 
     # Write the nwb file
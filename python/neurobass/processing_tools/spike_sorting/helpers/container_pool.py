@@ -0,0 +1,219 @@
+import os
+import json
+import fcntl
+import subprocess
+from pathlib import Path
+from typing import List, Union
+from ....container_images import resolve_singularity_image
+
+
+# Containers in a pool are long-lived and shared by all jobs on the node.
+# Each one bind-mounts the node's jobs directory (at the same absolute path)
+# so that any job's working files are visible inside it. A container is
+# claimed by a job by holding an exclusive flock on its lock file, so the
+# pool works across the separate run-job processes on the node.
+
+_pool_label = 'neurobass.container_pool'
+
+# The pool is configured by CONTAINER_POOL_SIZE and COMPUTE_RESOURCE_DIR, read
+# from the environment of the job, or from the environment of the node process
+# passed explicitly (env) when the node starts and stops the pools.
+
+def get_container_pool_size(env: Union[dict, None]=None) -> int:
+    env = os.environ if env is None else env
+    return int(env.get('CONTAINER_POOL_SIZE', '0') or '0')
+
+def get_container_pool_shared_dir(env: Union[dict, None]=None) -> Union[str, None]:
+    env = os.environ if env is None else env
+    compute_resource_dir = env.get('COMPUTE_RESOURCE_DIR', None)
+    if not compute_resource_dir:
+        return None
+    return str((Path(compute_resource_dir) / 'jobs').absolute())
+
+class WarmContainer:
+    def __init__(self, *, pool: 'WarmContainerPool', name: str, lock_file):
+        self._pool = pool
+        self.name = name
+        self._lock_file = lock_file
+    def exec(self, command: List[str]) -> int:
+        """Execute a command in the container, forwarding its output
+
+        Args:
+            command (List[str]): the command and its arguments
+
+        Returns:
+            int: the exit code of the command
+        """
+        return self._pool._exec(self.name, command)
+    def release(self):
+        """Return the container to the pool (or stop it if the pool is over capacity)"""
+        if self._lock_file is None:
+            return
+        try:
+            if len(self._pool._list()) > self._pool.pool_size:
+                self._pool._stop(self.name)
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+class WarmContainerPool:
+    def __init__(self, *,
+        pool_name: str,
+        image: str,
+        container_method: str,
+        shared_dir: str,
+        pool_size: int,
+        gpu: bool = True,
+        lock_dir: str = '/tmp/neurobass_container_pool'
+    ):
+        """A node-level pool of pre-started containers for a single image
+
+        Args:
+            pool_name (str): name of the pool, e.g., kilosort3
+            image (str): the container image
+            container_method (str): 'docker' or 'singularity'
+            shared_dir (str): absolute path of the directory to bind-mount (read/write) in each container
+            pool_size (int): number of idle containers to keep warm
+            gpu (bool): whether to expose the GPUs to the containers
+            lock_dir (str): directory for the lock files used to claim containers
+        """
+        if container_method not in ['docker', 'singularity']:
+            raise ValueError(f'Unexpected container method for container pool: {container_method}')
+        self.pool_name = pool_name
+        self.image = image
+        self.container_method = container_method
+        self.shared_dir = shared_dir
+        self.pool_size = pool_size
+        self.gpu = gpu
+        self._lock_dir = Path(lock_dir)
+    def prewarm(self):
+        """Start containers until the pool has pool_size healthy containers"""
+        with self._creation_lock():
+            names = [name for name in self._list() if self._check_health(name)]
+            while len(names) < self.pool_size:
+                name = self._start()
+                print(f'Started warm container for {self.pool_name}: {name}')
+                names.append(name)
+    def acquire(self) -> WarmContainer:
+        """Claim an idle healthy container from the pool, starting a new one if none is available"""
+        self._lock_dir.mkdir(parents=True, exist_ok=True)
+        with self._creation_lock():
+            for name in self._list():
+                lock_file = self._try_lock(name)
+                if lock_file is None:
+                    continue # in use by another job
+                if not self._check_health(name):
+                    print(f'Removing unhealthy container from pool: {name}')
+                    self._stop(name)
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    lock_file.close()
+                    continue
+                return WarmContainer(pool=self, name=name, lock_file=lock_file)
+            name = self._start()
+            lock_file = self._try_lock(name)
+            if lock_file is None:
+                raise Exception(f'Unable to lock newly started container: {name}')
+            return WarmContainer(pool=self, name=name, lock_file=lock_file)
+    def stop_all(self):
+        for name in self._list():
+            self._stop(name)
+
+    def _creation_lock(self):
+        self._lock_dir.mkdir(parents=True, exist_ok=True)
+        return _FileLock(self._lock_dir / f'{self.pool_name}.pool.lock')
+    def _try_lock(self, name: str):
+        f = open(self._lock_dir / f'{name}.lock', 'w')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+        return f
+    def _list(self) -> List[str]:
+        if self.container_method == 'docker':
+            client = _docker_client()
+            containers = client.containers.list(filters={'label': f'{_pool_label}={self.pool_name}', 'status': 'running'})
+            return [c.name for c in containers]
+        else:
+            out = subprocess.check_output(['singularity', 'instance', 'list', '--json']).decode('utf-8')
+            instances = json.loads(out).get('instances', [])
+            prefix = f'neurobass-{self.pool_name}-'
+            return [x['instance'] for x in instances if x['instance'].startswith(prefix)]
+    def _start(self) -> str:
+        import random
+        import string
+        name = f'neurobass-{self.pool_name}-' + ''.join(random.choice(string.ascii_lowercase) for i in range(8))
+        if self.container_method == 'docker':
+            import docker
+            client = _docker_client()
+            container = client.containers.create(
+                self.image,
+                name=name,
+                tty=True,
+                labels={_pool_label: self.pool_name},
+                volumes={self.shared_dir: {'bind': self.shared_dir, 'mode': 'rw'}},
+                device_requests=[docker.types.DeviceRequest(count=-1, capabilities=[["gpu"]])] if self.gpu else []
+            )
+            container.start()
+        else:
+            singularity_image = resolve_singularity_image(self.image)
+            options = ['--bind', f'{self.shared_dir}:{self.shared_dir}']
+            if self.gpu:
+                options += ['--nv']
+            subprocess.run(['singularity', 'instance', 'start', *options, singularity_image, name], check=True)
+        return name
+    def _stop(self, name: str):
+        if self.container_method == 'docker':
+            client = _docker_client()
+            container = client.containers.get(name)
+            container.stop()
+            container.remove()
+        else:
+            subprocess.run(['singularity', 'instance', 'stop', name])
+    def _check_health(self, name: str) -> bool:
+        try:
+            return self._exec(name, ['true'], verbose=False) == 0
+        except Exception as e:
+            print(f'Health check failed for container {name}: {e}')
+            return False
+    def _exec(self, name: str, command: List[str], verbose: bool = True) -> int:
+        if self.container_method == 'docker':
+            client = _docker_client()
+            container = client.containers.get(name)
+            exit_code, output = container.exec_run(command)
+            if verbose:
+                print(output.decode('utf-8'))
+            return exit_code
+        else:
+            cmd = ['singularity', 'exec', f'instance://{name}', *command]
+            if verbose:
+                print(f'Executing command in singularity instance: {" ".join(cmd)}')
+                return subprocess.run(cmd).returncode
+            else:
+                return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+
+class _FileLock:
+    def __init__(self, path: Path):
+        self._path = path
+        self._f = None
+    def __enter__(self):
+        self._f = open(self._path, 'w')
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+        self._f = None
+
+_docker_client_instance = None
+def _docker_client():
+    global _docker_client_instance
+    if _docker_client_instance is None:
+        import docker
+        _docker_client_instance = docker.from_env()
+    return _docker_client_instance
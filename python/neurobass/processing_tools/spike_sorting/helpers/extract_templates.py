@@ -0,0 +1,191 @@
+from typing import Union
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import spikeinterface as si
+
+
+# Post-sort extraction of the templates (mean waveforms) and the spike
+# amplitudes in two chunked passes over the (filtered) recording.
+#
+# In the first pass, all the spikes falling in a chunk are handled at once:
+# the snippets of a random subset of the spikes of each unit (at most
+# max_spikes_per_unit) are gathered with a strided view of the chunk and
+# summed into a per-unit accumulator that is memory-mapped in the working
+# directory. Each worker has its own accumulator (so the workers never wait
+# for each other), and the accumulators are reduced and normalized unit by
+# unit at the end, so the dense templates are never all held in memory. Only
+# the channels with the largest template amplitude are kept for each unit
+# (sparse templates).
+#
+# The amplitude of a spike is measured on the peak channel of its unit, at
+# the offset of the peak of the template, so the second pass (which only
+# reads the chunks that contain spikes) needs the templates.
+
+def extract_templates(
+    recording: si.BaseRecording,
+    sorting: si.BaseSorting,
+    *,
+    working_dir: str,
+    ms_before: float=1,
+    ms_after: float=2,
+    max_spikes_per_unit: int=500,
+    num_channels_per_unit: int=16,
+    chunk_duration_sec: float=10,
+    num_workers: int=1,
+    seed: int=0
+) -> dict:
+    """Extract the sparse templates and the spike amplitudes of a (single-segment) sorting
+
+    Args:
+        recording (si.BaseRecording): the filtered recording
+        sorting (si.BaseSorting): the sorting
+        working_dir (str): directory for the memory-mapped accumulator
+        ms_before (float): duration of the snippets before the spike
+        ms_after (float): duration of the snippets after the spike
+        max_spikes_per_unit (int): number of spikes (chosen at random) averaged in each template
+        num_channels_per_unit (int): number of channels kept in each template
+        chunk_duration_sec (float): duration of the chunks of the pass over the recording
+        num_workers (int): number of threads
+        seed (int): seed for the choice of the spikes
+
+    Returns:
+        dict: {columns, descriptions, indexed} - columns of the units table (in the order of sorting.get_unit_ids()); indexed are the ragged (per-spike) columns
+    """
+    sampling_frequency = recording.get_sampling_frequency()
+    num_frames = recording.get_num_samples(segment_index=0)
+    num_channels = recording.get_num_channels()
+    channel_ids = np.array(recording.get_channel_ids())
+    gains = recording.get_channel_gains()
+    gains = np.asarray(gains, dtype=np.float32) if gains is not None else np.ones(num_channels, dtype=np.float32)
+    nb = int(ms_before / 1000 * sampling_frequency)
+    na = int(ms_after / 1000 * sampling_frequency)
+    T = nb + na
+    K = min(num_channels_per_unit, num_channels)
+
+    unit_ids = sorting.get_unit_ids()
+    num_units = len(unit_ids)
+    spike_trains = [np.asarray(sorting.get_unit_spike_train(unit_id), dtype=np.int64) for unit_id in unit_ids]
+    num_spikes = np.array([len(st) for st in spike_trains], dtype=np.int64)
+    all_frames = np.concatenate(spike_trains) if num_units > 0 else np.zeros(0, dtype=np.int64)
+    all_units = np.repeat(np.arange(num_units), num_spikes)
+    # the spikes averaged in the templates (not too close to the edges of the recording)
+    rng = np.random.default_rng(seed)
+    sampled = np.zeros(len(all_frames), dtype=bool)
+    offset = 0
+    for st in spike_trains:
+        candidates = offset + np.nonzero((st >= nb) & (st + na <= num_frames))[0]
+        if len(candidates) > max_spikes_per_unit:
+            candidates = rng.choice(candidates, max_spikes_per_unit, replace=False)
+        sampled[candidates] = True
+        offset += len(st)
+    order = np.argsort(all_frames, kind='stable')
+    sorted_frames = all_frames[order]
+
+    num_accumulators = max(1, num_workers)
+    accumulator_fnames = [os.path.join(working_dir, f'templates_accumulator_{a}.dat') for a in range(num_accumulators)]
+    accumulators = []
+    counts = np.zeros((num_accumulators, num_units), dtype=np.int64)
+    # the accumulators not in use by a worker
+    free_accumulators = queue.Queue()
+
+    chunk_num_frames = int(chunk_duration_sec * sampling_frequency)
+    chunk_starts = list(range(0, num_frames, chunk_num_frames))
+    def get_chunk(i1: int):
+        # the spikes of the chunk, and the traces with margins for the snippets of the spikes near the edges of the chunk
+        i2 = min(i1 + chunk_num_frames, num_frames)
+        k1, k2 = np.searchsorted(sorted_frames, [i1, i2])
+        if k2 == k1:
+            return None, None, None
+        inds = order[k1:k2]
+        s1 = max(0, i1 - nb)
+        s2 = min(num_frames, i2 + na)
+        traces = recording.get_traces(segment_index=0, start_frame=s1, end_frame=s2).astype(np.float32)
+        traces *= gains
+        return inds, traces, s1
+
+    def accumulate_chunk(i1: int):
+        inds, traces, s1 = get_chunk(i1)
+        if inds is None:
+            return
+        sampled_inds = inds[sampled[inds]]
+        if len(sampled_inds) == 0:
+            return
+        # windows[j] is the view traces[j:j + T, :].T (no copy)
+        windows = np.lib.stride_tricks.sliding_window_view(traces, T, axis=0)
+        snippets = windows[all_frames[sampled_inds] - nb - s1].transpose(0, 2, 1)
+        units = all_units[sampled_inds]
+        a = free_accumulators.get()
+        try:
+            np.add.at(accumulators[a], units, snippets)
+            np.add.at(counts[a], units, 1)
+        finally:
+            free_accumulators.put(a)
+
+    template_channel_indices = np.zeros((num_units, K), dtype=np.int64)
+    sparse_templates = np.zeros((num_units, T, K), dtype=np.float32)
+    peak_channel_indices = np.zeros(num_units, dtype=np.int64)
+    # the offset (from the spike frame) of the peak of each template on its peak channel
+    peak_offsets = np.zeros(num_units, dtype=np.int64)
+    try:
+        for a, fname in enumerate(accumulator_fnames):
+            accumulators.append(np.memmap(fname, dtype=np.float32, mode='w+', shape=(num_units, T, num_channels)))
+            free_accumulators.put(a)
+        _for_each_chunk(accumulate_chunk, chunk_starts, num_workers=num_workers)
+        counts = np.sum(counts, axis=0)
+        for u in range(num_units):
+            # reduced into the first accumulator, and normalized in place
+            template = accumulators[0][u]
+            for accumulator in accumulators[1:]:
+                template += accumulator[u]
+            template /= max(counts[u], 1)
+            # keep the channels with the largest peak-to-peak amplitude (in channel order)
+            ptp = np.max(template, axis=0) - np.min(template, axis=0)
+            template_channel_indices[u] = np.sort(np.argsort(-ptp)[:K])
+            sparse_templates[u] = template[:, template_channel_indices[u]]
+            peak_channel_indices[u] = np.argmax(ptp)
+            peak_offsets[u] = np.argmax(np.abs(template[:, peak_channel_indices[u]])) - nb
+    finally:
+        del accumulators
+        for fname in accumulator_fnames:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    amplitudes = np.zeros(len(all_frames), dtype=np.float32)
+    def measure_chunk(i1: int):
+        inds, traces, s1 = get_chunk(i1)
+        if inds is None:
+            return
+        units = all_units[inds]
+        # within the traces of the chunk (the peak of a spike near the edges of the recording may be out of range)
+        frames = np.clip(all_frames[inds] + peak_offsets[units], s1, s1 + traces.shape[0] - 1)
+        amplitudes[inds] = np.abs(traces[frames - s1, peak_channel_indices[units]])
+
+    _for_each_chunk(measure_chunk, chunk_starts, num_workers=num_workers)
+
+    columns = {
+        'template': sparse_templates,
+        'template_channel_ids': channel_ids[template_channel_indices],
+        'peak_channel_id': channel_ids[peak_channel_indices],
+        'template_num_spikes': counts,
+        'spike_amplitudes': np.split(amplitudes, np.cumsum(num_spikes)[:-1]) if num_units > 0 else []
+    }
+    descriptions = {
+        'template': f'Mean waveform (uV, filtered) from {ms_before} ms before to {ms_after} ms after the spike ({T} samples) on the {K} channels of template_channel_ids',
+        'template_channel_ids': 'Channel ids of the channels of the template',
+        'peak_channel_id': 'Channel id of the channel with the largest template amplitude',
+        'template_num_spikes': 'Number of spikes averaged in the template',
+        'spike_amplitudes': 'Amplitude of each spike (uV, filtered, absolute value on the peak channel of the unit at the peak of the template), in the order of spike_times'
+    }
+    return {'columns': columns, 'descriptions': descriptions, 'indexed': ['spike_amplitudes']}
+
+def _for_each_chunk(process_chunk, chunk_starts: list, *, num_workers: int):
+    if num_workers <= 1:
+        for i1 in chunk_starts:
+            process_chunk(i1)
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            # consume the results so that exceptions are raised
+            for _ in executor.map(process_chunk, chunk_starts):
+                pass
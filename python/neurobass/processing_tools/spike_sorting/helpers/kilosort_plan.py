@@ -0,0 +1,157 @@
+from typing import Union
+import os
+import subprocess
+
+
+# Planning of the Kilosort batch size (NT) from the shape of the recording and
+# the resources of the node.
+#
+# Larger batches mean fewer kernel launches and fewer passes over the
+# temporary whitened file, but the GPU must hold several float32 copies of
+# each batch (raw, filtered, whitened, residuals, ...) plus the templates, and
+# the drift correction works at the resolution of one batch.
+
+# number of float32 copies of a batch (including the buffers) held on the GPU at once (conservative)
+_gpu_batch_copies = 12
+# fraction of the free GPU / host memory that may be used
+_gpu_memory_fraction = 0.6
+_host_memory_fraction = 0.25
+# the Kilosort default (64 * 1024 samples) corresponds to ~2.2 s at 30 kHz
+_target_batch_duration_sec = 65536 / 30000
+# without drift correction, batches may be longer
+_max_batch_duration_sec_no_correction = 4 * _target_batch_duration_sec
+_min_batch_num_samples = 8192
+
+def plan_kilosort_batches(
+    *,
+    num_channels: int,
+    sampling_frequency: float,
+    num_samples: int,
+    params: dict,
+    gpu_memory_bytes: Union[int, None]=None,
+    host_memory_bytes: Union[int, None]=None
+) -> dict:
+    """Choose the Kilosort batch size (NT) and related parameters
+
+    Args:
+        num_channels (int): number of channels of the recording
+        sampling_frequency (float): sampling frequency in Hz
+        num_samples (int): number of samples of the recording
+        params (dict): the sorting parameters (ntbuff, wave_length, do_correction, Nfilt, NT)
+        gpu_memory_bytes (Union[int, None]): free GPU memory (if None, it is queried)
+        host_memory_bytes (Union[int, None]): available host memory (if None, it is queried)
+
+    Returns:
+        dict: the plan ({NT, Nfilt, useRAM, reasons, ...}). NT and Nfilt are the values given in params if set.
+    """
+    if gpu_memory_bytes is None:
+        gpu_memory_bytes = get_gpu_free_memory_bytes()
+    if host_memory_bytes is None:
+        host_memory_bytes = get_host_available_memory_bytes()
+    ntbuff = params['ntbuff']
+    nt0 = params['wave_length']
+    reasons = []
+
+    # max number of templates: as in SpikeInterface, unless the GPU memory
+    # would not leave room for a batch of the minimum size
+    template_bytes_per_filter = 4 * (nt0 * num_channels + 3 * (nt0 + num_channels))
+    if params.get('Nfilt', None) is not None:
+        Nfilt = params['Nfilt'] // 32 * 32
+        reasons.append('Nfilt set manually')
+    else:
+        Nfilt = (num_channels // 32) * 32 * 8
+    if Nfilt == 0:
+        Nfilt = num_channels * 8
+    if params.get('Nfilt', None) is None and gpu_memory_bytes is not None:
+        budget = gpu_memory_bytes * _gpu_memory_fraction - _gpu_batch_copies * 4 * num_channels * (_min_batch_num_samples + 3 * ntbuff)
+        max_Nfilt = int(budget // template_bytes_per_filter) // 32 * 32
+        if max_Nfilt < Nfilt:
+            Nfilt = max(32, max_Nfilt)
+            reasons.append('Nfilt limited by gpu_memory')
+    # templates and their spatial/temporal components, float32
+    template_bytes = Nfilt * template_bytes_per_filter
+
+    if params.get('NT', None) is not None:
+        NT = params['NT'] // 32 * 32
+        reasons.append('NT set manually')
+    else:
+        max_duration_sec = _target_batch_duration_sec if params.get('do_correction', True) else _max_batch_duration_sec_no_correction
+        candidates = {'duration': int(max_duration_sec * sampling_frequency)}
+        if gpu_memory_bytes is not None:
+            budget = gpu_memory_bytes * _gpu_memory_fraction - template_bytes
+            candidates['gpu_memory'] = int(budget / (_gpu_batch_copies * 4 * num_channels)) - 3 * ntbuff
+        if host_memory_bytes is not None:
+            # batches are read as int16 and converted to float32 on the host
+            budget = host_memory_bytes * _host_memory_fraction
+            candidates['host_memory'] = int(budget / (6 * 3 * num_channels)) - 3 * ntbuff
+        # no point in batches longer than the recording (including the buffer)
+        candidates['recording_length'] = num_samples - ntbuff
+        limiting = min(candidates, key=lambda k: candidates[k])
+        NT = max(_min_batch_num_samples, candidates[limiting])
+        # even if the recording is shorter than the minimum batch
+        NT = min(NT, candidates['recording_length'])
+        NT = NT // 32 * 32 + ntbuff
+        reasons.append(f'NT limited by {limiting}')
+        if gpu_memory_bytes is None:
+            reasons.append('GPU memory unknown')
+
+    # Kilosort keeps the whitened data in a temporary file; keeping it in RAM
+    # is not implemented in the compiled Kilosort 3 (ops.useRAM is ignored)
+    useRAM = 0
+    reasons.append('useRAM is not supported by Kilosort 3')
+
+    return {
+        'NT': int(NT),
+        'Nfilt': int(Nfilt),
+        'useRAM': useRAM,
+        'batch_duration_sec': NT / sampling_frequency,
+        'num_batches': int(-(-num_samples // (NT - ntbuff))) if NT > ntbuff else None,
+        'estimated_gpu_memory_bytes': int(_gpu_batch_copies * 4 * num_channels * (NT + 3 * ntbuff) + template_bytes),
+        'gpu_memory_bytes': gpu_memory_bytes,
+        'host_memory_bytes': host_memory_bytes,
+        'reasons': reasons
+    }
+
+def get_gpu_free_memory_bytes() -> Union[int, None]:
+    """Get the free memory of the first GPU, or None if it cannot be determined"""
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+        try:
+            h = pynvml.nvmlDeviceGetHandleByIndex(0)
+            return int(pynvml.nvmlDeviceGetMemoryInfo(h).free)
+        finally:
+            pynvml.nvmlShutdown()
+    except Exception:
+        pass
+    try:
+        out = subprocess.run(
+            ['nvidia-smi', '--query-gpu=memory.free', '--format=csv,noheader,nounits'],
+            capture_output=True, text=True, timeout=10
+        )
+        if out.returncode == 0 and out.stdout.strip():
+            # MiB
+            return int(out.stdout.strip().splitlines()[0]) * 1024 * 1024
+    except Exception:
+        pass
+    return None
+
+def get_host_available_memory_bytes() -> Union[int, None]:
+    """Get the available host memory (taking into account the memory limit of the job), or None if it cannot be determined"""
+    ret = None
+    if os.path.exists('/proc/meminfo'):
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    ret = int(line.split()[1]) * 1024
+    # cgroup v2 memory limit (see job_resources.py)
+    try:
+        with open('/proc/self/cgroup', 'r') as f:
+            cgroup_path = f.read().strip().split('::')[-1]
+        with open(f'/sys/fs/cgroup{cgroup_path}/memory.max', 'r') as f:
+            x = f.read().strip()
+        if x != 'max':
+            ret = min(ret, int(x)) if ret is not None else int(x)
+    except Exception:
+        pass
+    return ret
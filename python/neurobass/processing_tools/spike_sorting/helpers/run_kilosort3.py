@@ -1,9 +1,14 @@
 import os
+import json
 from pathlib import Path
+from typing import Union
 import subprocess
 import numpy as np
 import spikeinterface as si
 import spikeinterface.extractors as se
+from ....container_images import resolve_singularity_image
+from .container_pool import WarmContainerPool, get_container_pool_size, get_container_pool_shared_dir
+from .kilosort_plan import plan_kilosort_batches
 
 # from SpikeInterface (kilosort.py)
 _default_params = {
@@ -90,6 +95,30 @@ _compiled_name = "ks3_compiled"
 
 _container_image = "spikeinterface/kilosort3-compiled-base"
 
+def get_kilosort3_container_pool(container_method: str, *, env: Union[dict, None]=None) -> Union[WarmContainerPool, None]:
+    """Return the node-level pool of warm kilosort3 containers, or None if pooling is disabled
+
+    Pooling is enabled by setting CONTAINER_POOL_SIZE to a positive number on the compute resource node.
+
+    Args:
+        container_method (str): 'docker' or 'singularity'
+        env (dict, optional): the configuration of the node (default: the environment)
+    """
+    if container_method not in ['docker', 'singularity']:
+        return None
+    pool_size = get_container_pool_size(env)
+    shared_dir = get_container_pool_shared_dir(env)
+    if pool_size <= 0 or shared_dir is None:
+        return None
+    return WarmContainerPool(
+        pool_name='kilosort3',
+        image=_container_image,
+        container_method=container_method,
+        shared_dir=shared_dir,
+        pool_size=pool_size,
+        gpu=True
+    )
+
 def run_kilosort3(
     *,
     recording: si.BinaryRecordingExtractor,
@@ -100,7 +129,7 @@ def run_kilosort3(
 ) -> si.BaseSorting:
     # check recording
     if recording.get_num_segments() > 1:
-        raise NotImplementedError("Multi-segment recordings are not supported yet")
+        raise NotImplementedError("Kilosort 3 requires a single-segment binary recording (multiple segments must be written to one file first)")
     if recording.dtype != "int16":
         raise ValueError("Recording dtype must be int16")
     
@@ -117,7 +146,8 @@ def run_kilosort3(
     print('Setting params...')
     params = _default_params.copy()
     params.update(sorting_params)
-    _check_params(recording, params)
+    params, plan = _check_params(recording, params)
+    print(f'Batch plan: NT={plan["NT"]} ({plan["batch_duration_sec"]:.2f} sec, {plan["num_batches"]} batches), Nfilt={plan["Nfilt"]}, useRAM={plan["useRAM"]}, estimated GPU memory {plan["estimated_gpu_memory_bytes"] / 1e9:.2f} GB ({"; ".join(plan["reasons"])})')
 
     # check for invalid params
     for k, v in params.items():
@@ -129,6 +159,8 @@ def run_kilosort3(
     binary_file_path = Path(binary_file_path)
 
     sorter_output_folder = Path(output_folder)
+    with open(sorter_output_folder / 'kilosort3_plan.json', 'w') as f:
+        json.dump(plan, f, indent=2)
     
     # Generate opts.mat file
     print('Generating opts.mat file...')
@@ -175,9 +207,26 @@ def run_kilosort3(
         str(sorter_output_folder.absolute()): {"bind": str(sorter_output_folder.absolute()), "mode": "rw"}
     }
 
-    command_in_container = f'{_compiled_name} {str(sorter_output_folder.absolute())}'
-    
-    if use_docker:
+    command_in_container = [_compiled_name, str(sorter_output_folder.absolute())]
+
+    # use a warm container from the node-level pool when available
+    container_pool = get_kilosort3_container_pool('docker' if use_docker else 'singularity' if use_singularity else 'none')
+    if container_pool is not None:
+        shared_dir = Path(container_pool.shared_dir)
+        for volume_src in volumes.keys():
+            if not Path(volume_src).is_relative_to(shared_dir):
+                print(f'Not using container pool because {volume_src} is not in {shared_dir}')
+                container_pool = None
+                break
+
+    if container_pool is not None:
+        print(f'Using warm {container_pool.container_method} container from pool...')
+        with container_pool.acquire() as container:
+            print(f'Executing command in container {container.name}: {" ".join(command_in_container)}')
+            exit_code = container.exec(command_in_container)
+        if exit_code != 0:
+            raise Exception(f'Kilosort3 exited with code {exit_code}')
+    elif use_docker:
         print('Using docker (THIS METHOD HAS NOT YET BEEN TESTED)...')
         import docker
         client = docker.from_env()
@@ -196,31 +245,17 @@ def run_kilosort3(
             docker_container.remove()
     elif use_singularity:
         print('Using singularity...')
-        from spython.main import Client
-
-        # load local image file if it exists, otherwise search dockerhub
-        sif_file = Client._get_filename(_container_image)
-        singularity_image = None
-        if Path(_container_image).exists():
-            singularity_image = _container_image
-        elif Path(sif_file).exists():
-            singularity_image = sif_file
-        else:
-            print(f"Singularity: pulling image {_container_image}")
-            singularity_image = Client.pull(f"docker://{_container_image}")
-
-        if not Path(singularity_image).exists():
-            raise FileNotFoundError(f"Unable to locate container image {_container_image}")
+        singularity_image = resolve_singularity_image(_container_image)
 
         # bin options
         singularity_bind = ",".join([f'{volume_src}:{volume["bind"]}' for volume_src, volume in volumes.items()])
         options = ["--bind", singularity_bind]
         options += ["--nv"]
 
-        singularity_cmd = f'singularity exec {" ".join(options)} {singularity_image} {command_in_container}'
+        singularity_cmd = ['singularity', 'exec', *options, singularity_image, *command_in_container]
 
-        print(f'Executing command in singularity container: {singularity_cmd}')
-        subprocess.run(singularity_cmd, shell=True)
+        print(f'Executing command in singularity container: {" ".join(singularity_cmd)}')
+        subprocess.run(singularity_cmd)
 
         # For some reason, the below was not working for me
         # client_instance = Client.instance(singularity_image, start=False, options=options)
@@ -404,22 +439,20 @@ def _generate_channel_map_file(recording, sorter_output_folder):
 
     scipy.io.savemat(str(sorter_output_folder / "chanMap.mat"), channel_map)
 
-# From SpikeInterface
+# Adapted from SpikeInterface (NT and Nfilt are planned from the recording and the node resources)
 def _check_params(recording, params):
     p = params
     nchan = recording.get_num_channels()
-    if p["Nfilt"] is None:
-        p["Nfilt"] = (nchan // 32) * 32 * 8
-    else:
-        p["Nfilt"] = p["Nfilt"] // 32 * 32
-    if p["Nfilt"] == 0:
-        p["Nfilt"] = nchan * 8
-    if p["NT"] is None:
-        p["NT"] = 64 * 1024 + p["ntbuff"]
-    else:
-        p["NT"] = p["NT"] // 32 * 32  # make sure is multiple of 32
     if p["wave_length"] % 2 != 1:
         p["wave_length"] = p["wave_length"] + 1  # The wave_length must be odd
     if p["wave_length"] > 81:
         p["wave_length"] = 81  # The wave_length must be less than 81.
-    return p
\ No newline at end of file
+    plan = plan_kilosort_batches(
+        num_channels=nchan,
+        sampling_frequency=recording.get_sampling_frequency(),
+        num_samples=recording.get_num_samples(segment_index=0),
+        params=p
+    )
+    p["Nfilt"] = plan["Nfilt"]  # multiple of 32 (nchan * 8 if that is 0)
+    p["NT"] = plan["NT"]  # multiple of 32 (+ ntbuff when planned)
+    return p, plan
\ No newline at end of file
@@ -2,7 +2,7 @@ import os
 import shutil
 import spikeinterface as si
 import spikeinterface.extractors as se
-from run_kilosort3 import run_kilosort3
+from neurobass.processing_tools.spike_sorting.helpers.run_kilosort3 import run_kilosort3
 
 
 def main():
@@ -0,0 +1,193 @@
+from typing import Union
+import numpy as np
+import spikeinterface as si
+
+
+# Per-unit summaries computed at the end of a sorting job, while the sorting
+# is still in memory, and stored as columns of the units table of the output
+# NWB file (see create_sorting_out_nwb_file). Viewers can then show
+# autocorrelograms, firing rates, etc. by reading a few small columns rather
+# than the full spike_times column.
+
+def compute_unit_summaries(
+    sorting: si.BaseSorting,
+    *,
+    num_frames: int,
+    recording: Union[si.BaseRecording, None]=None,
+    isi_threshold_msec: float=1.5,
+    autocorrelogram_bin_size_msec: float=1,
+    autocorrelogram_window_msec: float=50,
+    num_raster_bins: int=400,
+    amplitude_percentiles: tuple=(5, 25, 50, 75, 95),
+    num_amplitude_chunks: int=10,
+    amplitude_chunk_duration_sec: float=1
+) -> dict:
+    """Compute per-unit summaries of a (single-segment) sorting
+
+    Args:
+        sorting (si.BaseSorting): the sorting
+        num_frames (int): number of frames of the sorted recording
+        recording (si.BaseRecording, optional): the (filtered) recording, for the spike amplitudes
+        isi_threshold_msec (float): inter-spike intervals shorter than this are violations
+        autocorrelogram_bin_size_msec (float): bin size of the autocorrelograms
+        autocorrelogram_window_msec (float): the autocorrelograms cover lags in (0, window]
+        num_raster_bins (int): number of time bins of the downsampled raster
+        amplitude_percentiles (tuple): the percentiles of the spike amplitudes to compute
+        num_amplitude_chunks (int): number of chunks of the recording, sampled uniformly, from which the amplitudes are computed
+        amplitude_chunk_duration_sec (float): duration of each of those chunks
+
+    Returns:
+        dict: {columns, descriptions} - columns maps a column name to an array with one row per unit (in the order of sorting.get_unit_ids())
+    """
+    sampling_frequency = sorting.get_sampling_frequency()
+    duration_sec = num_frames / sampling_frequency
+    unit_ids = sorting.get_unit_ids()
+    spike_trains = [np.sort(np.asarray(sorting.get_unit_spike_train(unit_id), dtype=np.int64)) for unit_id in unit_ids]
+    num_spikes = np.array([len(st) for st in spike_trains], dtype=np.int64)
+
+    isi_threshold_frames = isi_threshold_msec / 1000 * sampling_frequency
+    isi_violation_rate = np.array([
+        np.count_nonzero(np.diff(st) < isi_threshold_frames) / (len(st) - 1) if len(st) > 1 else 0
+        for st in spike_trains
+    ], dtype=np.float32)
+
+    bin_size_frames = autocorrelogram_bin_size_msec / 1000 * sampling_frequency
+    num_acg_bins = int(round(autocorrelogram_window_msec / autocorrelogram_bin_size_msec))
+    autocorrelograms = np.array([
+        _autocorrelogram(st, bin_size_frames=bin_size_frames, num_bins=num_acg_bins)
+        for st in spike_trains
+    ], dtype=np.uint32).reshape(len(unit_ids), num_acg_bins)
+
+    # spike counts in equal time bins (all units at once)
+    unit_indices = np.repeat(np.arange(len(unit_ids)), num_spikes)
+    all_frames = np.concatenate(spike_trains) if len(spike_trains) > 0 else np.zeros(0, dtype=np.int64)
+    raster_bins = np.clip(all_frames * num_raster_bins // max(num_frames, 1), 0, num_raster_bins - 1)
+    raster = np.bincount(unit_indices * num_raster_bins + raster_bins, minlength=len(unit_ids) * num_raster_bins)
+    raster = np.minimum(raster, np.iinfo(np.uint16).max).astype(np.uint16).reshape(len(unit_ids), num_raster_bins)
+
+    columns = {
+        'num_spikes': num_spikes,
+        'firing_rate': (num_spikes / duration_sec).astype(np.float32),
+        'isi_violation_rate': isi_violation_rate,
+        'autocorrelogram': autocorrelograms,
+        'spike_count_raster': raster
+    }
+    descriptions = {
+        'num_spikes': 'Number of spikes',
+        'firing_rate': 'Mean firing rate (Hz) over the sorted time window',
+        'isi_violation_rate': f'Fraction of inter-spike intervals shorter than {isi_threshold_msec} ms',
+        'autocorrelogram': f'Autocorrelogram: number of spike pairs at lags in {num_acg_bins} bins of {autocorrelogram_bin_size_msec} ms from 0 to {autocorrelogram_window_msec} ms (the autocorrelogram is symmetric)',
+        'spike_count_raster': f'Number of spikes in {num_raster_bins} bins of {duration_sec / num_raster_bins:.6g} s spanning the sorted time window'
+    }
+    if recording is not None:
+        columns['amplitude_percentiles'] = _compute_amplitude_percentiles(
+            recording,
+            spike_trains,
+            percentiles=amplitude_percentiles,
+            num_chunks=num_amplitude_chunks,
+            chunk_duration_sec=amplitude_chunk_duration_sec
+        )
+        descriptions['amplitude_percentiles'] = f'Percentiles {", ".join(str(p) for p in amplitude_percentiles)} of the spike amplitudes (uV, absolute value on the peak channel of the unit at the peak of its mean waveform, from {num_amplitude_chunks} sampled chunks of {amplitude_chunk_duration_sec} s; NaN if no spikes were sampled)'
+    return {'columns': columns, 'descriptions': descriptions}
+
+def _autocorrelogram(st: np.ndarray, *, bin_size_frames: float, num_bins: int) -> np.ndarray:
+    # counts of the differences st[i + k] - st[i] within the window, for
+    # increasing k until no pair is within the window
+    window = bin_size_frames * num_bins
+    ret = np.zeros(num_bins, dtype=np.int64)
+    for k in range(1, len(st)):
+        d = st[k:] - st[:-k]
+        d = d[d < window]
+        if len(d) == 0:
+            break
+        ret += np.bincount((d / bin_size_frames).astype(np.int64), minlength=num_bins)[:num_bins]
+    return ret
+
+def _compute_amplitude_percentiles(recording: si.BaseRecording, spike_trains: list, *, percentiles: tuple, num_chunks: int, chunk_duration_sec: float, ms_before: float=1, ms_after: float=2, num_channels_per_unit: int=16) -> np.ndarray:
+    # the amplitudes of the spikes that fall within chunks sampled uniformly
+    # across the recording - the recording is only read in those chunks. As in
+    # extract_templates, the amplitude of a spike is the absolute value on the
+    # peak channel of its unit, at the offset of the peak of the unit's mean
+    # waveform. So that the memory does not grow with units x channels, the
+    # mean waveform is only computed on a neighbourhood of channels of each
+    # unit: those where the snippets of its spikes have the largest mean
+    # peak-to-peak amplitude
+    sampling_frequency = recording.get_sampling_frequency()
+    num_frames = recording.get_num_samples(segment_index=0)
+    num_channels = recording.get_num_channels()
+    chunk_num_frames = int(chunk_duration_sec * sampling_frequency)
+    nb = int(ms_before / 1000 * sampling_frequency)
+    na = int(ms_after / 1000 * sampling_frequency)
+    T = nb + na
+    num_units = len(spike_trains)
+    unit_indices = np.repeat(np.arange(num_units), [len(st) for st in spike_trains])
+    all_frames = np.concatenate(spike_trains) if num_units > 0 else np.zeros(0, dtype=np.int64)
+    if num_frames <= num_chunks * chunk_num_frames:
+        chunk_starts = np.arange(0, num_frames, chunk_num_frames)
+    else:
+        chunk_starts = np.linspace(0, num_frames - chunk_num_frames, num_chunks).astype(int)
+    chunks = []
+    for i1 in chunk_starts:
+        i2 = min(i1 + chunk_num_frames, num_frames)
+        inds = np.nonzero((all_frames >= i1) & (all_frames < i2))[0]
+        if len(inds) > 0:
+            chunks.append((int(i1), int(i2), inds))
+    ret = np.full((num_units, len(percentiles)), np.nan, dtype=np.float32)
+    if len(chunks) == 0:
+        return ret
+
+    # only the spikes whose snippet is within the chunk are used for the mean waveforms
+    chunks = [(i1, i2, inds, inds[(all_frames[inds] - nb >= i1) & (all_frames[inds] + na <= i2)]) for i1, i2, inds in chunks]
+
+    # the channel neighbourhoods of the units (the snippets on all the channels are handled in batches, to bound the memory)
+    K = min(num_channels_per_unit, num_channels)
+    ptp_sums = np.zeros((num_units, num_channels), dtype=np.float64)
+    batch_size = 64
+    for i1, i2, inds, snippet_inds in chunks:
+        traces = _get_traces_uV(recording, i1, i2)
+        windows = np.lib.stride_tricks.sliding_window_view(traces, T, axis=0)
+        for b in range(0, len(snippet_inds), batch_size):
+            batch = snippet_inds[b:b + batch_size]
+            np.add.at(ptp_sums, unit_indices[batch], np.ptp(windows[all_frames[batch] - nb - i1], axis=2))
+    neighbourhoods = np.argsort(-ptp_sums, axis=1)[:, :K]
+
+    # the mean waveforms of the units on their neighbourhoods
+    sums = np.zeros((num_units, K, T), dtype=np.float32)
+    for i1, i2, inds, snippet_inds in chunks:
+        if len(snippet_inds) == 0:
+            continue
+        traces = _get_traces_uV(recording, i1, i2)
+        # windows[j] is the view traces[j:j + T, :].T (no copy)
+        windows = np.lib.stride_tricks.sliding_window_view(traces, T, axis=0)
+        units = unit_indices[snippet_inds]
+        np.add.at(sums, units, windows[(all_frames[snippet_inds] - nb - i1)[:, None], neighbourhoods[units]])
+    k = np.argmax(np.max(sums, axis=2) - np.min(sums, axis=2), axis=1)
+    peak_channel_indices = neighbourhoods[np.arange(num_units), k]
+    peak_offsets = np.argmax(np.abs(sums[np.arange(num_units), k, :]), axis=1) - nb
+
+    amplitudes = []
+    amplitude_unit_indices = []
+    for i1, i2, inds, snippet_inds in chunks:
+        traces = _get_traces_uV(recording, i1, i2)
+        units = unit_indices[inds]
+        frames = np.clip(all_frames[inds] + peak_offsets[units], i1, i2 - 1)
+        amplitudes.append(np.abs(traces[frames - i1, peak_channel_indices[units]]))
+        amplitude_unit_indices.append(units)
+    amplitudes = np.concatenate(amplitudes)
+    amplitude_unit_indices = np.concatenate(amplitude_unit_indices)
+    order = np.argsort(amplitude_unit_indices, kind='stable')
+    amplitudes = amplitudes[order]
+    boundaries = np.searchsorted(amplitude_unit_indices[order], np.arange(num_units + 1))
+    for u in range(num_units):
+        a = amplitudes[boundaries[u]:boundaries[u + 1]]
+        if len(a) > 0:
+            ret[u, :] = np.percentile(a, percentiles)
+    return ret
+
+def _get_traces_uV(recording: si.BaseRecording, i1: int, i2: int) -> np.ndarray:
+    # the offsets are not applied: the recording is filtered
+    traces = recording.get_traces(segment_index=0, start_frame=i1, end_frame=i2).astype(np.float32)
+    gains = recording.get_channel_gains()
+    if gains is not None:
+        traces = traces * np.asarray(gains, dtype=np.float32)
+    return traces
@@ -0,0 +1,122 @@
+from typing import Union
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import spikeinterface as si
+
+
+# Staging of a recording as a single int16 binary file (the format expected by
+# kilosort). Recordings that are not int16 (e.g., float32 in microvolts) are
+# scaled per channel to use the int16 range, and the resulting gains are
+# returned so that amplitudes can be mapped back.
+
+# the robust peak of a channel (see compute_int16_scales) is mapped to this fraction of the int16 range
+_int16_target_fraction = 0.9
+# spikes can be much larger than the bulk of the samples, so leave headroom above the 99.9th percentile
+_percentile_headroom = 10
+
+def compute_int16_scales(recording: si.BaseRecording, *, num_chunks: int=20, chunk_duration_sec: float=1) -> np.ndarray:
+    """Compute a per-channel scale factor for converting a recording to int16
+
+    The scale is computed from chunks sampled uniformly across the recording,
+    so that the larger of 10 times the 99.9th percentile of |x| and the max of
+    |x| (over the sampled chunks) maps to 90% of the int16 range.
+
+    Returns:
+        np.ndarray: the scale factor of each channel (int16 value = x * scale)
+    """
+    chunk_num_frames = int(chunk_duration_sec * recording.get_sampling_frequency())
+    chunks = []
+    for segment_index in range(recording.get_num_segments()):
+        num_frames = recording.get_num_samples(segment_index=segment_index)
+        n = max(1, num_chunks // recording.get_num_segments())
+        for i1 in np.linspace(0, max(0, num_frames - chunk_num_frames), n).astype(int):
+            i2 = min(i1 + chunk_num_frames, num_frames)
+            chunks.append(np.abs(recording.get_traces(segment_index=segment_index, start_frame=int(i1), end_frame=int(i2)).astype(np.float32)))
+    x = np.concatenate(chunks, axis=0)
+    peak = np.maximum(np.percentile(x, 99.9, axis=0) * _percentile_headroom, np.max(x, axis=0))
+    scales = np.ones(recording.get_num_channels(), dtype=np.float64)
+    nonzero = peak > 0
+    scales[nonzero] = _int16_target_fraction * 32767 / peak[nonzero]
+    return scales
+
+def write_int16_binary_recording(
+    recording: si.BaseRecording,
+    fname: str,
+    *,
+    chunk_duration_sec: float=10,
+    num_workers: int=1,
+    scales: Union[np.ndarray, None]=None
+) -> dict:
+    """Write a recording to a single-segment int16 binary file
+
+    Segments are written one after the other. The chunks are read, converted
+    and written directly at their offset in the file by a pool of threads, so
+    neither the recording nor the converted data is ever held in full.
+
+    Args:
+        recording (si.BaseRecording): the recording (any dtype, any number of segments)
+        fname (str): the output file
+        chunk_duration_sec (float): duration of the chunks
+        num_workers (int): number of threads
+        scales (np.ndarray, optional): per-channel scale factors (computed with compute_int16_scales if None and the recording is not int16)
+
+    Returns:
+        dict: {scales, gain_to_uV, offset_to_uV} - the scale factors applied and the resulting gains of the int16 data
+    """
+    num_channels = recording.get_num_channels()
+    is_int16 = recording.get_dtype() == np.int16
+    if is_int16:
+        scales = None
+    elif scales is None:
+        scales = compute_int16_scales(recording)
+    scales_float32 = scales.astype(np.float32) if scales is not None else None
+
+    chunk_num_frames = int(chunk_duration_sec * recording.get_sampling_frequency())
+    tasks = []
+    offset_bytes = 0
+    for segment_index in range(recording.get_num_segments()):
+        num_frames = recording.get_num_samples(segment_index=segment_index)
+        for i1 in range(0, num_frames, chunk_num_frames):
+            i2 = min(i1 + chunk_num_frames, num_frames)
+            tasks.append((segment_index, i1, i2, offset_bytes))
+            offset_bytes += (i2 - i1) * num_channels * 2
+
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, offset_bytes)
+        def write_chunk(task):
+            segment_index, i1, i2, offset = task
+            traces = recording.get_traces(segment_index=segment_index, start_frame=i1, end_frame=i2)
+            if scales_float32 is None:
+                x = np.ascontiguousarray(traces, dtype=np.int16)
+            else:
+                # convert in place in a single float32 buffer
+                y = np.array(traces, dtype=np.float32)
+                np.multiply(y, scales_float32, out=y)
+                np.rint(y, out=y)
+                np.clip(y, -32768, 32767, out=y)
+                x = y.astype(np.int16)
+            os.pwrite(fd, x.tobytes(), offset)
+        if num_workers <= 1:
+            for task in tasks:
+                write_chunk(task)
+        else:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                # consume the results so that exceptions are raised
+                for _ in executor.map(write_chunk, tasks):
+                    pass
+    finally:
+        os.close(fd)
+
+    gains = recording.get_channel_gains()
+    offsets = recording.get_channel_offsets()
+    gains = np.array(gains, dtype=np.float64) if gains is not None else np.ones(num_channels)
+    offsets = np.array(offsets, dtype=np.float64) if offsets is not None else np.zeros(num_channels)
+    if scales is not None:
+        gains = gains / scales
+    return {
+        'scales': scales.tolist() if scales is not None else None,
+        'gain_to_uV': gains.tolist(),
+        'offset_to_uV': offsets.tolist()
+    }
@@ -5,6 +5,8 @@ from uuid import uuid4
 import importlib
 import inspect
 from .init_compute_resource_node import env_var_keys
+from .JobCache import JobCache
+from .MultipartUpload import MultipartUploadStream, ProgressiveFileUpload
 
 import boto3
 
@@ -33,7 +35,7 @@ def run_job():
         def register_processing_tool(self, tool: NeurobassPlugin):
             processing_tools.append(tool)
     plugin_context = NeurobassPluginContextImpl()
-    plugin_package_names = ['neurobass']
+    plugin_package_names = ['neurobass'] + [x for x in os.environ.get('NEUROBASS_PLUGIN_PACKAGES', '').split(',') if x]
     for plugin_package_name in plugin_package_names:
         module = importlib.import_module(plugin_package_name)
         for attr_name in dir(module):
@@ -59,10 +61,14 @@ def run_job():
         raise ValueError(f'Processing tool not found: {tool_name}')
     
     class NeurobassProcessingToolContextImpl(NeurobassProcessingToolContext):
+        def __init__(self):
+            # validated once, with the compiled validator of the tool - the
+            # tool gets this instance from get_validated_data
+            self._validated_data = tool.get_descriptor().validate(self.get_data())
         def get_data(self) -> Any:
             d = {}
             for x in job['input_files']:
-                d[x['name']] = InputFile(name=x['name'], path=x['path'], content_string=x['content_string'])
+                d[x['name']] = InputFile(name=x['name'], path=x['path'], content_string=x.get('content_string', ''), content_file=x.get('content_file', None))
             for x in job['output_files']:
                 d[x['name']] = OutputFile(name=x['name'], path=x['path'])
             for x in job['parameters']:
@@ -75,17 +81,39 @@ def run_job():
                 raise ValueError(f'Unexpected content string: {x}')
             return x[len('url:'):]
         def upload_output_file(self, output_file: OutputFile, path: str):
-            random_output_id = str(uuid4())[0:8]
-            basename = os.path.basename(path)
-            s3.upload_file(path, OUTPUT_BUCKET, f'neurobass-dev/{random_output_id}/{basename}')
-            # for now we hard-code neurosift.org
-            url = f'{OUTPUT_BUCKET_BASE_URL}/neurobass-dev/{random_output_id}/{basename}'
-            with open (f'outputs/{output_file.name}.json', 'w') as f:
-                out = {
-                    'url': url,
-                    'size': os.path.getsize(path)
-                }
-                json.dump(out, f)
+            with self.span('upload'):
+                self._upload_output_file(output_file, path)
+            self.counter('bytes_uploaded', os.path.getsize(path))
+        def _upload_output_file(self, output_file: OutputFile, path: str):
+            key = _get_output_key(os.path.basename(path))
+            s3.upload_file(path, OUTPUT_BUCKET, key)
+            _write_output_record(output_file, key, os.path.getsize(path))
+        def open_output_file(self, output_file: OutputFile, file_name: str):
+            # streamed to the bucket as it is written (concurrent multipart upload)
+            key = _get_output_key(file_name)
+            def on_complete(size: int):
+                _write_output_record(output_file, key, size)
+                self.counter('bytes_uploaded', size)
+            return MultipartUploadStream(s3, bucket=OUTPUT_BUCKET, key=key, on_complete=on_complete)
+        def upload_output_file_progressively(self, output_file: OutputFile, path: str):
+            key = _get_output_key(os.path.basename(path))
+            def on_complete(size: int):
+                _write_output_record(output_file, key, size)
+                self.counter('bytes_uploaded', size)
+            return ProgressiveFileUpload(s3, bucket=OUTPUT_BUCKET, key=key, path=path, on_complete=on_complete)
+
+    def _get_output_key(file_name: str):
+        random_output_id = str(uuid4())[0:8]
+        return f'neurobass-dev/{random_output_id}/{file_name}'
+    def _write_output_record(output_file: OutputFile, key: str, size: int):
+        # for now we hard-code neurosift.org
+        url = f'{OUTPUT_BUCKET_BASE_URL}/{key}'
+        with open (f'outputs/{output_file.name}.json', 'w') as f:
+            out = {
+                'url': url,
+                'size': size
+            }
+            json.dump(out, f)
     
     print(f'Running job: {tool_name}')
     for x in job['input_files']:
@@ -96,7 +124,54 @@ def run_job():
         print(f'  Parameter: {x["name"]}: {x["value"]}')
 
     # Create the context and run the tool, which will produce the output files
-    tool.run(NeurobassProcessingToolContextImpl())
+    # (the context fails early if the data does not match the model of the tool)
+    context = NeurobassProcessingToolContextImpl()
+    data = context.get_validated_data(tool.get_model())
+    metrics = context.get_metrics()
+    metrics.start()
+    try:
+        # Reuse the outputs of an identical previous job, if available
+        job_cache = JobCache(os.path.join(os.environ.get('COMPUTE_RESOURCE_DIR', '../..'), 'job_cache'))
+        cache_key = None
+        try:
+            with context.span('job_cache_lookup'):
+                cache_key = job_cache.compute_key(tool=tool, data=data)
+                cache_entry = job_cache.lookup(cache_key) if cache_key is not None else None
+        except Exception as e:
+            print(f'Warning: unable to use the job cache: {str(e)}')
+            cache_entry = None
+        if cache_entry is not None and all(x['name'] in cache_entry['outputs'] for x in job['output_files']):
+            print(f'Reusing the outputs of a previous identical job (cache key {cache_key})')
+            for x in job['output_files']:
+                with open(f'outputs/{x["name"]}.json', 'w') as f:
+                    json.dump(cache_entry['outputs'][x['name']], f)
+            context.counter('job_cache_hit')
+            try:
+                job_cache.record('hit', tool_name=tool_name, time_saved_sec=cache_entry['elapsed_sec'])
+            except Exception as e:
+                print(f'Warning: unable to record the job cache hit: {str(e)}')
+        else:
+            with context.span('run'):
+                tool.run(context)
+            # the outputs are uploaded, so a resubmitted job would not need the checkpoints
+            checkpoints = getattr(context, '_checkpoints', None)
+            if checkpoints is not None:
+                checkpoints.discard()
+            # the outputs are uploaded: never fail the job because of the cache
+            try:
+                if cache_key is not None and all(os.path.exists(f'outputs/{x["name"]}.json') for x in job['output_files']):
+                    outputs = {}
+                    for x in job['output_files']:
+                        with open(f'outputs/{x["name"]}.json', 'r') as f:
+                            outputs[x['name']] = json.load(f)
+                    job_cache.store(cache_key, tool_name=tool_name, outputs=outputs, elapsed_sec=metrics.to_dict()['elapsed_sec'])
+                job_cache.record('miss' if cache_key is not None else 'uncacheable', tool_name=tool_name)
+            except Exception as e:
+                print(f'Warning: unable to update the job cache: {str(e)}')
+    finally:
+        # job_metrics.json is reported along with the job by handle_job
+        metrics.stop()
+        metrics.write('job_metrics.json')
 
     # check that the output files were created
     for x in job['output_files']:
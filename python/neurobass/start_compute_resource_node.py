@@ -9,6 +9,7 @@ import signal
 import importlib
 import inspect
 from .init_compute_resource_node import env_var_keys
+from .container_images import collect_container_images, prepare_container_images, container_images_fname
 
 
 this_directory = Path(__file__).parent
@@ -19,6 +20,7 @@ class Daemon:
         self.the_env = the_env
         self.process = None
         self.output_thread = None
+        self.prewarm_thread = None
 
     def _forward_output(self):
         while True:
@@ -44,7 +46,8 @@ class Daemon:
             def register_processing_tool(self, tool: NeurobassPlugin):
                 self._processing_tools.append(tool)
         plugin_context = NeurobassPluginContextImpl()
-        plugin_package_names = ['neurobass']
+        # additional plugin packages can be specified as a comma-separated list
+        plugin_package_names = ['neurobass'] + [x for x in (self.the_env.get('NEUROBASS_PLUGIN_PACKAGES', None) or os.environ.get('NEUROBASS_PLUGIN_PACKAGES', '')).split(',') if x]
         for plugin_package_name in plugin_package_names:
             module = importlib.import_module(plugin_package_name)
             for attr_name in dir(module):
@@ -65,13 +68,24 @@ class Daemon:
         with open(f'{self.dir}/spec.json', 'w') as f:
             json.dump(spec, f, indent=2)
 
+        # Collect the container images required by the tools. Until they are
+        # pulled, container_images.json marks those tools as not ready, and the
+        # node will not start jobs for them.
+        container_method = self.the_env.get('CONTAINER_METHOD', None) or os.environ.get('CONTAINER_METHOD', 'none')
+        tool_images = collect_container_images(plugin_context._processing_tools)
+        container_images_path = f'{self.dir}/{container_images_fname}'
+        if container_method in ['docker', 'singularity'] and tool_images:
+            with open(container_images_path, 'w') as f:
+                json.dump({
+                    'container_method': container_method,
+                    'images': {},
+                    'tools': {tool_name: {'ready': False} for tool_name in tool_images.keys()}
+                }, f, indent=2)
+        elif os.path.exists(container_images_path):
+            os.remove(container_images_path)
+
         cmd = ["node", f'{this_directory}/js/dist/index.js', "start", "--dir", self.dir]
-        env0 = dict(
-            os.environ,
-            COMPUTE_RESOURCE_DIR=self.dir
-        )
-        for k, v in self.the_env.items():
-            env0[k] = v
+        env0 = self._get_node_env()
         self.process = subprocess.Popen(
             cmd,
             stdout=subprocess.PIPE,
@@ -84,6 +98,10 @@ class Daemon:
         self.output_thread = Thread(target=self._forward_output, daemon=True) # daemon=True means that the thread will not block the program from exiting
         self.output_thread.start()
 
+        # pull the container images and start warm sorter containers in the background
+        self.prewarm_thread = Thread(target=_prepare_containers, args=(env0, tool_images), daemon=True)
+        self.prewarm_thread.start()
+
         signal.signal(signal.SIGINT, self._handle_exit)
         signal.signal(signal.SIGTERM, self._handle_exit)
 
@@ -91,6 +109,45 @@ class Daemon:
         if self.process:
             self.process.terminate()
             self.process.wait()
+        _stop_container_pools(self._get_node_env())
+
+    def _get_node_env(self) -> dict:
+        # the environment of the node process (also the configuration of the container pools)
+        env0 = dict(
+            os.environ,
+            COMPUTE_RESOURCE_DIR=os.path.abspath(self.dir)
+        )
+        for k, v in self.the_env.items():
+            # structured values (e.g., JOB_RESOURCE_LIMITS written as YAML) are passed as JSON
+            env0[k] = v if isinstance(v, str) else json.dumps(v)
+        return env0
+
+
+def _prepare_containers(env: dict, tool_images: dict):
+    container_method = env.get('CONTAINER_METHOD', 'none')
+    if container_method not in ['docker', 'singularity']:
+        return
+    if tool_images:
+        prepare_container_images(dir=env['COMPUTE_RESOURCE_DIR'], tool_images=tool_images, container_method=container_method)
+    from .processing_tools.spike_sorting.helpers.run_kilosort3 import get_kilosort3_container_pool
+    pool = get_kilosort3_container_pool(container_method, env=env)
+    if pool is None:
+        return
+    try:
+        print(f'Prewarming {pool.pool_size} {container_method} container(s) for {pool.pool_name}')
+        pool.prewarm()
+    except Exception as e:
+        print(f'Warning: unable to prewarm container pool for {pool.pool_name}: {e}')
+
+def _stop_container_pools(env: dict):
+    from .processing_tools.spike_sorting.helpers.run_kilosort3 import get_kilosort3_container_pool
+    pool = get_kilosort3_container_pool(env.get('CONTAINER_METHOD', 'none'), env=env)
+    if pool is None:
+        return
+    try:
+        pool.stop_all()
+    except Exception as e:
+        print(f'Warning: unable to stop container pool for {pool.pool_name}: {e}')
 
 
 def start_compute_resource_node(dir: str):
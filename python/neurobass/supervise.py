@@ -0,0 +1,127 @@
+from typing import Dict, Union
+import os
+import sys
+import time
+import signal
+import asyncio
+from .handle_job import handle_job_async, load_compute_resource_node_config
+from .NeurobassApiClient import NeurobassApiClient
+
+
+def supervise(*, socket_path: Union[str, None]=None, status_check_interval_sec: float=60):
+    """Handle the jobs of the compute resource node in the current directory, in a single long-lived process
+
+    The job IDs are read one per line, from stdin or (if socket_path is
+    given) from the connections to a unix socket. Each job is handled as in
+    "neurobass handle-job", but all the jobs share the event loop and the
+    pooled connections of a single API client, and the status checks of the
+    running jobs are batched into a single request. When stdin is closed,
+    the supervisor stops once the jobs are finished; on SIGTERM or SIGINT,
+    the jobs are stopped.
+
+    Args:
+        socket_path (str, optional): path of the unix socket to listen on (default: read stdin)
+        status_check_interval_sec (float): interval between the batched status checks
+    """
+    load_compute_resource_node_config()
+    api = NeurobassApiClient.from_env()
+    try:
+        asyncio.run(_supervise(api=api, socket_path=socket_path, status_check_interval_sec=status_check_interval_sec))
+    finally:
+        api.close()
+
+async def _supervise(*, api: NeurobassApiClient, socket_path: Union[str, None], status_check_interval_sec: float):
+    supervisor = _JobSupervisor(api=api, status_check_interval_sec=status_check_interval_sec)
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in [signal.SIGTERM, signal.SIGINT]:
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async def read_job_ids(reader: asyncio.StreamReader):
+        while True:
+            line = await reader.readline()
+            if len(line) == 0:
+                break
+            job_id = line.decode('utf-8').strip()
+            if job_id:
+                supervisor.handle_job(job_id)
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(lambda reader, writer: read_job_ids(reader), path=socket_path)
+        print(f'Listening for job IDs on {socket_path}')
+        try:
+            await stop_event.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            os.remove(socket_path)
+    else:
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        print('Reading job IDs from stdin')
+        stdin_task = asyncio.create_task(read_job_ids(reader))
+        stop_task = asyncio.create_task(stop_event.wait())
+        await asyncio.wait([stdin_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+        stdin_task.cancel()
+        stop_task.cancel()
+    print('No longer accepting jobs')
+    if stop_event.is_set():
+        supervisor.cancel()
+    await supervisor.wait()
+
+class _JobSupervisor:
+    """The jobs being handled, and the batched status checks of the running ones"""
+    def __init__(self, *, api: NeurobassApiClient, status_check_interval_sec: float):
+        self._api = api
+        self._status_check_interval_sec = status_check_interval_sec
+        self._tasks: Dict[str, asyncio.Task] = {}
+        # the statuses of the running jobs of the compute resource, from a single getJobs request
+        self._running_job_ids: Union[set, None] = None
+        self._running_job_ids_timestamp = 0
+        self._running_job_ids_request: Union[asyncio.Task, None] = None
+    def handle_job(self, job_id: str):
+        if job_id in self._tasks:
+            print(f'Job is already being handled: {job_id}')
+            return
+        print(f'Handling job: {job_id}')
+        self._tasks[job_id] = asyncio.create_task(self._handle_job(job_id))
+    def cancel(self):
+        """Stop the jobs being handled (their run-job subprocesses are terminated)"""
+        for task in self._tasks.values():
+            task.cancel()
+    async def wait(self):
+        """Wait for the jobs being handled to finish"""
+        while len(self._tasks) > 0:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+    async def _handle_job(self, job_id: str):
+        try:
+            await handle_job_async(
+                job_id=job_id,
+                api=self._api,
+                get_job_status=lambda: self._get_job_status(job_id),
+                echo_console_output=False
+            )
+            print(f'Finished handling job: {job_id}')
+        except Exception as e:
+            print(f'Error handling job {job_id}: {str(e)}')
+        finally:
+            del self._tasks[job_id]
+    async def _get_job_status(self, job_id: str) -> str:
+        # the checks of all the jobs within an interval share one getJobs request
+        if time.time() - self._running_job_ids_timestamp >= self._status_check_interval_sec / 2:
+            if self._running_job_ids_request is None:
+                self._running_job_ids_request = asyncio.create_task(self._api.get_jobs(status='running'))
+            request = self._running_job_ids_request
+            try:
+                jobs = await asyncio.shield(request)
+            finally:
+                if self._running_job_ids_request is request:
+                    self._running_job_ids_request = None
+            self._running_job_ids = set(job['jobId'] for job in jobs)
+            self._running_job_ids_timestamp = time.time()
+        if job_id in self._running_job_ids:
+            return 'running'
+        # rare: the job is no longer running (or no longer exists)
+        return (await self._api.get_job(job_id=job_id))['status']
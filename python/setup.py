@@ -62,7 +62,8 @@ setup(
         'simplejson',
         'numpy',
         'PyYAML',
-        'remfile'
+        'remfile',
+        'threadpoolctl'
     ],
     cmdclass={
         'install': NpmInstallCommand,